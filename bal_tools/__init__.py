@@ -5,7 +5,14 @@ from .errors import (
     ChecksumError,
     UnexpectedListLengthError,
 )
-from .subgraph import Subgraph
+from .subgraph import Subgraph, warm_url_cache
+from .async_subgraph import AsyncSubgraph
+from .response_cache import (
+    MemoryResponseCache,
+    SQLiteResponseCache,
+    DirectoryResponseCache,
+)
 from .pools_gauges import BalPoolsGauges
-from .ecosystem import Aura, StakeDAO
+from .multichain import MultiChainPoolsGauges
+from .ecosystem import Aura, StakeDAO, load_aura_gauge_mappings_by_chain
 from .drpc import Web3RpcByChain, Web3Rpc
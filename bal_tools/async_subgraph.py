@@ -0,0 +1,284 @@
+import asyncio
+from typing import (
+    AsyncGenerator,
+    AsyncIterator,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+from weakref import WeakKeyDictionary
+
+from aiohttp import ClientError
+from gql import Client
+from gql.client import AsyncClientSession
+from gql.transport.aiohttp import AIOHTTPTransport
+from gql.transport.exceptions import TransportServerError
+
+from .subgraph import Subgraph
+from .queries import QUERY_REGISTRY
+from .response_cache import ResponseCache, response_cache_key, response_ttl
+from .transport import GRAPHQL_CLIENT_HEADERS
+from .pagination import apaginate, get_path, DEFAULT_PAGE_SIZE
+from .ratelimit import (
+    RATE_LIMITERS,
+    RateLimiterRegistry,
+    TokenBucket,
+    backoff_delay,
+    host_of,
+)
+
+
+RETRY_STATUS_CODES = (400, 429, 500, 502, 503, 504, 520)
+DEFAULT_MAX_CONCURRENCY_PER_HOST = 8
+
+
+class AsyncHostLimiter:
+    """
+    bounds the number of in-flight requests to a host and paces them with `bucket`
+    """
+
+    def __init__(self, semaphore: asyncio.Semaphore, bucket: TokenBucket):
+        self.semaphore = semaphore
+        self.bucket = bucket
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        try:
+            await self.bucket.acquire_async()
+        except BaseException:
+            self.semaphore.release()
+            raise
+        return self
+
+    async def __aexit__(self, *args):
+        self.semaphore.release()
+
+
+# concurrency bounds are shared by every AsyncSubgraph on the same event loop, so a
+# sweep over many chains served by the same gateway still respects one per host
+_host_semaphores: (
+    "WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Semaphore]]"
+) = WeakKeyDictionary()
+
+
+def get_host_limiter(
+    url: str,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY_PER_HOST,
+    bucket: TokenBucket = None,
+) -> AsyncHostLimiter:
+    """
+    get the limiter for the host of `url` on the running event loop; the first caller
+    for a host decides its concurrency. requests are paced by `bucket`, by default
+    the host's limiter in `RATE_LIMITERS` shared with the sync clients
+    """
+    semaphores = _host_semaphores.setdefault(asyncio.get_running_loop(), {})
+    host = host_of(url)
+    if host not in semaphores:
+        semaphores[host] = asyncio.Semaphore(max_concurrency)
+    return AsyncHostLimiter(semaphores[host], bucket or RATE_LIMITERS.get(url))
+
+
+class AsyncSubgraph:
+    """
+    asyncio counterpart of `Subgraph.fetch_graphql_data`
+
+    url resolution and the bundled queries are shared with the sync `Subgraph`;
+    requests go over one keep-alive aiohttp session per url and are bounded per host.
+    sessions are closed by `aclose`, or when the event loop that opened them shuts
+    down. `requests_per_second` paces this client only; without it requests share
+    the host's limiter in `RATE_LIMITERS`
+
+    usage:
+        async with AsyncSubgraph("mainnet") as subgraph:
+            results = await asyncio.gather(
+                *[subgraph.fetch_graphql_data("gauges", "fetch_gauge_shares", p) for p in params]
+            )
+    """
+
+    def __init__(
+        self,
+        chain: str = "mainnet",
+        max_concurrency_per_host: int = DEFAULT_MAX_CONCURRENCY_PER_HOST,
+        requests_per_second: float = None,
+        silence_warnings: bool = False,
+        execute_timeout: int = 120,
+        response_cache: ResponseCache = None,
+    ):
+        self.subgraph = Subgraph(
+            chain, silence_warnings=silence_warnings, response_cache=response_cache
+        )
+        self.chain = chain
+        self.max_concurrency_per_host = max_concurrency_per_host
+        self.requests_per_second = requests_per_second
+        self.execute_timeout = execute_timeout
+        # an explicit rate applies to this client only
+        self.rate_limiters = (
+            RateLimiterRegistry(tiers={}) if requests_per_second else None
+        )
+        # sessions and their lock are bound to the event loop that opened them
+        self._sessions: Dict[
+            asyncio.AbstractEventLoop, Dict[str, Tuple[Client, AsyncClientSession]]
+        ] = {}
+        self._sessions_locks: Dict[asyncio.AbstractEventLoop, asyncio.Lock] = {}
+        self._closers: Dict[asyncio.AbstractEventLoop, AsyncGenerator] = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    async def aclose(self):
+        """
+        close the sessions opened on the running event loop
+        """
+        closer = self._closers.pop(asyncio.get_running_loop(), None)
+        if closer is not None:
+            await closer.aclose()
+
+    async def _close_on_shutdown(self, loop: asyncio.AbstractEventLoop):
+        # finalised by `aclose`, or by the loop's `shutdown_asyncgens` (which
+        # `asyncio.run` calls) before the loop closes
+        try:
+            yield
+        finally:
+            self._closers.pop(loop, None)
+            self._sessions_locks.pop(loop, None)
+            for client, _ in self._sessions.pop(loop, {}).values():
+                await client.close_async()
+
+    async def _loop_sessions(self) -> Dict[str, Tuple[Client, AsyncClientSession]]:
+        loop = asyncio.get_running_loop()
+        if loop not in self._sessions:
+            # loops closed without finalising their async generators leave nothing
+            # to close the sessions with
+            for stale in [other for other in list(self._sessions) if other.is_closed()]:
+                self._sessions.pop(stale, None)
+                self._sessions_locks.pop(stale, None)
+                self._closers.pop(stale, None)
+            self._sessions[loop] = {}
+            closer = self._close_on_shutdown(loop)
+            await closer.asend(None)
+            self._closers[loop] = closer
+        return self._sessions[loop]
+
+    def _bucket(self, url: str) -> Optional[TokenBucket]:
+        if self.rate_limiters is None:
+            return None
+        bucket = self.rate_limiters.get(url)
+        if bucket.rate is None:
+            bucket.configure(self.requests_per_second)
+        return bucket
+
+    async def get_subgraph_url(self, subgraph: str = "core") -> str:
+        if not self.subgraph.subgraph_url.get(subgraph):
+            # resolution may hit the network on a cold url cache; keep the loop free
+            self.subgraph.subgraph_url[subgraph] = await asyncio.to_thread(
+                self.subgraph.get_subgraph_url, subgraph
+            )
+        return self.subgraph.subgraph_url[subgraph]
+
+    async def _get_session(self, url: str) -> AsyncClientSession:
+        sessions = await self._loop_sessions()
+        if url in sessions:
+            return sessions[url][1]
+        lock = self._sessions_locks.setdefault(
+            asyncio.get_running_loop(), asyncio.Lock()
+        )
+        async with lock:
+            if url not in sessions:
+                client = Client(
+                    transport=AIOHTTPTransport(url=url, headers=GRAPHQL_CLIENT_HEADERS),
+                    fetch_schema_from_transport=False,
+                    execute_timeout=self.execute_timeout,
+                )
+                sessions[url] = (client, await client.connect_async())
+        return sessions[url][1]
+
+    async def fetch_graphql_data(
+        self,
+        subgraph: str,
+        query: str,
+        params: dict = None,
+        url: str = None,
+        retries: int = 5,
+        validate: bool = False,
+    ):
+        """
+        query a subgraph using a locally saved query
+
+        params:
+        - query: the name of the query (file) to be executed, or the query itself
+        - params: optional parameters to be passed to the query
+        - url: optional url overriding the resolved subgraph url
+        - retries: number of retry attempts on throttling/server errors (default: 5)
+        - validate: check `params` against the query's variable definitions first
+
+        returns:
+        - result of the query
+        """
+        if not url:
+            url = await self.get_subgraph_url(subgraph)
+            if not url:
+                raise ValueError(
+                    f"Subgraph url not found for {subgraph} on chain {self.chain}"
+                )
+
+        gql_query = QUERY_REGISTRY.get(subgraph, query)
+        if validate:
+            QUERY_REGISTRY.validate_variables(subgraph, query, params)
+
+        response_cache = self.subgraph.response_cache
+        if response_cache is not None:
+            cache_key = response_cache_key(url, gql_query, params)
+            result = response_cache.get(cache_key)
+            if result is not None:
+                return result
+
+        limiter = get_host_limiter(
+            url, self.max_concurrency_per_host, self._bucket(url)
+        )
+        session = await self._get_session(url)
+        for attempt in range(retries + 1):
+            try:
+                async with limiter:
+                    result = await session.execute(gql_query, variable_values=params)
+                if response_cache is not None:
+                    response_cache.set(cache_key, result, response_ttl(params))
+                return result
+            except TransportServerError as e:
+                if e.code not in RETRY_STATUS_CODES or attempt == retries:
+                    raise
+            except (ClientError, asyncio.TimeoutError):
+                if attempt == retries:
+                    raise
+            # exponential backoff with jitter, outside of the limiter
+            await asyncio.sleep(backoff_delay(attempt))
+
+    def paginate_graphql_data(
+        self,
+        subgraph: str,
+        query: str,
+        params: dict = None,
+        path: Union[str, Sequence[str]] = None,
+        page_size: int = DEFAULT_PAGE_SIZE,
+        limit: int = None,
+        url: str = None,
+    ) -> AsyncIterator[List[dict]]:
+        """
+        async counterpart of `Subgraph.paginate_graphql_data`
+        """
+
+        async def fetch_page(cursor: str, first: int) -> List[dict]:
+            data = await self.fetch_graphql_data(
+                subgraph,
+                query,
+                {**(params or {}), "first": first, "id_gt": cursor},
+                url=url,
+            )
+            return get_path(data, path)
+
+        return apaginate(fetch_page, page_size, limit)
@@ -0,0 +1,101 @@
+import json
+import os
+import tempfile
+import time
+from importlib.resources import files
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+
+CACHE_DIR = Path(os.getenv("BAL_TOOLS_CACHE_DIR", Path.home() / ".cache" / "bal_tools"))
+DEFAULT_TTL = 24 * 60 * 60
+
+
+def is_offline() -> bool:
+    """
+    true when `BAL_TOOLS_OFFLINE` is set; registries then skip the network entirely
+    """
+    return os.getenv("BAL_TOOLS_OFFLINE", "").lower() in ("1", "true", "yes")
+
+
+def cache_path(name: str) -> Path:
+    return CACHE_DIR / name
+
+
+def read_json_cache(name: str, ttl: Optional[int] = DEFAULT_TTL) -> Optional[Any]:
+    """
+    read a json file from the on-disk cache
+
+    params:
+    - name: file name relative to the cache dir
+    - ttl: max age in seconds; None accepts any age
+
+    returns:
+    - the decoded json, or None if missing, expired or unreadable
+    """
+    path = cache_path(name)
+    try:
+        if ttl is not None and time.time() - path.stat().st_mtime > ttl:
+            return None
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json_cache(name: str, data: Any) -> None:
+    """
+    atomically write a json file to the on-disk cache; failures are ignored
+    so a read-only home dir never breaks the caller
+    """
+    path = cache_path(name)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+def load_bundled_json(name: str) -> Any:
+    with open(files(__package__).joinpath(f"misc/{name}")) as f:
+        return json.load(f)
+
+
+def load_registry(
+    name: str, fetch: Callable[[], Any], ttl: Optional[int] = DEFAULT_TTL
+) -> Any:
+    """
+    resolve a registry that normally lives on the network
+
+    sources used (in order of priority):
+    1. fresh on-disk cache (younger than `ttl`)
+    2. `fetch()`, written back to the on-disk cache
+    3. stale on-disk cache
+    4. snapshot bundled with the package under `misc/`
+
+    params:
+    - name: json file name, used for both the cache and the bundled snapshot
+    - fetch: callable returning the live registry
+    - ttl: max age in seconds of the on-disk cache
+
+    returns:
+    - the registry
+    """
+    data = read_json_cache(name, ttl)
+    if data is not None:
+        return data
+    if not is_offline():
+        try:
+            data = fetch()
+        except Exception:
+            data = None
+        if data:
+            write_json_cache(name, data)
+            return data
+    data = read_json_cache(name, ttl=None)
+    if data is not None:
+        return data
+    return load_bundled_json(name)
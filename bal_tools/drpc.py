@@ -1,6 +1,24 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional, Sequence, Union
+
 from requests import Session
 from requests.adapters import HTTPAdapter, Retry
 from web3 import Web3
+from web3.contract.contract import ContractFunction
+from web3.providers import JSONBaseProvider
+
+try:
+    from web3._utils.batching import sort_batch_response_by_response_ids
+except ImportError:  # web3 < 7 has no batching
+    sort_batch_response_by_response_ids = None
+
+from .errors import AllEndpointsFailedError
+from .models import ChainResults
+from .multicall import MULTICALL_CHUNK_SIZE, multicall
+from .response_cache import ResponseCache
+from .rpc_cache import RpcCallCache
 
 DRPC_NAME_OVERRIDES = {
     "mainnet": "ethereum",
@@ -18,12 +36,373 @@ ADAPTER = HTTPAdapter(
 )
 DRPC_SESSION = Session()
 DRPC_SESSION.mount("https://", ADAPTER)
+BATCH_CHUNK_SIZE = 100  # requests per json-rpc batch
+HEAD_TTL = 1.0  # seconds a fetched chain head is reused for
+PREWARM_MAX_WORKERS = 8
+
+# endpoint pools fail over instead of retrying, so their session never retries
+FAILOVER_SESSION = Session()
+FAILOVER_SESSION.mount(
+    "https://", HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=0)
+)
+FAILOVER_SESSION.mount(
+    "http://", HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=0)
+)
+RPC_TIMEOUT = 10  # seconds per request to a single endpoint
+EWMA_ALPHA = 0.3  # weight of the latest sample in the rolling stats
+ERROR_PENALTY = 1.0  # seconds of latency a 100% error rate is worth when ranking
+ENDPOINT_COOLDOWN = 5.0  # seconds a failing endpoint is skipped, doubled per failure
+MAX_ENDPOINT_COOLDOWN = 5 * 60
+HEDGE_DELAY = 0.25  # min seconds before a slow read is also sent to the next endpoint
+HEDGE_LATENCY_MULTIPLIER = 3  # reads slower than this many times the usual are hedged
+# reads that are safe to send to two endpoints at once
+HEDGED_METHODS = frozenset(
+    {
+        "eth_blockNumber",
+        "eth_call",
+        "eth_chainId",
+        "eth_estimateGas",
+        "eth_gasPrice",
+        "eth_getBalance",
+        "eth_getBlockByHash",
+        "eth_getBlockByNumber",
+        "eth_getCode",
+        "eth_getLogs",
+        "eth_getStorageAt",
+        "eth_getTransactionByHash",
+        "eth_getTransactionCount",
+        "eth_getTransactionReceipt",
+        "net_version",
+        "web3_clientVersion",
+    }
+)
+_HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=32, thread_name_prefix="rpc-hedge")
+
+
+class ChainHeadTracker:
+    """
+    reuses the latest `eth_blockNumber` response for `ttl` seconds; concurrent
+    lookups of an expired head share a single request
+    """
+
+    def __init__(self, ttl: float = HEAD_TTL):
+        self.ttl = ttl
+        self._response = None
+        self._fetched_at = 0.0
+        self._lock = Lock()
+
+    def get(self, fetch: Callable[[], dict]) -> dict:
+        """
+        params:
+        - fetch: callable making the `eth_blockNumber` request
+
+        returns:
+        - the cached or freshly fetched rpc response
+        """
+        with self._lock:
+            if self._response is None or time.monotonic() - self._fetched_at > self.ttl:
+                response = fetch()
+                if "result" not in response:
+                    # errors are passed on, never cached
+                    return response
+                self._response = response
+                self._fetched_at = time.monotonic()
+            return self._response
+
+    @property
+    def block_number(self) -> int:
+        """
+        last fetched head; 0 before the first fetch
+        """
+        return int(self._response["result"], 16) if self._response else 0
+
+
+def route_request(
+    provider, method: str, params: Any, fetch: Callable[[str, Any], dict]
+) -> dict:
+    """
+    answer `eth_blockNumber` from the head tracker and final historical reads from
+    the call cache of `provider`; anything else is `fetch`ed
+    """
+    if method == "eth_blockNumber" and provider.head.ttl:
+        return provider.head.get(lambda: fetch(method, params))
+    if provider.call_cache is None:
+        return fetch(method, params)
+
+    def head() -> int:
+        # a stale head only makes the finality check stricter
+        if not provider.head.block_number:
+            provider.head.get(lambda: fetch("eth_blockNumber", []))
+        return provider.head.block_number
+
+    return provider.call_cache.request(
+        method, params, lambda: fetch(method, params), head
+    )
+
+
+class HeadCachingHTTPProvider(Web3.HTTPProvider):
+    """
+    `HTTPProvider` answering `eth_blockNumber` from a `ChainHeadTracker` and final
+    historical reads from an optional `RpcCallCache`
+    """
+
+    def __init__(
+        self,
+        *args,
+        head_ttl: float = HEAD_TTL,
+        call_cache: RpcCallCache = None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.head = ChainHeadTracker(head_ttl)
+        self.call_cache = call_cache
+
+    def make_request(self, method, params):
+        return route_request(self, method, params, super().make_request)
+
+
+class RpcEndpoint:
+    """
+    an rpc url with its rolling (EWMA) latency and error rate
+    """
+
+    def __init__(self, uri: str, alpha: float = EWMA_ALPHA):
+        self.uri = uri
+        self.alpha = alpha
+        self.latency = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.down_until = 0.0
+        self._consecutive_failures = 0
+        self._in_flight: List[float] = []
+        self._lock = Lock()
+
+    def start(self) -> float:
+        started = time.monotonic()
+        with self._lock:
+            self._in_flight.append(started)
+        return started
+
+    def record(self, started: float, ok: bool):
+        """
+        record the outcome of the request begun by `start`
+        """
+        latency = time.monotonic() - started
+        with self._lock:
+            self._in_flight.remove(started)
+            self.requests += 1
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.alpha * (latency - self.latency)
+            self.error_rate += self.alpha * ((0.0 if ok else 1.0) - self.error_rate)
+            if ok:
+                self._consecutive_failures = 0
+                self.down_until = 0.0
+            else:
+                self.failures += 1
+                self._consecutive_failures += 1
+                cooldown = ENDPOINT_COOLDOWN * 2 ** (self._consecutive_failures - 1)
+                self.down_until = time.monotonic() + min(
+                    cooldown, MAX_ENDPOINT_COOLDOWN
+                )
+
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self.down_until
+
+    def score(self) -> float:
+        """
+        lower is better; endpoints never tried score 0 so they get a first request,
+        and a request still in flight counts with its age so far
+        """
+        latency = self.latency or 0.0
+        with self._lock:
+            if self._in_flight:
+                latency = max(latency, time.monotonic() - min(self._in_flight))
+        return latency + ERROR_PENALTY * self.error_rate
+
+    def stats(self) -> dict:
+        return {
+            "uri": self.uri,
+            "latency": self.latency,
+            "error_rate": self.error_rate,
+            "requests": self.requests,
+            "failures": self.failures,
+            "available": self.available,
+        }
+
+
+class MultiEndpointProvider(JSONBaseProvider):
+    """
+    json-rpc provider spreading requests over several endpoints of one chain
+
+    every request goes to the endpoint with the best rolling latency and error rate.
+    a failing endpoint (connection error, timeout, non-200 status) is skipped for a
+    growing cooldown and the request moves on to the next one at once. reads still
+    unanswered after `HEDGE_LATENCY_MULTIPLIER` times the endpoint's usual latency
+    (and at least `hedge_delay`) are also sent to the next endpoint; the first answer
+    wins. json-rpc errors, eg reverts, are answers and returned as is
+
+    `eth_blockNumber` and final historical reads are answered as by
+    `HeadCachingHTTPProvider`
+    """
+
+    def __init__(
+        self,
+        endpoint_uris: Sequence[str],
+        session: Session = None,
+        request_timeout: float = RPC_TIMEOUT,
+        hedge_delay: float = HEDGE_DELAY,
+        head_ttl: float = HEAD_TTL,
+        call_cache: RpcCallCache = None,
+    ):
+        """
+        params:
+        - endpoint_uris: rpc urls of the chain
+        - session: requests session; defaults to a shared one without retries
+        - request_timeout: seconds before a single endpoint is given up on
+        - hedge_delay: min seconds before a read is hedged; None disables hedging
+        - head_ttl: see `ChainHeadTracker`
+        - call_cache: cache of final historical reads; None disables it
+        """
+        super().__init__()
+        if not endpoint_uris:
+            raise ValueError("At least one endpoint is required")
+        self.endpoints = [RpcEndpoint(uri) for uri in endpoint_uris]
+        self.session = session or FAILOVER_SESSION
+        self.request_timeout = request_timeout
+        self.hedge_delay = hedge_delay
+        self.head = ChainHeadTracker(head_ttl)
+        self.call_cache = call_cache
+
+    @property
+    def endpoint_uri(self) -> str:
+        return self.ranked()[0].uri
+
+    def ranked(self) -> List[RpcEndpoint]:
+        """
+        endpoints best first; those cooling down come last, soonest available first
+        """
+        available = sorted(
+            (e for e in self.endpoints if e.available), key=RpcEndpoint.score
+        )
+        cooling = sorted(
+            (e for e in self.endpoints if not e.available), key=lambda e: e.down_until
+        )
+        return available + cooling
+
+    def stats(self) -> List[dict]:
+        return [endpoint.stats() for endpoint in self.endpoints]
+
+    def _post(self, endpoint: RpcEndpoint, payload: bytes) -> Any:
+        started = endpoint.start()
+        try:
+            response = self.session.post(
+                endpoint.uri,
+                data=payload,
+                headers={"Content-Type": "application/json"},
+                timeout=self.request_timeout,
+            )
+            response.raise_for_status()
+            decoded = self.decode_rpc_response(response.content)
+        except Exception:
+            endpoint.record(started, ok=False)
+            raise
+        endpoint.record(started, ok=True)
+        return decoded
+
+    def _send(self, payload: bytes, hedge: bool) -> Any:
+        endpoints = iter(self.ranked())
+        pending = {}
+        errors = []
+
+        def launch() -> bool:
+            endpoint = next(endpoints, None)
+            if endpoint is None:
+                return False
+            pending[_HEDGE_EXECUTOR.submit(self._post, endpoint, payload)] = endpoint
+            return True
+
+        if not hedge or self.hedge_delay is None or len(self.endpoints) == 1:
+            for endpoint in endpoints:
+                try:
+                    return self._post(endpoint, payload)
+                except Exception as e:
+                    errors.append(f"{endpoint.uri}: {e}")
+        else:
+            exhausted = not launch()
+            while pending:
+                # at most two endpoints race for one read
+                timeout = None
+                if not exhausted and len(pending) < 2:
+                    latency = min(e.latency or 0.0 for e in pending.values())
+                    timeout = max(self.hedge_delay, HEDGE_LATENCY_MULTIPLIER * latency)
+                done, _ = wait(list(pending), timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    exhausted = not launch()
+                    continue
+                for future in done:
+                    endpoint = pending.pop(future)
+                    try:
+                        return future.result()
+                    except Exception as e:
+                        errors.append(f"{endpoint.uri}: {e}")
+                if not pending:
+                    # fail over at once
+                    exhausted = not launch()
+        raise AllEndpointsFailedError(f"All rpc endpoints failed: {'; '.join(errors)}")
+
+    def _request(self, method, params) -> Any:
+        payload = self.encode_rpc_request(method, params)
+        return self._send(payload, method in HEDGED_METHODS)
+
+    def make_request(self, method, params):
+        return route_request(self, method, params, self._request)
+
+    def make_batch_request(self, requests):
+        payload = self.encode_batch_rpc_request(requests)
+        response = self._send(
+            payload, all(method in HEDGED_METHODS for method, _ in requests)
+        )
+        if not isinstance(response, list):
+            # rpc errors come back as a single response
+            return response
+        return sort_batch_response_by_response_ids(response)
 
 
 class Web3RpcByChain:
-    def __init__(self, DRPC_KEY):
+    def __init__(
+        self,
+        DRPC_KEY,
+        lazy: bool = False,
+        head_ttl: float = HEAD_TTL,
+        endpoints: Dict[str, Union[str, List[str]]] = None,
+        call_cache: ResponseCache = None,
+        cache_calls: bool = True,
+        finality_depth: Optional[int] = None,
+    ):
+        """
+        params:
+        - DRPC_KEY: drpc api key
+        - lazy: build the per-chain clients without health checks; each is checked
+          on first use, or all at once by `prewarm`
+        - head_ttl: see `Web3Rpc`
+        - endpoints: rpc url, or urls to fail over between, per chain to use
+          instead of drpc
+        - call_cache, cache_calls, finality_depth: see `Web3Rpc`; one backend serves
+          every chain
+        """
         self.DRPC_KEY = DRPC_KEY
+        self.lazy = lazy
+        self.head_ttl = head_ttl
+        self.endpoints = endpoints or {}
+        self.call_cache = call_cache
+        self.cache_calls = cache_calls
+        self.finality_depth = finality_depth
         self._w3_by_chain = {}
+        self._lock = Lock()
 
     def __getitem__(self, chain):
         return self._get_or_create_w3(chain)
@@ -31,12 +410,57 @@ class Web3RpcByChain:
     def __getattr__(self, chain):
         return self._get_or_create_w3(chain)
 
+    def _create_w3(self, chain: str, lazy: bool) -> "Web3Rpc":
+        return Web3Rpc(
+            chain,
+            self.DRPC_KEY,
+            lazy=lazy,
+            head_ttl=self.head_ttl,
+            endpoint_uri=self.endpoints.get(chain),
+            call_cache=self.call_cache,
+            cache_calls=self.cache_calls,
+            finality_depth=self.finality_depth,
+        )
+
     def _get_or_create_w3(self, chain):
+        if chain.startswith("_"):
+            # keep copy, pickle and friends from creating clients
+            raise AttributeError(chain)
         if chain not in self._w3_by_chain:
-            w3 = Web3Rpc(chain, self.DRPC_KEY)
-            self._w3_by_chain[chain] = w3
+            w3 = self._create_w3(chain, self.lazy)
+            with self._lock:
+                self._w3_by_chain.setdefault(chain, w3)
         return self._w3_by_chain[chain]
 
+    def prewarm(
+        self, chains: Sequence[str], max_workers: int = PREWARM_MAX_WORKERS
+    ) -> ChainResults:
+        """
+        create the clients of `chains` and run their health checks concurrently
+
+        returns:
+        - ChainResults of chain -> Web3Rpc; chains failing their check are in
+          `errors` and are not kept
+        """
+
+        def warm(chain: str) -> "Web3Rpc":
+            w3 = self._create_w3(chain, lazy=True)
+            w3.check()
+            return w3
+
+        chain_results = ChainResults()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {chain: executor.submit(warm, chain) for chain in chains}
+        for chain, future in futures.items():
+            try:
+                w3 = future.result()
+            except Exception as e:
+                chain_results.errors[chain] = e
+                continue
+            with self._lock:
+                chain_results.results[chain] = self._w3_by_chain.setdefault(chain, w3)
+        return chain_results
+
     def __setitem__(self, chain, value):
         self._w3_by_chain[chain] = value
 
@@ -57,29 +481,127 @@ class Web3RpcByChain:
 
 
 class Web3Rpc:
-    def __init__(self, chain, DRPC_KEY):
+    def __init__(
+        self,
+        chain,
+        DRPC_KEY,
+        lazy: bool = False,
+        head_ttl: float = HEAD_TTL,
+        endpoint_uri: Union[str, Sequence[str]] = None,
+        hedge_delay: float = HEDGE_DELAY,
+        call_cache: ResponseCache = None,
+        cache_calls: bool = True,
+        finality_depth: Optional[int] = None,
+    ):
+        """
+        params:
+        - chain: chain to connect to
+        - DRPC_KEY: drpc api key
+        - lazy: skip the health check here; it runs on first use instead
+        - head_ttl: seconds `eth.block_number` is answered from the last fetched
+          head; 0 always asks the node
+        - endpoint_uri: rpc url to use instead of drpc, or several urls pooled by a
+          `MultiEndpointProvider`
+        - hedge_delay: see `MultiEndpointProvider`
+        - call_cache: backend of the `RpcCallCache` memoizing `eth_call`,
+          `eth_getBalance` and `eth_getBlockByNumber` (full transactions included)
+          at final blocks; defaults to the process wide in-memory lru,
+          `SQLiteResponseCache` persists results
+        - cache_calls: False disables the cache
+        - finality_depth: blocks behind the head a read must be to be cached;
+          defaults to the depth of the chain in `rpc_cache.FINALITY_DEPTHS`
+        """
+        self.chain = chain
         drpc_chain = DRPC_NAME_OVERRIDES.get(chain, chain)
-        endpoint_uri = (
+        endpoint_uri = endpoint_uri or (
             f"https://lb.drpc.live/ogrpc?network={drpc_chain}&dkey={DRPC_KEY}"
         )
+        if not isinstance(endpoint_uri, str) and len(endpoint_uri) == 1:
+            endpoint_uri = endpoint_uri[0]
+        self._checked = False
+        self.call_cache = None
+        if cache_calls:
+            self.call_cache = RpcCallCache(chain, call_cache, finality_depth)
         try:
-            self.w3 = Web3(
-                Web3.HTTPProvider(endpoint_uri=endpoint_uri, session=DRPC_SESSION)
-            )
+            if isinstance(endpoint_uri, str):
+                provider = HeadCachingHTTPProvider(
+                    endpoint_uri=endpoint_uri,
+                    session=DRPC_SESSION,
+                    head_ttl=head_ttl,
+                    call_cache=self.call_cache,
+                )
+            else:
+                provider = MultiEndpointProvider(
+                    endpoint_uri,
+                    hedge_delay=hedge_delay,
+                    head_ttl=head_ttl,
+                    call_cache=self.call_cache,
+                )
+            self.w3 = Web3(provider)
         except Exception as e:
             raise ConnectionError(
                 f"Error connecting to {drpc_chain} on DRPC (url: {endpoint_uri}): {e}"
             )
-        if not self.w3.is_connected():
-            raise ConnectionError(
-                f"Not connected to {drpc_chain} on DRPC (url: {endpoint_uri})"
-            )
+        if not lazy:
+            self.check()
+
+    def check(self):
+        """
+        health check of the endpoint: fetches the chain head, which then primes the
+        head cache; runs at most once
+
+        raises:
+        - ConnectionError when the node does not answer
+        """
+        if self._checked:
+            return
         try:
             self.w3.eth.block_number
         except Exception as e:
             raise ConnectionError(
-                f"Error fetching latest block number: {e}, chain: {chain}, url: {self.w3.provider.endpoint_uri}"
+                f"Error fetching latest block number: {e}, chain: {self.chain}, url: {self.w3.provider.endpoint_uri}"
             )
+        self._checked = True
+
+    def batch_call(
+        self,
+        calls: Sequence[ContractFunction],
+        block_identifier="latest",
+        allow_failure: bool = False,
+        chunk_size: int = MULTICALL_CHUNK_SIZE,
+    ) -> List[Any]:
+        """
+        run many contract reads at the same block in a few Multicall3 eth_calls; see
+        `bal_tools.multicall.multicall`
+        """
+        self.check()
+        return multicall(
+            self.w3, calls, block_identifier, allow_failure, chunk_size=chunk_size
+        )
+
+    def get_blocks(
+        self, block_identifiers: Sequence, chunk_size: int = BATCH_CHUNK_SIZE
+    ) -> List[Any]:
+        """
+        fetch many blocks in json-rpc batch requests of `chunk_size` blocks
+
+        returns:
+        - blocks in the order of `block_identifiers`
+        """
+        self.check()
+        if not hasattr(self.w3, "batch_requests"):
+            # web3 < 7 has no batching
+            return [self.w3.eth.get_block(block) for block in block_identifiers]
+        blocks = []
+        for i in range(0, len(block_identifiers), chunk_size):
+            with self.w3.batch_requests() as batch:
+                for block in block_identifiers[i : i + chunk_size]:
+                    batch.add(self.w3.eth.get_block(block))
+                blocks += batch.execute()
+        return blocks
 
     def __getattr__(self, name):
+        if name.startswith("_") or "w3" not in self.__dict__:
+            raise AttributeError(name)
+        self.check()
         return getattr(self.w3, name)
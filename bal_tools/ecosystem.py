@@ -1,9 +1,12 @@
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import math
 import os
 import re
 import statistics
-from typing import Dict
+import time
+from functools import cached_property
+from typing import Dict, Iterator, List, Optional, Tuple
 from .errors import (
     UnexpectedListLengthError,
     MultipleMatchesError,
@@ -12,6 +15,9 @@ from .errors import (
 from web3 import Web3
 import requests
 from .subgraph import Subgraph
+from .cache import read_json_cache, write_json_cache
+from .models import ChainResults
+from .pagination import DEFAULT_PAGE_SIZE, paginate
 from .drpc import Web3RpcByChain
 from .utils import to_checksum_address
 
@@ -20,6 +26,45 @@ AURA_L2_DEFAULT_GAUGE_STAKER = to_checksum_address(
     "0xC181Edc719480bd089b94647c2Dc504e2700a2B0"
 )
 
+AURA_SNAPSHOT_MAX_AGE = 60 * 60  # snapshots younger than this skip the subgraph
+
+
+def aura_snapshot_file(chain: str) -> str:
+    return f"aura_gauge_mappings_{chain.lower()}.json"
+
+
+def load_aura_gauge_mappings_by_chain(
+    chains: List[str],
+    max_age: int = AURA_SNAPSHOT_MAX_AGE,
+    max_workers: int = None,
+) -> ChainResults:
+    """
+    load the gauge to aura PID mappings of many chains concurrently, each from its
+    on-disk snapshot topped up with the gauges changed since
+
+    params:
+    - chains: chains to load
+    - max_age: see `Aura.load_aura_gauge_mappings`
+    - max_workers: number of chains loaded at once
+
+    returns:
+    - ChainResults of chain -> {gauge_address: PID}; pass a result on to
+      `Aura(chain, aura_pids_by_address=...)`
+    """
+
+    def load(chain: str) -> Dict[str, int]:
+        return Aura(chain, lazy=True).load_aura_gauge_mappings(max_age)
+
+    chain_results = ChainResults()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {chain: executor.submit(load, chain) for chain in chains}
+    for chain, future in futures.items():
+        try:
+            chain_results.results[chain] = future.result()
+        except Exception as e:
+            chain_results.errors[chain] = e
+    return chain_results
+
 
 class KeyAsDefaultDict(defaultdict):
     def __missing__(self, key):
@@ -33,42 +78,148 @@ class Aura:
         "0xaF52695E1bB01A16D33D7194C28C42b10e0Dbec2"
     )
 
-    def __init__(self, chain):
+    def __init__(
+        self,
+        chain,
+        lazy: bool = False,
+        aura_pids_by_address: Dict[str, int] = None,
+        snapshot_max_age: Optional[int] = AURA_SNAPSHOT_MAX_AGE,
+    ):
+        """
+        params:
+        - chain: chain to query
+        - lazy: fetch the gauge to PID mapping on first access instead of here
+        - aura_pids_by_address: already loaded gauge to PID mapping
+        - snapshot_max_age: max age in seconds of the on-disk mapping snapshot before
+          it is topped up from the subgraph; None disables the snapshot
+        """
         self.chain = chain
         self.subgraph = Subgraph(chain)
+        self.lazy = lazy
+        self.snapshot_max_age = snapshot_max_age
+        self._force_refresh = False
+        if aura_pids_by_address is not None:
+            self.aura_pids_by_address = aura_pids_by_address
+        elif not lazy:
+            self.aura_pids_by_address
+
+    @cached_property
+    def aura_pids_by_address(self) -> Optional[Dict[str, int]]:
         try:
-            self.aura_pids_by_address = Aura.get_aura_gauge_mappings(self)
+            if self.snapshot_max_age is None:
+                return Aura.get_aura_gauge_mappings(self)
+            max_age = 0 if self._force_refresh else self.snapshot_max_age
+            self._force_refresh = False
+            return self.load_aura_gauge_mappings(max_age)
         except Exception as e:
             print(f"Failed to populate aura pids from aura subgraph: {e}")
-            self.aura_pids_by_address = None
+            return None
+
+    def refresh(self):
+        """
+        refetch the gauge to PID mapping, topping up the snapshot regardless of its
+        age; lazy instances refetch on the next access
+        """
+        self.__dict__.pop("aura_pids_by_address", None)
+        self._force_refresh = True
+        if not self.lazy:
+            self.aura_pids_by_address
 
     def get_aura_gauge_mappings(self) -> Dict[str, int]:
         """
         Get a dict with gauge_address as key and aura PID as value for the running chain.
         """
-        data = self.subgraph.fetch_graphql_data("aura", "get_aura_gauge_mappings")
-        # print(json.dumps(data, indent=1))
-        aura_pid_by_gauge = {}
-        for result_item in data["gauges"]:
-            gauge_address = to_checksum_address(result_item["pool"]["gauge"]["id"])
-            pid = result_item["pool"]["id"]
-            # Seems like pid can be a string or a list
-            if isinstance(pid, list):
-                if len(pid > 1):
+        return self.fetch_aura_gauge_mappings()[0]
+
+    def fetch_aura_gauge_mappings(
+        self, since_block: int = 0, known: Dict[str, int] = None
+    ) -> Tuple[Dict[str, int], Optional[int]]:
+        """
+        Fetch the gauge to aura PID mapping, or only the gauges changed since a block
+
+        params:
+        - since_block: only fetch the gauges added or changed at or after this block
+        - known: mapping the fetched gauges are merged into
+
+        returns:
+        - (dict of gauge_address -> PID, block the subgraph was indexed up to when the
+          fetch started; None if the subgraph does not report it)
+        """
+        aura_pid_by_gauge = dict(known or {})
+        fetched = set()
+        block = None
+
+        def fetch_page(cursor: str, first: int) -> List[dict]:
+            nonlocal block
+            data = self.subgraph.fetch_graphql_data(
+                "aura",
+                "get_aura_gauge_mappings",
+                {"first": first, "id_gt": cursor, "since": int(since_block)},
+            )
+            if block is None and data.get("_meta"):
+                block = int(data["_meta"]["block"]["number"])
+            return data["gauges"]
+
+        for page in paginate(fetch_page):
+            for result_item in page:
+                gauge_address = to_checksum_address(result_item["pool"]["gauge"]["id"])
+                pid = result_item["pool"]["id"]
+                # Seems like pid can be a string or a list
+                if isinstance(pid, list):
+                    if len(pid) > 1:
+                        raise MultipleMatchesError(
+                            f"Gauge: {gauge_address} is returning multiple aura PIDs: {pid}"
+                        )
+                    else:
+                        pid = pid[0]
+
+                # a gauge re-added under a new pool overrides its `known` PID; only a
+                # gauge listed twice by the subgraph is ambiguous
+                if gauge_address in fetched:
                     raise MultipleMatchesError(
-                        f"Gauge: {gauge_address} is returning multiple aura PIDs: {pid}"
+                        f"Gauge with address{gauge_address} already found with PID"
+                        f" {aura_pid_by_gauge[gauge_address]} when trying to"
+                        f" insert new PID {pid}"
                     )
-                else:
-                    pid = [pid][0]
-
-            if gauge_address in aura_pid_by_gauge:
-                raise MultipleMatchesError(
-                    f"Gauge with address{gauge_address} already found with PID"
-                    f" {aura_pid_by_gauge[gauge_address]} when trying to"
-                    f" insert new PID {pid}"
-                )
-            aura_pid_by_gauge[gauge_address] = pid
-        return aura_pid_by_gauge
+                fetched.add(gauge_address)
+                aura_pid_by_gauge[gauge_address] = pid
+        return aura_pid_by_gauge, block
+
+    def load_aura_gauge_mappings(
+        self, max_age: int = AURA_SNAPSHOT_MAX_AGE
+    ) -> Dict[str, int]:
+        """
+        Get the gauge to aura PID mapping from the on-disk snapshot of the chain
+
+        A snapshot older than `max_age` is topped up with the gauges changed since the
+        block it was taken at and written back; without a snapshot the full mapping is
+        fetched
+
+        params:
+        - max_age: max age in seconds of the snapshot before it is topped up
+
+        returns:
+        - dict of gauge_address -> PID
+        """
+        name = aura_snapshot_file(self.chain)
+        snapshot = read_json_cache(name, ttl=None)
+        if snapshot and time.time() - snapshot["fetched_at"] <= max_age:
+            return snapshot["mappings"]
+
+        fetched_at = time.time()
+        if snapshot:
+            mappings, block = self.fetch_aura_gauge_mappings(
+                snapshot["block"], snapshot["mappings"]
+            )
+            # an unreported block keeps the old one, so nothing is skipped next time
+            block = snapshot["block"] if block is None else block
+        else:
+            mappings, block = self.fetch_aura_gauge_mappings()
+        if block is not None:
+            write_json_cache(
+                name, {"block": block, "fetched_at": fetched_at, "mappings": mappings}
+            )
+        return mappings
 
     def get_aura_pool_shares(self, gauge_address, block) -> Dict[str, int]:
         """
@@ -81,28 +232,90 @@ class Aura:
         returns:
         - result of the query
         """
-        # Prepare the GraphQL query and variables
+        results = {}
+        for page in self.iter_aura_pool_shares(gauge_address, block):
+            results.update(page)
+        return results
+
+    def iter_aura_pool_shares(
+        self, gauge_address, block, page_size: int = DEFAULT_PAGE_SIZE
+    ) -> Iterator[Dict[str, float]]:
+        """
+        Stream the aura stakers of a gauge at `block`, one page of {user: amount} at a time,
+        so large leaderboards are never held in memory at once
+
+        params:
+        - gauge_address: The gauge to query that has BPTs deposited in it
+        - block: The block to query on
+        - page_size: Number of accounts fetched per request
+
+        returns:
+        - generator of {user_address: amount} dicts
+        """
         gauge_address = to_checksum_address(gauge_address)
         aura_pid = self.aura_pids_by_address.get(gauge_address)
-        variables = {"poolId": aura_pid, "block": int(block)}
-        try:
-            data = self.subgraph.fetch_graphql_data(
-                "aura", "get_aura_user_pool_balances", variables
+        pages = self.subgraph.paginate_graphql_data(
+            "aura",
+            "get_aura_user_pool_balances",
+            {"poolId": aura_pid, "block": int(block)},
+            ("leaderboard", "accounts"),
+            page_size=page_size,
+        )
+        for accounts in self._raise_no_result(pages):
+            yield {
+                user: amount for _, user, amount in self._parse_aura_accounts(accounts)
+            }
+
+    def get_aura_pool_shares_for_gauges(
+        self, gauge_addresses: List[str], block, page_size: int = DEFAULT_PAGE_SIZE
+    ) -> Dict[str, Dict[str, float]]:
+        """
+        Get the aura stakers of many gauges at `block`; all gauges share one paginated
+        stream of pool accounts instead of one query (or more) per gauge
+
+        params:
+        - gauge_addresses: The gauges to query that have BPTs deposited in them
+        - block: The block to query on
+        - page_size: Number of accounts fetched per request
+
+        returns:
+        - dict of gauge_address -> {user_address: amount}
+        """
+        gauge_by_pid = {}
+        for gauge_address in gauge_addresses:
+            gauge_address = to_checksum_address(gauge_address)
+            gauge_by_pid[str(self.get_aura_pid_from_gauge(gauge_address))] = (
+                gauge_address
             )
+        results = {gauge: {} for gauge in gauge_by_pid.values()}
+        if not gauge_by_pid:
+            return results
+        pages = self.subgraph.paginate_graphql_data(
+            "aura",
+            "get_aura_users_pool_balances",
+            {"poolIds": list(gauge_by_pid), "block": int(block)},
+            "poolAccounts",
+            page_size=page_size,
+        )
+        for accounts in self._raise_no_result(pages):
+            for pid, user, amount in self._parse_aura_accounts(accounts):
+                results[gauge_by_pid[pid]][user] = amount
+        return results
+
+    @staticmethod
+    def _raise_no_result(pages: Iterator[List[dict]]) -> Iterator[List[dict]]:
+        try:
+            yield from pages
         except Exception as e:
             raise NoResultError(f"Problem executing subgraph query: {e}")
 
-        results = {}
-        # Parse the data if the query was successful
-        if data and "leaderboard" in data and data["leaderboard"]["accounts"]:
-            for account in data["leaderboard"]["accounts"]:
-                ## Aura amounts are WEI denominated and others are float.  Transform
-                amount = float(int(account["staked"]) / 1e18)
-                user_address = to_checksum_address(account["account"]["id"])
-                results[user_address] = amount
-        # TODO better handle pagination with the query and this function/pull multiple pages if required
-        assert len(results) < 1000, "Pagination limit hit on Aura query"
-        return results
+    @staticmethod
+    def _parse_aura_accounts(accounts: List[dict]) -> Iterator[Tuple[str, str, float]]:
+        for account in accounts:
+            ## Aura amounts are WEI denominated and others are float.  Transform
+            amount = float(int(account["staked"]) / 1e18)
+            user_address = to_checksum_address(account["account"]["id"])
+            yield account["pool"]["id"], user_address, amount
 
     def get_aura_pid_from_gauge(self, deposit_gauge_address: str) -> int:
         """
@@ -144,6 +357,9 @@ class Snapshot:
     ):
         limit = 100
         offset = 0
+        # one block lookup for all proposals
+        current_timestamp = web3.eth.get_block("latest")["timestamp"]
+        timestamp_two_weeks_ago = current_timestamp - (60 * 60 * 24 * 7 * 2)
         while True:
             result = self.subgraph.fetch_graphql_data(
                 subgraph="snapshot",
@@ -159,10 +375,6 @@ class Snapshot:
                     continue
                 match = re.match(r"Gauge Weight for Week of .+", proposal["title"])
                 number_of_choices = len(proposal["choices"])
-                current_timestamp = web3.eth.get_block(web3.eth.get_block_number())[
-                    "timestamp"
-                ]
-                timestamp_two_weeks_ago = current_timestamp - (60 * 60 * 24 * 7 * 2)
                 if match and number_of_choices > self.SNAPSHOT_MIN_AMOUNT_POOLS:
                     if timestamp_two_weeks_ago < proposal["end"] < current_timestamp:
                         gauge_proposal = proposal
@@ -20,3 +20,15 @@ class UnexpectedListLengthError(Exception):
 
 class NoPricesFoundError(Exception):
     pass
+
+
+class QueryVariablesError(Exception):
+    pass
+
+
+class MulticallFailedError(Exception):
+    pass
+
+
+class AllEndpointsFailedError(Exception):
+    pass
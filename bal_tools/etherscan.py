@@ -1,13 +1,96 @@
 import os
+import sqlite3
 import time
-from typing import Optional, Dict, Any
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock
+from typing import Optional, Dict, Any, Iterable, List, Tuple, Union
 import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
 
+from .cache import cache_path
+from .ratelimit import RATE_LIMITERS, RateLimiterRegistry, TokenBucket
+from .transport import RateLimitedAdapter, RateLimitedRetry
 from .utils import chain_ids_by_name
 
 
+BLOCK_LOOKUP_MAX_WORKERS = 8
+# lookups closer than this to now may still resolve to another block
+BLOCK_CACHE_MIN_AGE = 60 * 60
+
+
+class BlockCache:
+    """
+    persistent (chain, timestamp, closest) -> block number cache in sqlite; falls
+    back on an in-memory database when the cache dir is not writable
+    """
+
+    def __init__(self, path: Union[str, Path] = None):
+        """
+        params:
+        - path: sqlite file; defaults to `blocks.sqlite` in the bal_tools cache dir
+        """
+        path = cache_path("blocks.sqlite") if path is None else path
+        try:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(path), check_same_thread=False, timeout=30)
+            self._create()
+        except (OSError, sqlite3.Error):
+            self._conn = sqlite3.connect(":memory:", check_same_thread=False)
+            self._create()
+        self._lock = Lock()
+
+    def _create(self):
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS blocks (chain TEXT, timestamp INTEGER,"
+                " closest TEXT, block INTEGER, PRIMARY KEY (chain, timestamp, closest))"
+            )
+
+    def get_many(
+        self, chain: str, timestamps: Iterable[int], closest: str
+    ) -> Dict[int, int]:
+        timestamps = list(timestamps)
+        found = {}
+        with self._lock:
+            # stay under sqlite's bound parameter limit
+            for i in range(0, len(timestamps), 500):
+                chunk = timestamps[i : i + 500]
+                rows = self._conn.execute(
+                    "SELECT timestamp, block FROM blocks WHERE chain = ?"
+                    f" AND closest = ? AND timestamp IN ({','.join('?' * len(chunk))})",
+                    (chain, closest, *chunk),
+                ).fetchall()
+                found.update(rows)
+        return found
+
+    def set_many(self, chain: str, blocks: Dict[int, int], closest: str):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?)",
+                [(chain, ts, closest, block) for ts, block in blocks.items()],
+            )
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM blocks")
+
+
+_default_block_cache = None
+_default_block_cache_lock = Lock()
+
+
+def get_block_cache() -> BlockCache:
+    """
+    the block cache shared by every `Etherscan` client in the process
+    """
+    global _default_block_cache
+    with _default_block_cache_lock:
+        if _default_block_cache is None:
+            _default_block_cache = BlockCache()
+        return _default_block_cache
+
+
 class Etherscan:
     BASE_URL = "https://api.etherscan.io/v2/api"
     # can be removed if official support is added by etherscan or a dedicated blocks subgraph is added
@@ -17,21 +100,91 @@ class Etherscan:
         "https://api.routescan.io/v2/network/mainnet/evm/9745/etherscan/api"
     )
 
-    def __init__(self, api_key: Optional[str] = None):
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        block_cache: BlockCache = None,
+        requests_per_second: float = None,
+        tier: str = None,
+    ):
+        """
+        params:
+        - api_key: etherscan api key; defaults to `ETHERSCAN_API_KEY`
+        - block_cache: cache of resolved blocks; defaults to the on-disk cache
+          shared by the process
+        - requests_per_second: etherscan limit of this client, overriding `tier`
+        - tier: api key tier of this client (see `RATE_LIMIT_TIERS`)
+
+        requests to etherscan and routescan go through the process wide limiters of
+        `bal_tools.ratelimit.RATE_LIMITERS`, set with `configure_rate_limit` (or
+        `ETHERSCAN_API_TIER`). a client given its own `requests_per_second` or `tier`
+        is paced by limiters of its own instead
+        """
         self.api_key = api_key or os.getenv("ETHERSCAN_API_KEY")
+        self._block_cache = block_cache
+        self.rate_limiters = None
+        if requests_per_second or tier:
+            self.rate_limiters = RateLimiterRegistry()
+            self.rate_limiters.configure(
+                self.BASE_URL,
+                requests_per_second,
+                tier=None if requests_per_second else tier,
+            )
 
         self.session = requests.Session()
-        retry_strategy = Retry(
+        retry_strategy = RateLimitedRetry(
             total=3,
             backoff_factor=0.5,
             status_forcelist=[429, 500, 502, 503, 504],
+            registry=self.rate_limiters,
+        )
+        adapter = RateLimitedAdapter(
+            max_retries=retry_strategy, registry=self.rate_limiters
         )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
         self.session.mount("http://", adapter)
         self.session.mount("https://", adapter)
-
+        # deprecated: kept for callers reading it, pacing is done by the limiters
         self.last_request_time = 0
-        self.rate_limit_delay = 0.2  # 200ms
+
+    @property
+    def rate_limit_delay(self) -> float:
+        """
+        deprecated: seconds between etherscan requests, use `requests_per_second`
+        """
+        rate = (self.rate_limiters or RATE_LIMITERS).get(self.BASE_URL).rate
+        return 1 / rate if rate else 0
+
+    @rate_limit_delay.setter
+    def rate_limit_delay(self, delay: float):
+        warnings.warn(
+            "Etherscan.rate_limit_delay is deprecated, use requests_per_second",
+            DeprecationWarning,
+            stacklevel=2,
+        )
+        if self.rate_limiters is None:
+            self.rate_limiters = RateLimiterRegistry()
+            for adapter in self.session.adapters.values():
+                adapter.registry = self.rate_limiters
+                adapter.max_retries.registry = self.rate_limiters
+        self.rate_limiters.configure(self.BASE_URL, 1 / delay if delay else None)
+
+    def _rate_limit(self):
+        """
+        deprecated: requests are paced by the limiters of the session
+        """
+        warnings.warn(
+            "Etherscan._rate_limit is deprecated, requests are paced by the session",
+            DeprecationWarning,
+            stacklevel=2,
+        )
+        (self.rate_limiters or RATE_LIMITERS).get(self.BASE_URL).acquire()
+        self.last_request_time = time.time()
+
+    @property
+    def block_cache(self) -> BlockCache:
+        if self._block_cache is None:
+            self._block_cache = get_block_cache()
+        return self._block_cache
 
     def _get_chain_id(self, chain: str) -> int:
         chain_ids = chain_ids_by_name()
@@ -41,19 +194,11 @@ class Etherscan:
             )
         return chain_ids[chain]
 
-    def _rate_limit(self):
-        current_time = time.time()
-        time_since_last_request = current_time - self.last_request_time
-        if time_since_last_request < self.rate_limit_delay:
-            time.sleep(self.rate_limit_delay - time_since_last_request)
-        self.last_request_time = time.time()
-
     def _make_request(self, params: Dict[str, Any]) -> Dict[str, Any]:
-        self._rate_limit()
-
         params["apikey"] = self.api_key
 
         response = self.session.get(self.BASE_URL, params=params, timeout=30)
+        self.last_request_time = time.time()
         response.raise_for_status()
 
         data = response.json()
@@ -113,6 +258,59 @@ class Etherscan:
 
     def get_block_by_timestamp(
         self, chain: str, timestamp: int, closest: str = "before"
+    ) -> Optional[int]:
+        blocks = self.get_blocks_by_timestamps({chain: [timestamp]}, closest)
+        return blocks[chain][int(timestamp)]
+
+    def get_blocks_by_timestamps(
+        self,
+        timestamps_by_chain: Dict[str, Iterable[int]],
+        closest: str = "before",
+        max_workers: int = BLOCK_LOOKUP_MAX_WORKERS,
+    ) -> Dict[str, Dict[int, Optional[int]]]:
+        """
+        resolve many timestamps on many chains to block numbers
+
+        timestamps are deduped and looked up in the block cache first; the rest are
+        fetched concurrently, paced by the per-provider rate limits. blocks of
+        timestamps older than `BLOCK_CACHE_MIN_AGE` are written back to the cache
+
+        params:
+        - timestamps_by_chain: dict of chain -> unix timestamps
+        - closest: "before" or "after"
+        - max_workers: number of concurrent requests
+
+        returns:
+        - dict of chain -> {timestamp: block number, or None if not found}
+
+        raises:
+        - the error of the first lookup failing on both etherscan and routescan
+        """
+        results: Dict[str, Dict[int, Optional[int]]] = {}
+        jobs: List[Tuple[str, int]] = []
+        for chain, timestamps in timestamps_by_chain.items():
+            timestamps = list(dict.fromkeys(int(ts) for ts in timestamps))
+            results[chain] = self.block_cache.get_many(chain, timestamps, closest)
+            jobs += [(chain, ts) for ts in timestamps if ts not in results[chain]]
+
+        def fetch(job: Tuple[str, int]) -> Optional[int]:
+            return self._fetch_block_by_timestamp(*job, closest)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            blocks = list(executor.map(fetch, jobs))
+
+        cutoff = time.time() - BLOCK_CACHE_MIN_AGE
+        to_cache: Dict[str, Dict[int, int]] = {}
+        for (chain, ts), block in zip(jobs, blocks):
+            results[chain][ts] = block
+            if block is not None and ts <= cutoff:
+                to_cache.setdefault(chain, {})[ts] = block
+        for chain, blocks_by_ts in to_cache.items():
+            self.block_cache.set_many(chain, blocks_by_ts, closest)
+        return results
+
+    def _fetch_block_by_timestamp(
+        self, chain: str, timestamp: int, closest: str = "before"
     ) -> Optional[int]:
         if chain == "plasma":
             return self._get_block_by_timestamp_plasma(timestamp, closest)
@@ -151,3 +349,27 @@ class Etherscan:
                 raise Exception(
                     f"Error fetching block for timestamp {timestamp} on {chain}: {str(etherscan_error)}"
                 )
+
+
+def configure_rate_limit(
+    tier: str = None, requests_per_second: float = None
+) -> TokenBucket:
+    """
+    set the etherscan limit shared by every client of the process
+
+    params:
+    - tier: api key tier (see `RATE_LIMIT_TIERS`)
+    - requests_per_second: explicit limit, overriding `tier`
+
+    returns:
+    - the etherscan limiter of `RATE_LIMITERS`
+    """
+    return RATE_LIMITERS.configure(
+        Etherscan.BASE_URL,
+        requests_per_second,
+        tier=None if requests_per_second else tier,
+    )
+
+
+if os.getenv("ETHERSCAN_API_TIER"):
+    configure_rate_limit(os.getenv("ETHERSCAN_API_TIER"))
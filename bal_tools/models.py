@@ -1,9 +1,9 @@
 # monkey patches the .__json__() method so that it can serialise custom objects
 import json_fix
 
-from typing import Optional, List, Tuple, Dict, NewType
+from typing import Any, Optional, List, Tuple, Dict, NewType
 from decimal import Decimal
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
 from pydantic import BaseModel, field_validator, model_validator, Field
 
@@ -63,6 +63,48 @@ class TwapPrices:
     token_prices: List[TWAPResult]
 
 
+@dataclass
+class CorePoolsDiff:
+    """
+    core pools that entered or left the set since the previous build, per chain
+    """
+
+    added: Dict[str, Dict[str, str]] = field(default_factory=dict)
+    removed: Dict[str, Dict[str, str]] = field(default_factory=dict)
+
+    @property
+    def changed(self) -> bool:
+        return any(self.added.values()) or any(self.removed.values())
+
+
+@dataclass
+class RateLimitMetrics:
+    """
+    counters of a rate limiter: requests let through, how many of them had to wait
+    and for how long in total, and `Retry-After` pauses received
+    """
+
+    requests: int = 0
+    throttled: int = 0
+    waited: float = 0.0
+    pauses: int = 0
+
+
+@dataclass
+class ChainResults:
+    """
+    outcome of a cross-chain sweep; chains that failed are in `errors` instead
+    of `results`
+    """
+
+    results: Dict[str, Any] = field(default_factory=dict)
+    errors: Dict[str, Exception] = field(default_factory=dict)
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+
 class Token(BaseModel):
     address: str
     logoURI: str
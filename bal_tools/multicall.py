@@ -0,0 +1,79 @@
+from typing import Any, List, Sequence
+
+from eth_utils.abi import collapse_if_tuple
+from web3 import Web3
+from web3._utils.abi import map_abi_data, named_tree, recursive_dict_to_namedtuple
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
+from web3.contract.contract import ContractFunction
+
+from .errors import MulticallFailedError
+from .utils import get_abi, to_checksum_address
+
+
+# deployed at the same address on every supported chain
+MULTICALL3_ADDRESS = "0xcA11bde05977b3631167028862bE2a173976CA11"
+# calls per `aggregate3`; keeps each eth_call well under node gas caps
+MULTICALL_CHUNK_SIZE = 500
+
+
+def decode_call_output(w3: Web3, call: ContractFunction, data: bytes) -> Any:
+    """
+    decode the return data of `call` the way `call.call()` returns it: addresses
+    checksummed at any depth, a single output as is, several as a list
+    """
+    outputs = call.abi["outputs"]
+    output_types = [collapse_if_tuple(o) for o in outputs]
+    values = w3.codec.decode(output_types, data)
+    # the normalisation `ContractFunction.call` applies
+    values = map_abi_data(BASE_RETURN_NORMALIZERS, output_types, values)
+    if call.decode_tuples:
+        values = recursive_dict_to_namedtuple(named_tree(outputs, values))
+    return values[0] if len(values) == 1 else values
+
+
+def multicall(
+    w3: Web3,
+    calls: Sequence[ContractFunction],
+    block_identifier="latest",
+    allow_failure: bool = False,
+    chunk_size: int = MULTICALL_CHUNK_SIZE,
+    multicall_address: str = MULTICALL3_ADDRESS,
+) -> List[Any]:
+    """
+    run many contract reads at the same block through Multicall3 `aggregate3`, one
+    eth_call per `chunk_size` reads
+
+    params:
+    - w3: web3 instance (or Web3Rpc) of the chain
+    - calls: bound contract functions, eg `contract.functions.balanceOf(user)`
+    - block_identifier: block all reads are made at
+    - allow_failure: return None for reverted reads instead of raising
+    - chunk_size: max reads per eth_call
+    - multicall_address: Multicall3 deployment to use
+
+    returns:
+    - decoded results in the order of `calls`
+
+    raises:
+    - MulticallFailedError when a read reverts and `allow_failure` is False
+    """
+    multicall3 = w3.eth.contract(
+        address=to_checksum_address(multicall_address), abi=get_abi("Multicall3")
+    )
+    results = []
+    for i in range(0, len(calls), chunk_size):
+        chunk = calls[i : i + chunk_size]
+        returned = multicall3.functions.aggregate3(
+            [(call.address, True, call._encode_transaction_data()) for call in chunk]
+        ).call(block_identifier=block_identifier)
+        for call, (success, data) in zip(chunk, returned):
+            # a call to an address without code succeeds with no data
+            if success and data:
+                results.append(decode_call_output(w3, call, data))
+            elif allow_failure:
+                results.append(None)
+            else:
+                raise MulticallFailedError(
+                    f"{call.fn_name} on {call.address} failed at block {block_identifier}"
+                )
+    return results
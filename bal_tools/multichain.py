@@ -0,0 +1,145 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Callable, Dict, List, Union
+
+from .pools_gauges import (
+    BalPoolsGauges,
+    fetch_cached_core_pools,
+    get_vebal_voting_list,
+)
+from .models import ChainResults
+from .utils import chain_names_prod
+
+
+DEFAULT_MAX_WORKERS = 8
+
+
+class MultiChainPoolsGauges:
+    """
+    runs `BalPoolsGauges` calls on many chains concurrently
+
+    the chain agnostic datasets (veBAL voting list and core pools) are fetched once
+    and shared by all chains; a chain failing is reported in `ChainResults.errors`
+    without aborting the other chains
+
+    usage:
+        multichain = MultiChainPoolsGauges(["mainnet", "arbitrum", "base"])
+        gauges = multichain.map("query_all_gauges")
+        pools = asyncio.run(multichain.amap("query_all_pools_async"))
+    """
+
+    def __init__(
+        self,
+        chains: List[str] = None,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        use_cached_core_pools: bool = True,
+    ):
+        self.chains = [chain.lower() for chain in (chains or chain_names_prod())]
+        self.max_workers = max_workers
+        self.use_cached_core_pools = use_cached_core_pools
+        self._instances: Dict[str, BalPoolsGauges] = {}
+        self._shared = None
+        self._lock = Lock()
+
+    def _shared_kwargs(self) -> dict:
+        with self._lock:
+            if self._shared is None:
+                vebal_voting_list = get_vebal_voting_list()
+                if self.use_cached_core_pools:
+                    core_pools_data = fetch_cached_core_pools()
+                else:
+                    core_pools_data = BalPoolsGauges(
+                        self.chains[0],
+                        vebal_voting_list=vebal_voting_list,
+                        core_pools_data={},
+                    ).build_core_pools(return_all_chains=True)
+                self._shared = {
+                    "vebal_voting_list": vebal_voting_list,
+                    "core_pools_data": core_pools_data,
+                }
+            return self._shared
+
+    def get(self, chain: str) -> BalPoolsGauges:
+        """
+        the `BalPoolsGauges` of `chain`, built on first use with the shared datasets
+        """
+        chain = chain.lower()
+        if chain not in self._instances:
+            instance = BalPoolsGauges(chain, **self._shared_kwargs())
+            self._instances.setdefault(chain, instance)
+        return self._instances[chain]
+
+    def map(
+        self, method: Union[str, Callable[[BalPoolsGauges], Any]], *args, **kwargs
+    ) -> ChainResults:
+        """
+        call `method` on every chain on a thread pool
+
+        params:
+        - method: name of a `BalPoolsGauges` method, or a callable taking the
+          per-chain instance
+        - args, kwargs: passed on to the method
+
+        returns:
+        - ChainResults with the result or exception of every chain
+        """
+
+        def call(chain: str):
+            instance = self.get(chain)
+            if isinstance(method, str):
+                return getattr(instance, method)(*args, **kwargs)
+            return method(instance, *args, **kwargs)
+
+        chain_results = ChainResults()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {chain: executor.submit(call, chain) for chain in self.chains}
+        for chain, future in futures.items():
+            try:
+                chain_results.results[chain] = future.result()
+            except Exception as e:
+                chain_results.errors[chain] = e
+        return chain_results
+
+    async def amap(self, method: str, *args, **kwargs) -> ChainResults:
+        """
+        asyncio counterpart of `map` for the `*_async` methods; at most `max_workers`
+        chains are in flight at once
+
+        the sessions opened for the call are closed before returning, so every
+        `asyncio.run` can call `amap` again
+        """
+        semaphore = asyncio.Semaphore(self.max_workers)
+
+        async def call(chain: str):
+            async with semaphore:
+                # instances may hit the network when first built
+                instance = await asyncio.to_thread(self.get, chain)
+                return await getattr(instance, method)(*args, **kwargs)
+
+        try:
+            outcomes = await asyncio.gather(
+                *[call(chain) for chain in self.chains], return_exceptions=True
+            )
+        finally:
+            await self.aclose()
+        chain_results = ChainResults()
+        for chain, outcome in zip(self.chains, outcomes):
+            if isinstance(outcome, Exception):
+                chain_results.errors[chain] = outcome
+            else:
+                chain_results.results[chain] = outcome
+        return chain_results
+
+    async def aclose(self):
+        for instance in self._instances.values():
+            await instance.aclose()
+
+    def query_all_gauges(self, include_other_gauges=True) -> ChainResults:
+        return self.map("query_all_gauges", include_other_gauges)
+
+    def query_all_pools(self) -> ChainResults:
+        return self.map("query_all_pools")
+
+    def core_pools(self) -> ChainResults:
+        return self.map(lambda instance: instance.core_pools)
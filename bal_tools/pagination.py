@@ -0,0 +1,96 @@
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Union,
+)
+
+
+DEFAULT_PAGE_SIZE = 1000  # max `first` accepted by the graph
+
+FetchPage = Callable[[str, int], List[dict]]
+AsyncFetchPage = Callable[[str, int], Awaitable[List[dict]]]
+
+
+def get_path(data: Any, path: Union[str, Sequence[str]]) -> List[dict]:
+    """
+    walk `path` down a query result to the paginated list; missing (or null)
+    entities yield an empty list
+    """
+    if path is None:
+        path = []
+    elif isinstance(path, str):
+        path = [path]
+    for key in path:
+        if not data:
+            return []
+        data = data.get(key)
+    return data or []
+
+
+def _next_first(page_size: int, remaining: Optional[int]) -> int:
+    return page_size if remaining is None else min(page_size, remaining)
+
+
+def paginate(
+    fetch_page: FetchPage,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    limit: Optional[int] = None,
+    cursor: str = "",
+    cursor_field: str = "id",
+) -> Iterator[List[dict]]:
+    """
+    cursor based pagination over a subgraph collection ordered by `cursor_field`
+    ascending; unlike `skip` every page costs the same and there is no upper bound
+
+    params:
+    - fetch_page: callable(cursor, first) returning the entities after `cursor`
+    - page_size: number of entities requested per page
+    - limit: max total number of entities to yield; None for all
+    - cursor: start after this value
+    - cursor_field: entity field the collection is ordered by
+
+    returns:
+    - generator of pages (lists of entities)
+    """
+    remaining = limit
+    while remaining is None or remaining > 0:
+        first = _next_first(page_size, remaining)
+        page = fetch_page(cursor, first)
+        if not page:
+            return
+        if remaining is not None:
+            remaining -= len(page)
+        yield page
+        if len(page) < first:
+            return
+        cursor = page[-1][cursor_field]
+
+
+async def apaginate(
+    fetch_page: AsyncFetchPage,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    limit: Optional[int] = None,
+    cursor: str = "",
+    cursor_field: str = "id",
+) -> AsyncIterator[List[dict]]:
+    """
+    async counterpart of `paginate`
+    """
+    remaining = limit
+    while remaining is None or remaining > 0:
+        first = _next_first(page_size, remaining)
+        page = await fetch_page(cursor, first)
+        if not page:
+            return
+        if remaining is not None:
+            remaining -= len(page)
+        yield page
+        if len(page) < first:
+            return
+        cursor = page[-1][cursor_field]
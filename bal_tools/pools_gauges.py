@@ -1,17 +1,25 @@
-from typing import Dict, List, Union
+from typing import Dict, Iterable, Iterator, List, Union
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+from threading import Lock
+import time
 import json
 import requests
 from .utils import to_checksum_address, flatten_nested_dict
 
 from gql.transport.exceptions import TransportQueryError
 from bal_tools.safe_tx_builder import ZERO_ADDRESS
-from bal_tools.subgraph import Subgraph
+from bal_tools.subgraph import Subgraph, DEFAULT_ALIAS_CHUNK_SIZE
+from bal_tools.async_subgraph import AsyncSubgraph
+from bal_tools.pagination import DEFAULT_PAGE_SIZE
 from bal_tools.errors import NoResultError
+from bal_tools.cache import read_json_cache, write_json_cache
 from bal_tools.models import (
     PoolData,
     GaugePoolData,
     GaugeData,
     CorePools,
+    CorePoolsDiff,
     PoolId,
     Symbol,
 )
@@ -23,21 +31,361 @@ GITHUB_RAW_CONFIG = (
     "https://raw.githubusercontent.com/BalancerMaxis/bal_addresses/main/config"
 )
 
+# per-key selections packed into aliased documents by the `*_for_*` batch methods
+POOL_SHARES_FIELD = """
+pool(id: $key, block: { number: $block }) {
+  shares(
+    first: $first
+    where: { balance_gt: "0", id_gt: $id_gt }
+    orderBy: id
+    orderDirection: asc
+  ) {
+    id
+    userAddress {
+      id
+    }
+    balance
+  }
+}
+"""
+GAUGE_SHARES_FIELD = """
+gaugeShares(
+  block: { number: $block }
+  where: { gauge_contains_nocase: $key, balance_gt: "0", id_gt: $id_gt }
+  orderBy: id
+  orderDirection: asc
+  first: $first
+) {
+  balance
+  id
+  user {
+    id
+  }
+}
+"""
+
+TVL_CHUNK_SIZE = 500  # pool ids per `poolGetPools(where: {idIn})` request
+
+
+def get_pools_tvl_by_chain(
+    pool_ids_by_chain: Dict[str, Iterable[str]],
+    chunk_size: int = TVL_CHUNK_SIZE,
+    max_workers: int = None,
+) -> Dict[str, Dict[str, float]]:
+    """
+    resolve the TVL of many pools, on many chains, as per the API V3 subgraph
+
+    pool ids are sent in chunks of `chunk_size` per chain; all chunks are fetched
+    concurrently, so a single chain with less than `chunk_size` pools is one request
+
+    params:
+    - pool_ids_by_chain: dict of chain -> pool ids
+    - chunk_size: max pool ids per request
+    - max_workers: number of concurrent requests; 1 fetches sequentially
+
+    returns:
+    - dict of chain -> {pool_id: tvl}; pools unknown to the api have a tvl of 0
+    """
+    subgraph = Subgraph()
+    jobs = []
+    results = {}
+    for chain, pool_ids in pool_ids_by_chain.items():
+        pool_ids = list(dict.fromkeys(pool_ids))
+        results[chain] = {pool_id: 0 for pool_id in pool_ids}
+        for i in range(0, len(pool_ids), chunk_size):
+            jobs.append((chain, pool_ids[i : i + chunk_size]))
+
+    def fetch(chain: str, pool_ids: List[str]) -> List[dict]:
+        return subgraph.fetch_graphql_data(
+            "apiv3",
+            "get_pools_tvl",
+            {"chain": chain.upper(), "poolIds": pool_ids, "first": len(pool_ids)},
+        )["poolGetPools"]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pages = executor.map(lambda job: (job[0], fetch(*job)), jobs)
+        for chain, pools in pages:
+            for pool in pools:
+                results[chain][pool["id"]] = float(
+                    pool["dynamicData"]["totalLiquidity"]
+                )
+    return results
+
+
+VEBAL_VOTING_LIST_TTL = 10 * 60
+
+_vebal_voting_list = None  # (fetched_at, voting list, voting list by pool id)
+_vebal_voting_list_lock = Lock()
+
+
+def fetch_vebal_voting_list() -> List[dict]:
+    """
+    the veBAL voting list of the api v3; the same for every chain
+    """
+    return Subgraph().fetch_graphql_data("apiv3", "vebal_get_voting_list")[
+        "veBalGetVotingList"
+    ]
+
+
+def index_vebal_voting_list(vebal_voting_list: List[dict]) -> Dict[str, dict]:
+    """
+    voting list entries by pool id; when a pool is listed more than once the
+    entry with an alive gauge wins
+    """
+    by_id = {}
+    for pool in vebal_voting_list:
+        current = by_id.get(pool["id"])
+        if current is None or current["gauge"]["isKilled"]:
+            by_id[pool["id"]] = pool
+    return by_id
+
+
+def _get_vebal_voting_list(force: bool = False):
+    global _vebal_voting_list
+    cached = _vebal_voting_list
+    if not force and cached and time.time() - cached[0] < VEBAL_VOTING_LIST_TTL:
+        return cached
+    with _vebal_voting_list_lock:
+        cached = _vebal_voting_list
+        if force or not cached or time.time() - cached[0] >= VEBAL_VOTING_LIST_TTL:
+            voting_list = fetch_vebal_voting_list()
+            cached = (time.time(), voting_list, index_vebal_voting_list(voting_list))
+            _vebal_voting_list = cached
+        return cached
+
+
+def get_vebal_voting_list(force: bool = False) -> List[dict]:
+    """
+    the veBAL voting list, fetched at most once per `VEBAL_VOTING_LIST_TTL` for the
+    whole process
+
+    params:
+    - force: refetch even if the cached list is still fresh
+    """
+    return _get_vebal_voting_list(force)[1]
+
+
+def get_vebal_voting_list_by_id(force: bool = False) -> Dict[str, dict]:
+    """
+    the process wide veBAL voting list indexed by pool id; see `get_vebal_voting_list`
+    """
+    return _get_vebal_voting_list(force)[2]
+
+
+def fetch_cached_core_pools() -> Dict[str, Dict[str, str]]:
+    """
+    the core pools of every chain as published in bal_addresses
+    """
+    return requests.get(f"{GITHUB_RAW_OUTPUTS}/core_pools.json").json()
+
+
+CORE_POOLS_CHUNK_SIZE = 500  # candidates per `poolGetPools(where: {idIn})` request
+CORE_POOL_MIN_TVL = 100_000
+CORE_POOLS_CHAINS = [
+    "mainnet",
+    "polygon",
+    "arbitrum",
+    "gnosis",
+    "zkevm",
+    "avalanche",
+    "base",
+    "mode",
+    "fraxtal",
+    "hyperevm",
+    "optimism",
+    "plasma",
+]
+CORE_POOLS_STATE_FILE = "core_pools_state.json"
+
+# url -> (etag, json) of the whitelist/blacklist downloads
+_config_lists: Dict[str, tuple] = {}
+
+
+def fetch_core_pools_config(name: str) -> dict:
+    """
+    a core pools config list (eg `core_pools_whitelist.json`) from bal_addresses;
+    unchanged lists are revalidated with their etag instead of downloaded again
+    """
+    url = f"{GITHUB_RAW_CONFIG}/{name}"
+    etag, data = _config_lists.get(url, (None, None))
+    headers = {"If-None-Match": etag} if etag else {}
+    response = requests.get(url, headers=headers)
+    if response.status_code == 304 and data is not None:
+        return data
+    response.raise_for_status()
+    data = response.json()
+    if response.headers.get("ETag"):
+        _config_lists[url] = (response.headers["ETag"], data)
+    return data
+
+
+def is_core_pool_candidate(pool: dict) -> bool:
+    """
+    whether a `get_core_pools_filters` result passes the core pool filters; see
+    `BalPoolsGauges.filter_core_pool_candidates`
+    """
+    if pool["dynamicData"]["isInRecoveryMode"]:
+        # pools in recovery mode are not core pools
+        return False
+    if pool["poolCreator"] and pool["poolCreator"] != ZERO_ADDRESS:
+        # balancer dao is not explicitly set as fees manager
+        if pool["type"] not in [
+            "COMPOSABLE_STABLE",
+            "META_STABLE",
+            "STABLE",
+            "WEIGHTED",
+        ]:
+            # pool type is not native;
+            # protocol fee management by balancer dao cannot be guaranteed
+            return False
+    if "BOOSTED" in pool["tags"]:
+        # v3 boosted pools are always core pools
+        return True
+    for pool_token in pool["poolTokens"]:
+        if pool_token["isExemptFromProtocolYieldFee"] == True:
+            # pools that are yield fee exempt are not core pools
+            return False
+    for pool_token in pool["poolTokens"]:
+        if pool_token.get("priceRateProviderData"):
+            if pool_token["priceRateProviderData"].get("address") != ZERO_ADDRESS:
+                # pools with a non zero rate provider are core pools
+                return True
+    return False
+
+
+def core_pool_listing_key(pool: dict) -> str:
+    """
+    the fields of a `get_core_pools_listing` result the core pool filters depend on,
+    serialised so unchanged pools can be skipped; tvl only matters through the
+    `minTvl` filter of the query
+    """
+    return json.dumps(
+        [
+            pool["dynamicData"]["isInRecoveryMode"],
+            pool["poolCreator"],
+            pool["type"],
+            sorted(pool["tags"] or []),
+            pool["poolTokens"],
+        ],
+        sort_keys=True,
+    )
+
+
+def summarise_core_pools(
+    core_pools_extended: List[dict], chains: List[str] = CORE_POOLS_CHAINS
+) -> Dict[str, Dict[str, str]]:
+    """
+    turn filtered core pool candidates into {chain: {pool_id: symbol}}, sorted by
+    pool id, with the whitelist and blacklist of bal_addresses applied to `chains`
+    """
+    core_pools = {chain: {} for chain in CORE_POOLS_CHAINS}
+
+    # summarise extended core pools dict into core_pools dict
+    for pool in core_pools_extended:
+        if not pool["chain"].lower() in core_pools:
+            continue
+        core_pools[pool["chain"].lower()][pool["id"]] = pool["symbol"]
+
+    # get whitelist and blacklist
+    whitelist = fetch_core_pools_config("core_pools_whitelist.json")
+    blacklist = fetch_core_pools_config("core_pools_blacklist.json")
+
+    for chain in chains:
+        # sort pools alphabetically by id
+        core_pools[chain] = dict(sorted(core_pools.get(chain, {}).items()))
+
+        # add pools from whitelist
+        try:
+            for pool, symbol in whitelist[chain].items():
+                if pool not in core_pools[chain]:
+                    core_pools[chain][pool] = symbol
+        except KeyError:
+            # no results for this chain
+            pass
+
+        # remove pools from blacklist
+        try:
+            for pool in blacklist[chain]:
+                if pool in core_pools[chain]:
+                    del core_pools[chain][pool]
+        except KeyError:
+            # no results for this chain
+            pass
+
+    return core_pools
+
 
 class BalPoolsGauges:
-    def __init__(self, chain="mainnet", use_cached_core_pools=True):
+    def __init__(
+        self,
+        chain="mainnet",
+        use_cached_core_pools=True,
+        vebal_voting_list: List[dict] = None,
+        core_pools_data: Dict[str, Dict[str, str]] = None,
+        lazy: bool = False,
+    ):
+        """
+        params:
+        - chain: chain to query
+        - use_cached_core_pools: read the core pools from bal_addresses instead of
+          building them
+        - vebal_voting_list: already fetched veBAL voting list, shared between chains
+        - core_pools_data: already fetched core pools of all chains, shared between
+          chains
+        - lazy: fetch the voting list and core pools on first access instead of here
+        """
         self.chain = chain.lower()
         self.subgraph = Subgraph(self.chain)
-        self.vebal_voting_list = self.subgraph.fetch_graphql_data(
-            "apiv3", "vebal_get_voting_list"
-        )["veBalGetVotingList"]
-        if use_cached_core_pools:
-            core_pools_data = requests.get(
-                f"{GITHUB_RAW_OUTPUTS}/core_pools.json"
-            ).json()
-            self.core_pools = CorePools(pools=core_pools_data.get(self.chain, {}))
-        else:
-            self.core_pools = self.build_core_pools()
+        self._async_subgraph = None
+        self.use_cached_core_pools = use_cached_core_pools
+        self.lazy = lazy
+        self._vebal_voting_list = vebal_voting_list
+        self._core_pools_data = core_pools_data
+        self._force_refresh = False
+        if not lazy:
+            self._fetch_datasets()
+
+    _DATASETS = ("vebal_voting_list", "vebal_voting_list_by_id", "core_pools")
+
+    def _fetch_datasets(self):
+        for name in self._DATASETS:
+            getattr(self, name)
+
+    def refresh(self):
+        """
+        refetch the voting list and core pools, including datasets passed to the
+        constructor; lazy instances refetch on the next access
+        """
+        for name in self._DATASETS:
+            self.__dict__.pop(name, None)
+        self._vebal_voting_list = None
+        self._core_pools_data = None
+        self._force_refresh = True
+        if not self.lazy:
+            self._fetch_datasets()
+
+    @cached_property
+    def vebal_voting_list(self) -> List[dict]:
+        if self._vebal_voting_list is not None:
+            return self._vebal_voting_list
+        _, voting_list, by_id = _get_vebal_voting_list(force=self._force_refresh)
+        self._force_refresh = False
+        self.__dict__.setdefault("vebal_voting_list_by_id", by_id)
+        return voting_list
+
+    @cached_property
+    def vebal_voting_list_by_id(self) -> Dict[str, dict]:
+        return index_vebal_voting_list(self.vebal_voting_list)
+
+    @cached_property
+    def core_pools(self) -> CorePools:
+        core_pools_data = self._core_pools_data
+        if core_pools_data is None:
+            if self.use_cached_core_pools:
+                core_pools_data = fetch_cached_core_pools()
+            else:
+                core_pools_data = self.build_core_pools(return_all_chains=True)
+        return CorePools(pools=core_pools_data.get(self.chain, {}))
 
     def is_pool_exempt_from_yield_fee(self, pool_id: str) -> bool:
         data = self.subgraph.fetch_graphql_data(
@@ -51,37 +399,175 @@ class BalPoolsGauges:
                 return True
 
     def is_pool_on_vebal_list(self, pool_id: str) -> bool:
-        for pool in self.vebal_voting_list:
-            if pool["id"] == pool_id:
-                if not pool["gauge"]["isKilled"]:
-                    return True
-        return False
+        pool = self.vebal_voting_list_by_id.get(pool_id)
+        return pool is not None and not pool["gauge"]["isKilled"]
+
+    @property
+    def async_subgraph(self) -> AsyncSubgraph:
+        """
+        asyncio client used by the `*_async` query methods; created on first use
+        """
+        if self._async_subgraph is None:
+            self._async_subgraph = AsyncSubgraph(self.chain)
+        return self._async_subgraph
+
+    async def aclose(self):
+        if self._async_subgraph is not None:
+            await self._async_subgraph.aclose()
+            self._async_subgraph = None
 
     def get_bpt_balances(self, pool_id: str, block: int) -> Dict[str, int]:
-        variables = {"poolId": pool_id, "block": int(block)}
-        data = self.subgraph.fetch_graphql_data(
-            "core", "get_user_pool_balances", variables
+        results = {}
+        for page in self.iter_bpt_balances(pool_id, block):
+            results.update(page)
+        return results
+
+    def iter_bpt_balances(
+        self, pool_id: str, block: int, page_size: int = DEFAULT_PAGE_SIZE
+    ) -> Iterator[Dict[str, float]]:
+        """
+        stream the bpt holders of a pool at `block`, one page of {user: balance} at a time
+        """
+        pages = self.subgraph.paginate_graphql_data(
+            "core",
+            "get_user_pool_balances",
+            {"poolId": pool_id, "block": int(block)},
+            ("pool", "shares"),
+            page_size=page_size,
         )
+        for page in pages:
+            yield self._parse_bpt_balances(page)
+
+    def get_bpt_balances_for_pools(
+        self,
+        pool_ids: List[str],
+        block: int,
+        chunk_size: int = DEFAULT_ALIAS_CHUNK_SIZE,
+    ) -> Dict[str, Dict[str, float]]:
+        """
+        get the bpt holders of many pools at `block` with a handful of aliased queries
+
+        params:
+        - pool_ids: the pools to snapshot
+        - block: the block to query on
+        - chunk_size: max pools packed into one query
+
+        returns:
+        - dict of pool_id -> {user_address: balance}
+        """
+        results = {pool_id: {} for pool_id in pool_ids}
+        pages = self.subgraph.paginate_aliased_graphql_data(
+            "core",
+            "GetUsersPoolBalances",
+            POOL_SHARES_FIELD,
+            list(results),
+            "ID!",
+            "shares",
+            {"block": ("Int", int(block))},
+            chunk_size=chunk_size,
+        )
+        for pool_id, page in pages:
+            results[pool_id].update(self._parse_bpt_balances(page))
+        return results
+
+    async def get_bpt_balances_async(self, pool_id: str, block: int) -> Dict[str, int]:
+        results = {}
+        pages = self.async_subgraph.paginate_graphql_data(
+            "core",
+            "get_user_pool_balances",
+            {"poolId": pool_id, "block": int(block)},
+            ("pool", "shares"),
+        )
+        async for page in pages:
+            results.update(self._parse_bpt_balances(page))
+        return results
+
+    @staticmethod
+    def _parse_bpt_balances(shares: List[dict]) -> Dict[str, float]:
         results = {}
-        if "pool" in data and data["pool"]:
-            for share in data["pool"]["shares"]:
-                user_address = to_checksum_address(share["userAddress"]["id"])
-                results[user_address] = float(share["balance"])
+        for share in shares:
+            user_address = to_checksum_address(share["userAddress"]["id"])
+            results[user_address] = float(share["balance"])
         return results
 
     def get_gauge_deposit_shares(
         self, gauge_address: str, block: int
     ) -> Dict[str, int]:
+        results = {}
+        for page in self.iter_gauge_deposit_shares(gauge_address, block):
+            results.update(page)
+        return results
+
+    def iter_gauge_deposit_shares(
+        self, gauge_address: str, block: int, page_size: int = DEFAULT_PAGE_SIZE
+    ) -> Iterator[Dict[str, float]]:
+        """
+        stream the depositors of a gauge at `block`, one page of {user: balance} at a time
+        """
         gauge_address = to_checksum_address(gauge_address)
-        variables = {"gaugeAddress": gauge_address, "block": int(block)}
-        data = self.subgraph.fetch_graphql_data(
-            "gauges", "fetch_gauge_shares", variables
+        pages = self.subgraph.paginate_graphql_data(
+            "gauges",
+            "fetch_gauge_shares",
+            {"gaugeAddress": gauge_address, "block": int(block)},
+            "gaugeShares",
+            page_size=page_size,
+        )
+        for page in pages:
+            yield self._parse_gauge_shares(page)
+
+    def get_gauge_deposit_shares_for_gauges(
+        self,
+        gauge_addresses: List[str],
+        block: int,
+        chunk_size: int = DEFAULT_ALIAS_CHUNK_SIZE,
+    ) -> Dict[str, Dict[str, float]]:
+        """
+        get the depositors of many gauges at `block` with a handful of aliased queries,
+        eg to snapshot every gauge on a chain at an epoch boundary
+
+        params:
+        - gauge_addresses: the gauges to snapshot
+        - block: the block to query on
+        - chunk_size: max gauges packed into one query
+
+        returns:
+        - dict of gauge_address -> {user_address: balance}
+        """
+        results = {to_checksum_address(gauge): {} for gauge in gauge_addresses}
+        pages = self.subgraph.paginate_aliased_graphql_data(
+            "gauges",
+            "FetchGaugesShares",
+            GAUGE_SHARES_FIELD,
+            list(results),
+            "String!",
+            params={"block": ("Int", int(block))},
+            chunk_size=chunk_size,
+        )
+        for gauge_address, page in pages:
+            results[gauge_address].update(self._parse_gauge_shares(page))
+        return results
+
+    async def get_gauge_deposit_shares_async(
+        self, gauge_address: str, block: int
+    ) -> Dict[str, int]:
+        gauge_address = to_checksum_address(gauge_address)
+        results = {}
+        pages = self.async_subgraph.paginate_graphql_data(
+            "gauges",
+            "fetch_gauge_shares",
+            {"gaugeAddress": gauge_address, "block": int(block)},
+            "gaugeShares",
         )
+        async for page in pages:
+            results.update(self._parse_gauge_shares(page))
+        return results
+
+    @staticmethod
+    def _parse_gauge_shares(shares: List[dict]) -> Dict[str, float]:
         results = {}
-        if "gaugeShares" in data:
-            for share in data["gaugeShares"]:
-                user_address = to_checksum_address(share["user"]["id"])
-                results[user_address] = float(share["balance"])
+        for share in shares:
+            user_address = to_checksum_address(share["user"]["id"])
+            results[user_address] = float(share["balance"])
         return results
 
     def get_preferential_gauge(self, pool_id: str) -> bool:
@@ -110,30 +596,37 @@ class BalPoolsGauges:
 
     def query_preferential_gauges(self, skip=0, step_size=100) -> list:
         """
-        TODO: add docstring
+        query all preferential gauges from the gauges subgraph
+
+        params:
+        - skip: number of gauges (ordered by address) to leave out of the result
+        - step_size: page size
+
+        returns:
+        - list of {"id", "symbol"} dicts
         """
-        variables = {"skip": skip, "step_size": step_size}
-        data = self.subgraph.fetch_graphql_data("gauges", "pref_gauges", variables)
-        try:
-            result = data["liquidityGauges"]
-        except KeyError:
-            result = []
-        if len(result) > 0:
-            # didnt reach end of results yet, collect next page
-            result += self.query_preferential_gauges(skip + step_size, step_size)
-        return result
+        gauges = [
+            gauge for page in self.iter_preferential_gauges(step_size) for gauge in page
+        ]
+        return gauges[skip:]
+
+    def iter_preferential_gauges(
+        self, page_size: int = DEFAULT_PAGE_SIZE
+    ) -> Iterator[List[dict]]:
+        return self.subgraph.paginate_graphql_data(
+            "gauges", "pref_gauges", path="liquidityGauges", page_size=page_size
+        )
 
     def query_root_gauges(self, skip=0, step_size=100) -> list:
-        variables = {"skip": skip, "step_size": step_size}
-        data = self.subgraph.fetch_graphql_data("gauges", "root_gauges", variables)
-        try:
-            result = data["rootGauges"]
-        except KeyError:
-            result = []
-        if len(result) > 0:
-            # didnt reach end of results yet, collect next page
-            result += self.query_root_gauges(skip + step_size, step_size)
-        return result
+        gauges = [gauge for page in self.iter_root_gauges(step_size) for gauge in page]
+        return gauges[skip:]
+
+    def iter_root_gauges(
+        self, page_size: int = DEFAULT_PAGE_SIZE
+    ) -> Iterator[List[dict]]:
+        return self.subgraph.paginate_graphql_data(
+            "gauges", "root_gauges", path="rootGauges", page_size=page_size
+        )
 
     def query_all_gauges(self, include_other_gauges=True) -> List[GaugeData]:
         """
@@ -142,6 +635,18 @@ class BalPoolsGauges:
         data = self.subgraph.fetch_graphql_data(
             "apiv3", "get_gauges", {"chain": self.chain.upper()}
         )
+        return self._parse_all_gauges(data, include_other_gauges)
+
+    async def query_all_gauges_async(
+        self, include_other_gauges=True
+    ) -> List[GaugeData]:
+        data = await self.async_subgraph.fetch_graphql_data(
+            "apiv3", "get_gauges", {"chain": self.chain.upper()}
+        )
+        return self._parse_all_gauges(data, include_other_gauges)
+
+    @staticmethod
+    def _parse_all_gauges(data: dict, include_other_gauges: bool) -> List[GaugeData]:
         all_gauges = []
         for pool in data["poolGetPools"]:
             gauge_pool = GaugePoolData(**flatten_nested_dict(pool))
@@ -174,6 +679,16 @@ class BalPoolsGauges:
         data = self.subgraph.fetch_graphql_data(
             "apiv3", "get_pools", {"chain": self.chain.upper()}
         )
+        return self._parse_all_pools(data)
+
+    async def query_all_pools_async(self) -> List[PoolData]:
+        data = await self.async_subgraph.fetch_graphql_data(
+            "apiv3", "get_pools", {"chain": self.chain.upper()}
+        )
+        return self._parse_all_pools(data)
+
+    @staticmethod
+    def _parse_all_pools(data: dict) -> List[PoolData]:
         all_pools = []
         for pool in data["poolGetPools"]:
             pool_data = PoolData(**flatten_nested_dict(pool))
@@ -208,6 +723,29 @@ class BalPoolsGauges:
             )
         except TransportQueryError:
             return 0
+        return self._parse_pool_tvl(data, pool_id)
+
+    def get_pools_tvl(
+        self, pool_ids: Iterable[str], chunk_size: int = TVL_CHUNK_SIZE
+    ) -> Dict[str, float]:
+        """
+        Returns the TVL of many pools as per the API V3 subgraph, in one request per
+        `chunk_size` pools; see `get_pools_tvl_by_chain`
+        """
+        return get_pools_tvl_by_chain({self.chain: pool_ids}, chunk_size)[self.chain]
+
+    async def get_pool_tvl_async(self, pool_id: str) -> float:
+        try:
+            data = await self.async_subgraph.fetch_graphql_data(
+                "apiv3",
+                "get_pool_tvl",
+                {"chain": self.chain.upper(), "poolId": pool_id},
+            )
+        except TransportQueryError:
+            return 0
+        return self._parse_pool_tvl(data, pool_id)
+
+    def _parse_pool_tvl(self, data: dict, pool_id: str) -> float:
         try:
             return float(data["poolGetPool"]["dynamicData"]["totalLiquidity"])
         except:
@@ -236,12 +774,14 @@ class BalPoolsGauges:
             "core", "liquid_pools_protocol_yield_fee"
         )
         try:
-            for pool in data["pools"]:
-                if self.get_pool_tvl(pool["id"]) >= 100_000:
-                    filtered_pools[pool["id"]] = pool["symbol"]
+            pools = data["pools"]
         except KeyError:
             # no results for this chain
-            pass
+            return filtered_pools
+        tvls = self.get_pools_tvl([pool["id"] for pool in pools])
+        for pool in pools:
+            if tvls[pool["id"]] >= 100_000:
+                filtered_pools[pool["id"]] = pool["symbol"]
         return filtered_pools
 
     def has_alive_preferential_gauge(self, pool_id: str) -> bool:
@@ -292,58 +832,8 @@ class BalPoolsGauges:
         if debug:
             return core_pools_extended
 
-        core_pools = {
-            "mainnet": {},
-            "polygon": {},
-            "arbitrum": {},
-            "gnosis": {},
-            "zkevm": {},
-            "avalanche": {},
-            "base": {},
-            "mode": {},
-            "fraxtal": {},
-            "hyperevm": {},
-            "optimism": {},
-            "plasma": {},
-        }
-
-        # summarise extended core pools dict into core_pools dict
-        for pool in core_pools_extended:
-            if not pool["chain"].lower() in core_pools:
-                continue
-            core_pools[pool["chain"].lower()][pool["id"]] = pool["symbol"]
-
-        # get whitelist and blacklist
-        whitelist = requests.get(f"{GITHUB_RAW_CONFIG}/core_pools_whitelist.json")
-        whitelist.raise_for_status()
-        whitelist = whitelist.json()
-
-        blacklist = requests.get(f"{GITHUB_RAW_CONFIG}/core_pools_blacklist.json")
-        blacklist.raise_for_status()
-        blacklist = blacklist.json()
-
-        chains = core_pools.keys() if return_all_chains else [self.chain]
-        for chain in chains:
-            # sort pools alphabetically by id
-            core_pools[chain] = dict(sorted(core_pools[chain].items()))
-
-            # add pools from whitelist
-            try:
-                for pool, symbol in whitelist[chain].items():
-                    if pool not in core_pools[chain]:
-                        core_pools[chain][pool] = symbol
-            except KeyError:
-                # no results for this chain
-                pass
-
-            # remove pools from blacklist
-            try:
-                for pool in blacklist[chain]:
-                    if pool in core_pools[chain]:
-                        del core_pools[chain][pool]
-            except KeyError:
-                # no results for this chain
-                pass
+        chains = CORE_POOLS_CHAINS if return_all_chains else [self.chain]
+        core_pools = summarise_core_pools(core_pools_extended, chains)
 
         if return_all_chains:
             return core_pools
@@ -352,6 +842,35 @@ class BalPoolsGauges:
                 pools={PoolId(k): Symbol(v) for k, v in core_pools[self.chain].items()}
             )
 
+    def fetch_core_pool_candidates(
+        self,
+        candidates: List[str],
+        chunk_size: int = CORE_POOLS_CHUNK_SIZE,
+        query: str = "get_core_pools_filters",
+    ) -> List[dict]:
+        """
+        the core pool filter inputs of the `candidates` with a tvl of >$100k, in one
+        `idIn` request per `chunk_size` candidates
+
+        params:
+        - query: `get_core_pools_listing` returns the filter inputs only, without
+          the tvl and fee figures
+        """
+        pools = []
+        for i in range(0, len(candidates), chunk_size):
+            data = self.subgraph.fetch_graphql_data(
+                "apiv3",
+                query,
+                {
+                    "where": {
+                        "minTvl": CORE_POOL_MIN_TVL,
+                        "idIn": candidates[i : i + chunk_size],
+                    }
+                },
+            )
+            pools += data["poolGetPools"]
+        return pools
+
     def filter_core_pool_candidates(self, candidates: List[str]) -> List[str]:
         """
         filter a list of core pool candidates based on:
@@ -362,43 +881,94 @@ class BalPoolsGauges:
         - not being in recovery mode
         ref: https://forum.balancer.fi/t/bip-734-balancer-v3-launch-and-protocol-enhancements/6168#p-14954-revised-core-pool-framework-6
         """
-        data = self.subgraph.fetch_graphql_data(
-            "apiv3",
-            "get_core_pools_filters",
-            {"where": {"minTvl": 100_000, "idIn": candidates}},
-        )
-        core_pools = []
-        for pool in data["poolGetPools"]:
-            if pool["dynamicData"]["isInRecoveryMode"]:
-                # pools in recovery mode are not core pools
-                continue
-            if pool["poolCreator"] and pool["poolCreator"] != ZERO_ADDRESS:
-                # balancer dao is not explicitly set as fees manager
-                if pool["type"] not in [
-                    "COMPOSABLE_STABLE",
-                    "META_STABLE",
-                    "STABLE",
-                    "WEIGHTED",
-                ]:
-                    # pool type is not native;
-                    # protocol fee management by balancer dao cannot be guaranteed
-                    continue
-            if "BOOSTED" in pool["tags"]:
-                # v3 boosted pools are always core pools
-                core_pools.append(pool)
+        return [
+            pool
+            for pool in self.fetch_core_pool_candidates(candidates)
+            if is_core_pool_candidate(pool)
+        ]
+
+
+class CorePoolsBuilder:
+    """
+    incremental `BalPoolsGauges.build_core_pools` for all chains
+
+    every build lists the candidates with the `get_core_pools_listing` query, which
+    holds the filter inputs without the tvl and fee figures; only the candidates
+    that are new, crossed the tvl threshold or had a filter input change (recovery
+    mode, creator, tags, rate providers, yield fee exemption) are re-evaluated. the
+    outcome of every candidate is kept between builds (in memory, and on disk when
+    `state_file` is set), and every build returns what changed
+
+    usage:
+        builder = CorePoolsBuilder(BalPoolsGauges(lazy=True), CORE_POOLS_STATE_FILE)
+        diff = builder.update()
+        builder.core_pools  # {chain: {pool_id: symbol}}
+    """
+
+    def __init__(self, pools_gauges: BalPoolsGauges, state_file: str = None):
+        """
+        params:
+        - pools_gauges: used to query the candidates; its chain does not matter
+        - state_file: name of the json state file in the bal_tools cache dir
+        """
+        self.pools_gauges = pools_gauges
+        self.state_file = state_file
+        state = read_json_cache(state_file, ttl=None) if state_file else None
+        state = state or {}
+        # pool id -> [filter inputs, listed pool if it passed the filters]
+        self.candidates: Dict[str, list] = state.get("candidates", {})
+        self.core_pools: Dict[str, Dict[str, str]] = state.get("core_pools", {})
+
+    def update(self, full: bool = False) -> CorePoolsDiff:
+        """
+        rebuild the core pools, re-evaluating only the candidates whose filter inputs
+        changed
+
+        params:
+        - full: re-evaluate every candidate
+
+        returns:
+        - CorePoolsDiff of the pools added and removed per chain
+        """
+        candidate_ids = [
+            pool["id"]
+            for pool in get_vebal_voting_list()
+            if not pool["gauge"]["isKilled"]
+        ]
+        # candidates below the tvl threshold are not listed
+        listed = {
+            pool["id"]: pool
+            for pool in self.pools_gauges.fetch_core_pool_candidates(
+                candidate_ids, query="get_core_pools_listing"
+            )
+        }
+        candidates = {}
+        for pool_id in candidate_ids:
+            pool = listed.get(pool_id)
+            key = core_pool_listing_key(pool) if pool else None
+            previous = self.candidates.get(pool_id)
+            if not full and previous is not None and previous[0] == key:
+                if previous[1] is not None:
+                    # display fields are refreshed from the listing
+                    previous = [key, {**previous[1], "symbol": pool["symbol"]}]
+                candidates[pool_id] = previous
                 continue
-            for pool_token in pool["poolTokens"]:
-                if pool_token["isExemptFromProtocolYieldFee"] == True:
-                    # pools that are yield fee exempt are not core pools
-                    break
-            else:
-                for pool_token in pool["poolTokens"]:
-                    if pool_token.get("priceRateProviderData"):
-                        if (
-                            pool_token["priceRateProviderData"].get("address")
-                            != ZERO_ADDRESS
-                        ):
-                            # pools with a non zero rate provider are core pools
-                            core_pools.append(pool)
-                            break
-        return core_pools
+            passed = pool is not None and is_core_pool_candidate(pool)
+            candidates[pool_id] = [key, pool if passed else None]
+
+        core_pools = summarise_core_pools(
+            [pool for _, pool in candidates.values() if pool is not None]
+        )
+        diff = CorePoolsDiff()
+        for chain in CORE_POOLS_CHAINS:
+            old, new = self.core_pools.get(chain, {}), core_pools[chain]
+            diff.added[chain] = {k: v for k, v in new.items() if k not in old}
+            diff.removed[chain] = {k: v for k, v in old.items() if k not in new}
+
+        self.candidates, self.core_pools = candidates, core_pools
+        if self.state_file:
+            write_json_cache(
+                self.state_file,
+                {"candidates": candidates, "core_pools": core_pools},
+            )
+        return diff
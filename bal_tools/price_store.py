@@ -0,0 +1,234 @@
+import sqlite3
+import time
+from pathlib import Path
+from threading import RLock
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from .twap import PriceHistory
+
+
+DAY = 24 * 60 * 60
+# ranges accepted by `tokenGetHistoricalPrices`, smallest first
+PRICE_RANGES = (
+    ("SEVEN_DAY", 7 * DAY),
+    ("THIRTY_DAY", 30 * DAY),
+    ("ONE_YEAR", 365 * DAY),
+)
+PRICE_REFRESH_INTERVAL = 60 * 60  # max age of the latest points before a refresh
+PRICE_CHUNK_SIZE = 100  # addresses per request
+
+# fetch(addresses, chain, range) -> `tokenGetHistoricalPrices` list
+FetchPrices = Callable[[List[str], str, str], List[dict]]
+
+
+def price_range_for(seconds: float) -> str:
+    """
+    smallest api range covering the past `seconds`
+    """
+    for name, length in PRICE_RANGES:
+        # a day of margin: the api buckets points per day
+        if seconds + DAY <= length:
+            return name
+    return PRICE_RANGES[-1][0]
+
+
+class PriceStore:
+    """
+    process wide store of historical token prices keyed by (chain, address)
+
+    histories are downloaded once, over the largest range, and then only topped up:
+    a refresh requests the smallest range covering the time since the last download
+    and appends the points newer than the last stored one, resampled to the daily
+    spacing of the history. with `path` set, histories also persist to sqlite and
+    survive restarts
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path] = None,
+        refresh_interval: int = PRICE_REFRESH_INTERVAL,
+        chunk_size: int = PRICE_CHUNK_SIZE,
+    ):
+        self.refresh_interval = refresh_interval
+        self.chunk_size = chunk_size
+        self._histories: Dict[Tuple[str, str], PriceHistory] = {}
+        # (covers_from, fetched_at) of every stored history
+        self._coverage: Dict[Tuple[str, str], Tuple[float, float]] = {}
+        self._lock = RLock()
+        self._conn = None
+        if path is not None:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            with self._conn:
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS prices (chain TEXT, address TEXT,"
+                    " timestamp INTEGER, price TEXT,"
+                    " PRIMARY KEY (chain, address, timestamp))"
+                )
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS coverage (chain TEXT, address TEXT,"
+                    " covers_from REAL, fetched_at REAL,"
+                    " PRIMARY KEY (chain, address))"
+                )
+
+    def clear(self):
+        with self._lock:
+            self._histories.clear()
+            self._coverage.clear()
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute("DELETE FROM prices")
+                    self._conn.execute("DELETE FROM coverage")
+
+    def _load(self, key: Tuple[str, str]):
+        # pull a history persisted by an earlier process into memory
+        if self._conn is None or key in self._coverage:
+            return
+        row = self._conn.execute(
+            "SELECT covers_from, fetched_at FROM coverage"
+            " WHERE chain = ? AND address = ?",
+            key,
+        ).fetchone()
+        if row is None:
+            return
+        points = self._conn.execute(
+            "SELECT timestamp, price FROM prices WHERE chain = ? AND address = ?"
+            " ORDER BY timestamp",
+            key,
+        ).fetchall()
+        self._histories[key] = PriceHistory(
+            [p[0] for p in points], [p[1] for p in points]
+        )
+        self._coverage[key] = tuple(row)
+
+    def _store(
+        self,
+        key: Tuple[str, str],
+        history: PriceHistory,
+        covers_from: float,
+        fetched_at: float,
+        new_from: int = 0,
+    ):
+        # `new_from`: points up to this timestamp are already persisted
+        self._histories[key] = history
+        self._coverage[key] = (covers_from, fetched_at)
+        if self._conn is None:
+            return
+        start = int(history.timestamps.searchsorted(new_from, "right"))
+        with self._conn:
+            if not new_from:
+                self._conn.execute(
+                    "DELETE FROM prices WHERE chain = ? AND address = ?", key
+                )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO prices VALUES (?, ?, ?, ?)",
+                [
+                    (*key, int(ts), str(price))
+                    for ts, price in zip(
+                        history.timestamps[start:], history.raw_prices[start:]
+                    )
+                ],
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO coverage VALUES (?, ?, ?, ?)",
+                (*key, covers_from, fetched_at),
+            )
+
+    def _plan(
+        self, key: Tuple[str, str], since: float, until: float, now: float
+    ) -> Optional[Tuple[str, bool]]:
+        # (range to request, whether it replaces the stored history) or None if fresh
+        coverage = self._coverage.get(key)
+        if coverage is None or coverage[0] > since:
+            # always the largest (daily) range: a shorter range is sampled denser and
+            # a window would average differently depending on what was fetched first
+            return PRICE_RANGES[-1][0], True
+        covers_from, fetched_at = coverage
+        if until > fetched_at and now - fetched_at > self.refresh_interval:
+            last_timestamp = self._histories[key].last_timestamp or fetched_at
+            return price_range_for(now - min(last_timestamp, fetched_at)), False
+        return None
+
+    def get_histories(
+        self,
+        chain: str,
+        addresses: Iterable[str],
+        fetch: FetchPrices,
+        since: float,
+        until: float = None,
+    ) -> Dict[str, PriceHistory]:
+        """
+        price histories of `addresses` covering at least `since` .. `until`,
+        downloading only what is missing or outdated
+
+        params:
+        - chain: GqlChain value, eg "MAINNET"
+        - addresses: token addresses
+        - fetch: callable(addresses, chain, range) returning `tokenGetHistoricalPrices`
+        - since: earliest timestamp needed
+        - until: latest timestamp needed; defaults to now
+
+        returns:
+        - dict of lowercased address -> PriceHistory
+        """
+        chain = chain.upper()
+        addresses = list(dict.fromkeys(address.lower() for address in addresses))
+        now = time.time()
+        until = now if until is None else until
+        # the lock covers planning and merging; the downloads run outside of it
+        requests: Dict[Tuple[str, bool], List[str]] = {}
+        with self._lock:
+            for address in addresses:
+                key = (chain, address)
+                self._load(key)
+                plan = self._plan(key, since, until, now)
+                if plan is not None:
+                    requests.setdefault(plan, []).append(address)
+
+        for (price_range, replace), to_fetch in requests.items():
+            for i in range(0, len(to_fetch), self.chunk_size):
+                chunk = to_fetch[i : i + self.chunk_size]
+                fetched = {
+                    entry["address"].lower(): PriceHistory.from_api(entry["prices"])
+                    for entry in fetch(chunk, chain, price_range)
+                    if entry["chain"].upper() == chain
+                }
+                with self._lock:
+                    for address in chunk:
+                        new = fetched.get(address, PriceHistory())
+                        self._merge((chain, address), new, price_range, replace, now)
+
+        with self._lock:
+            return {address: self._histories[(chain, address)] for address in addresses}
+
+    def _merge(
+        self,
+        key: Tuple[str, str],
+        new: PriceHistory,
+        price_range: str,
+        replace: bool,
+        now: float,
+    ):
+        if replace or key not in self._coverage:
+            # the largest range is all the api serves
+            largest = price_range == PRICE_RANGES[-1][0]
+            covers_from = 0 if largest else now - dict(PRICE_RANGES)[price_range] + DAY
+            self._store(key, new, covers_from, now)
+            return
+        # api ranges are sampled at different intervals and the averages weigh every
+        # point alike, so one history keeps a single spacing: the coarser one
+        old = self._histories[key]
+        step = max(old.step, new.step)
+        new_from = old.last_timestamp
+        if old.step < 0.99 * step:
+            old, new_from = old.resample(step), 0
+        self._store(
+            key,
+            old.append(new.resample(step, after=old.last_timestamp)),
+            self._coverage[key][0],
+            now,
+            new_from,
+        )
+
+
+PRICE_STORE = PriceStore()
@@ -0,0 +1,219 @@
+import os
+import re
+from functools import lru_cache
+from pathlib import Path
+from threading import Lock
+from typing import Any, Dict, Tuple
+
+from gql import gql
+from graphql import (
+    ListTypeNode,
+    NonNullTypeNode,
+    OperationDefinitionNode,
+    TypeNode,
+    VariableDefinitionNode,
+)
+
+from .errors import QueryVariablesError
+
+
+GRAPHQL_BASE_PATH = Path(os.path.dirname(os.path.abspath(__file__))) / "graphql"
+
+# python types accepted for the builtin graphql scalars; custom scalars are not checked
+SCALAR_TYPES = {
+    "Int": (int,),
+    "Float": (int, float),
+    "String": (str,),
+    "ID": (str, int),
+    "Boolean": (bool,),
+}
+
+
+def _document(parsed):
+    # gql>=4 wraps the parsed document in a GraphQLRequest
+    return getattr(parsed, "document", parsed)
+
+
+def _is_query_string(query: str) -> bool:
+    return "{" in query and "}" in query
+
+
+@lru_cache(maxsize=256)
+def parse_query(query: str):
+    """
+    parse an inline query string once; repeated calls return the cached object
+    """
+    return gql(query)
+
+
+def build_aliased_query(
+    name: str,
+    field: str,
+    count: int,
+    alias_variables: Dict[str, str],
+    shared_variables: Dict[str, str] = None,
+) -> str:
+    """
+    build one document repeating `field` under the aliases `q0` .. `q{count - 1}`
+
+    params:
+    - name: operation name
+    - field: selection using `$var` placeholders
+    - count: number of aliases
+    - alias_variables: {var: type} of variables that get one copy per alias, eg
+      `$id_gt` becomes `$id_gt_0`, `$id_gt_1`, ...
+    - shared_variables: {var: type} of variables shared by all aliases
+
+    returns:
+    - the query string; identical inputs give identical strings, so the parsed
+      document is cached by `parse_query`
+    """
+    definitions = [f"${var}: {t}" for var, t in (shared_variables or {}).items()]
+    fields = []
+    for i in range(count):
+        definitions += [f"${var}_{i}: {t}" for var, t in alias_variables.items()]
+        aliased = field
+        for var in alias_variables:
+            aliased = re.sub(rf"\${var}\b", f"${var}_{i}", aliased)
+        fields.append(f"q{i}: {aliased.strip()}")
+    body = "\n".join(fields)
+    return f"query {name}({', '.join(definitions)}) {{\n{body}\n}}"
+
+
+class QueryRegistry:
+    """
+    loads and parses the bundled `.gql` files at most once per process
+
+    queries are keyed by (subgraph, query name); the name can be either the file
+    name without extension or the operation name defined in the file
+    """
+
+    def __init__(self, base_path: Path = GRAPHQL_BASE_PATH):
+        self.base_path = Path(base_path)
+        self._queries: Dict[Tuple[str, str], Any] = {}
+        self._lock = Lock()
+        self._preloaded = False
+
+    def _load(self, subgraph: str, name: str):
+        parsed = gql((self.base_path / subgraph / f"{name}.gql").read_text())
+        self._register(subgraph, name, parsed)
+        return parsed
+
+    def _register(self, subgraph: str, name: str, parsed):
+        self._queries[(subgraph, name)] = parsed
+        for definition in _document(parsed).definitions:
+            if isinstance(definition, OperationDefinitionNode) and definition.name:
+                self._queries.setdefault((subgraph, definition.name.value), parsed)
+
+    def get(self, subgraph: str, query: str):
+        """
+        get a parsed query
+
+        params:
+        - subgraph: folder of the query inside `graphql/`
+        - query: query (file or operation) name, or an inline query string
+
+        returns:
+        - the parsed query, ready to be passed to a gql client
+        """
+        if _is_query_string(query):
+            return parse_query(query)
+        parsed = self._queries.get((subgraph, query))
+        if parsed is not None:
+            return parsed
+        with self._lock:
+            parsed = self._queries.get((subgraph, query))
+            if parsed is not None:
+                return parsed
+            try:
+                return self._load(subgraph, query)
+            except FileNotFoundError:
+                if self._preloaded:
+                    raise
+            # the name may be an operation name; only a full scan can tell
+            self._preload()
+            try:
+                return self._queries[(subgraph, query)]
+            except KeyError:
+                raise FileNotFoundError(
+                    f"No query {query} found for subgraph {subgraph} in {self.base_path}"
+                )
+
+    def _preload(self) -> int:
+        for path in sorted(self.base_path.glob("*/*.gql")):
+            key = (path.parent.name, path.stem)
+            if key not in self._queries:
+                self._register(*key, gql(path.read_text()))
+        self._preloaded = True
+        return len(self._queries)
+
+    def preload(self) -> int:
+        """
+        parse every bundled query up front, eg at worker start up
+
+        returns:
+        - number of registered (subgraph, name) keys
+        """
+        with self._lock:
+            return self._preload()
+
+    def variable_definitions(
+        self, subgraph: str, query: str
+    ) -> Dict[str, VariableDefinitionNode]:
+        definitions = {}
+        for definition in _document(self.get(subgraph, query)).definitions:
+            if isinstance(definition, OperationDefinitionNode):
+                for variable in definition.variable_definitions:
+                    definitions[variable.variable.name.value] = variable
+        return definitions
+
+    def validate_variables(self, subgraph: str, query: str, variables: dict = None):
+        """
+        check `variables` against the variable definitions of the parsed operation
+
+        raises:
+        - QueryVariablesError on unknown variables, missing required variables or
+          values that do not match a builtin scalar type
+        """
+        variables = variables or {}
+        definitions = self.variable_definitions(subgraph, query)
+        unknown = set(variables) - set(definitions)
+        if unknown:
+            raise QueryVariablesError(
+                f"Unknown variables for {subgraph}/{query}: {sorted(unknown)}"
+            )
+        for name, definition in definitions.items():
+            value = variables.get(name)
+            if value is None:
+                if (
+                    isinstance(definition.type, NonNullTypeNode)
+                    and definition.default_value is None
+                ):
+                    raise QueryVariablesError(
+                        f"Missing required variable ${name} for {subgraph}/{query}"
+                    )
+                continue
+            if not _matches_type(value, definition.type):
+                raise QueryVariablesError(
+                    f"Variable ${name} for {subgraph}/{query} does not match its type: {value!r}"
+                )
+
+
+def _matches_type(value: Any, type_node: TypeNode) -> bool:
+    if isinstance(type_node, NonNullTypeNode):
+        return value is not None and _matches_type(value, type_node.type)
+    if value is None:
+        return True
+    if isinstance(type_node, ListTypeNode):
+        # graphql coerces a single value into a list of one
+        values = value if isinstance(value, (list, tuple)) else [value]
+        return all(_matches_type(v, type_node.type) for v in values)
+    expected = SCALAR_TYPES.get(type_node.name.value)
+    if expected is None:
+        return True
+    if isinstance(value, bool) and bool not in expected:
+        return False
+    return isinstance(value, expected)
+
+
+QUERY_REGISTRY = QueryRegistry()
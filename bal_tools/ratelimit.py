@@ -0,0 +1,232 @@
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+from threading import Lock
+from typing import Dict, Mapping, Optional
+from urllib.parse import urlparse
+
+from .models import RateLimitMetrics
+
+
+# requests per second of the known providers, per api key tier
+RATE_LIMIT_TIERS: Dict[str, Dict[str, float]] = {
+    "api.etherscan.io": {
+        "free": 5,
+        "standard": 10,
+        "advanced": 20,
+        "professional": 30,
+    },
+    "api.routescan.io": {"free": 2},
+}
+DEFAULT_TIER = "free"
+DEFAULT_JITTER = 0.1  # fraction of a wait added at random
+
+
+def host_of(url: str) -> str:
+    """
+    host a url (or a bare host) is rate limited under; ports are ignored
+    """
+    return (urlparse(url).hostname or "") if "://" in url else url.lower()
+
+
+def retry_after_seconds(headers: Mapping[str, str]) -> Optional[float]:
+    """
+    seconds asked for by a `Retry-After` header, given as seconds or as an http date;
+    None when absent or unparseable
+    """
+    value = headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(
+    attempt: int, base: float = 1.0, cap: float = 60.0, jitter: float = 0.5
+) -> float:
+    """
+    exponential backoff of retry `attempt` (0 based), randomised by +-`jitter` so
+    parallel clients do not retry in lockstep
+    """
+    return min(base * 2**attempt, cap) * (1 + random.uniform(-jitter, jitter))
+
+
+class TokenBucket:
+    """
+    token bucket refilled at `rate` tokens per second, holding at most `capacity`
+
+    bursts of up to `capacity` requests go out at once and sustained traffic is
+    spread at `rate`. thread safe; `acquire` blocks the thread and `acquire_async`
+    only the calling task, so threads and event loops can share one bucket
+
+    a provider asking to back off (`Retry-After`) pauses the bucket for everyone
+    """
+
+    def __init__(
+        self,
+        rate: Optional[float] = None,
+        capacity: float = None,
+        jitter: float = DEFAULT_JITTER,
+    ):
+        """
+        params:
+        - rate: tokens added per second; None only applies pauses
+        - capacity: max tokens held; defaults to one second worth of tokens
+        - jitter: fraction of every wait added at random
+        """
+        self.rate = rate
+        self.capacity = capacity or max(rate or 1, 1)
+        self.jitter = jitter
+        self.metrics = RateLimitMetrics()
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = Lock()
+
+    def configure(self, rate: Optional[float], capacity: float = None):
+        with self._lock:
+            self.rate = rate
+            self.capacity = capacity or max(rate or 1, 1)
+            self._tokens = min(self._tokens, self.capacity)
+
+    def reserve(self, tokens: float = 1) -> float:
+        """
+        take `tokens` now, going into debt if the bucket runs dry
+
+        returns:
+        - seconds to wait before the tokens may be used, jitter included
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self._paused_until - now)
+            if self.rate:
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._tokens -= tokens
+                wait = max(wait, -self._tokens / self.rate)
+            self._updated = now
+            if wait > 0:
+                wait *= 1 + random.uniform(0, self.jitter)
+                self.metrics.throttled += 1
+                self.metrics.waited += wait
+            self.metrics.requests += 1
+            return wait
+
+    def pause(self, seconds: float):
+        """
+        hold every request for `seconds`, eg as asked by a `Retry-After` header
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self.metrics.pauses += 1
+
+    def paused_for(self) -> float:
+        """
+        seconds left of the current pause
+        """
+        with self._lock:
+            return max(0.0, self._paused_until - time.monotonic())
+
+    def acquire(self, tokens: float = 1):
+        """
+        block until `tokens` are available
+        """
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens: float = 1):
+        """
+        asyncio counterpart of `acquire`
+        """
+        wait = self.reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class RateLimiterRegistry:
+    """
+    one limiter per host, shared by every client in the process
+
+    hosts of `RATE_LIMIT_TIERS` start on their free tier; other hosts are not
+    throttled but still honour `Retry-After` pauses and collect metrics. any object
+    with the `TokenBucket` interface can be plugged in with `register`
+
+    usage:
+        RATE_LIMITERS.configure("api.etherscan.io", tier="advanced")
+        RATE_LIMITERS.get(url).acquire()
+    """
+
+    def __init__(self, tiers: Dict[str, Dict[str, float]] = None):
+        self.tiers = RATE_LIMIT_TIERS if tiers is None else tiers
+        self._limiters: Dict[str, TokenBucket] = {}
+        self._lock = Lock()
+
+    def get(self, url: str) -> TokenBucket:
+        """
+        params:
+        - url: url, or bare host, of the request
+
+        returns:
+        - the limiter of the host
+        """
+        host = host_of(url)
+        limiter = self._limiters.get(host)
+        if limiter is not None:
+            return limiter
+        with self._lock:
+            if host not in self._limiters:
+                rate = self.tiers.get(host, {}).get(DEFAULT_TIER)
+                self._limiters[host] = TokenBucket(rate)
+            return self._limiters[host]
+
+    def configure(
+        self,
+        url: str,
+        rate: float = None,
+        capacity: float = None,
+        tier: str = None,
+    ) -> TokenBucket:
+        """
+        set the limit of a host, either explicitly or from its `tier`
+
+        raises:
+        - ValueError for a tier unknown for the host
+        """
+        if tier is not None:
+            host_tiers = self.tiers.get(host_of(url), {})
+            if tier not in host_tiers:
+                raise ValueError(
+                    f"Unknown tier {tier} for {host_of(url)}; known: {list(host_tiers)}"
+                )
+            rate = host_tiers[tier]
+        limiter = self.get(url)
+        limiter.configure(rate, capacity)
+        return limiter
+
+    def register(self, url: str, limiter: TokenBucket):
+        with self._lock:
+            self._limiters[host_of(url)] = limiter
+
+    def metrics(self) -> Dict[str, RateLimitMetrics]:
+        """
+        returns:
+        - dict of host -> metrics of its limiter
+        """
+        with self._lock:
+            return {host: limiter.metrics for host, limiter in self._limiters.items()}
+
+    def clear(self):
+        with self._lock:
+            self._limiters.clear()
+
+
+RATE_LIMITERS = RateLimiterRegistry()
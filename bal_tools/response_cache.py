@@ -0,0 +1,266 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+from typing import Any, Optional, Tuple, Union
+
+from graphql import print_ast
+
+from .cache import cache_path
+
+
+DEFAULT_RESPONSE_TTL = 5 * 60  # for results not pinned to a block
+RESPONSE_CACHE_VERSION = 1  # bump to invalidate every stored response
+
+
+def _document(query) -> Any:
+    # gql>=4 wraps the parsed document in a GraphQLRequest
+    return getattr(query, "document", query)
+
+
+def url_family(url: str) -> str:
+    """
+    the part of a subgraph url identifying what is served; the graph api key (or
+    any other key in a gateway url) does not change the results
+    """
+    return re.sub(r"/api/[^/]+/", "/api/[api-key]/", url.split("?")[0].rstrip("/"))
+
+
+def response_cache_key(url: str, query, variables: dict = None) -> str:
+    """
+    content address of a query result: hash of (url family, normalised query, variables)
+
+    params:
+    - url: subgraph url the query is sent to
+    - query: the parsed query
+    - variables: query variables
+
+    returns:
+    - hex sha256 digest
+    """
+    payload = json.dumps(
+        [
+            RESPONSE_CACHE_VERSION,
+            url_family(url),
+            print_ast(_document(query)),
+            variables or {},
+        ],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def response_ttl(variables: dict = None) -> Optional[int]:
+    """
+    results pinned to a block number never change and are kept forever (None);
+    anything else follows the chain head and gets `DEFAULT_RESPONSE_TTL`
+
+    pin queries to finalized blocks only; a result pinned to a block that is
+    later reorged away is not invalidated
+    """
+    if variables and variables.get("block") is not None:
+        return None
+    return DEFAULT_RESPONSE_TTL
+
+
+class ResponseCache(ABC):
+    """
+    base class of the `fetch_graphql_data` response cache backends
+
+    subclasses implement `_get` and `_set` on (expires_at, value) entries, plus
+    `delete` and `clear`; `expires_at` is None for entries that never expire
+    """
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at < time.time():
+            self.delete(key)
+            return None
+        return value
+
+    def set(self, key: str, value: Any, ttl: Optional[int] = None):
+        expires_at = None if ttl is None else time.time() + ttl
+        self._set(key, expires_at, value)
+
+    @abstractmethod
+    def _get(self, key: str) -> Optional[Tuple[Optional[float], Any]]:
+        pass
+
+    @abstractmethod
+    def _set(self, key: str, expires_at: Optional[float], value: Any):
+        pass
+
+    @abstractmethod
+    def delete(self, key: str):
+        pass
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+
+class MemoryResponseCache(ResponseCache):
+    """
+    process local lru cache holding at most `maxsize` responses, and optionally at
+    most `maxbytes` of their json encoding
+    """
+
+    def __init__(self, maxsize: int = 1024, maxbytes: int = None):
+        """
+        params:
+        - maxsize: number of responses kept
+        - maxbytes: total size of the responses kept, measured as json; a response
+          larger than this is not cached. None bounds the cache by count only
+        """
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self._entries: "OrderedDict[str, Tuple[Optional[float], Any, int]]" = (
+            OrderedDict()
+        )
+        self._lock = Lock()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[:2]
+
+    def _set(self, key, expires_at, value):
+        size = 0
+        if self.maxbytes is not None:
+            size = len(json.dumps(value, default=str))
+            if size > self.maxbytes:
+                self.delete(key)
+                return
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries[key][2]
+            self._entries[key] = (expires_at, value, size)
+            self._entries.move_to_end(key)
+            self.nbytes += size
+            while len(self._entries) > self.maxsize or (
+                self.maxbytes is not None and self.nbytes > self.maxbytes
+            ):
+                self.nbytes -= self._entries.popitem(last=False)[1][2]
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.nbytes -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+class SQLiteResponseCache(ResponseCache):
+    """
+    responses stored as gzipped json in a single sqlite file; safe to share
+    between threads and processes
+    """
+
+    def __init__(self, path: Union[str, Path] = None):
+        """
+        params:
+        - path: sqlite file; defaults to `responses.sqlite` in the bal_tools cache dir
+        """
+        self.path = cache_path("responses.sqlite") if path is None else Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self._lock = Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses"
+                " (key TEXT PRIMARY KEY, expires_at REAL, value BLOB)"
+            )
+
+    def _get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT expires_at, value FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(gzip.decompress(row[1]))
+
+    def _set(self, key, expires_at, value):
+        blob = gzip.compress(json.dumps(value).encode())
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                (key, expires_at, blob),
+            )
+
+    def delete(self, key):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM responses")
+
+    def close(self):
+        self._conn.close()
+
+
+class DirectoryResponseCache(ResponseCache):
+    """
+    one gzipped json file per response, sharded by the first two hex digits of the key;
+    easy to inspect, rsync or prune with standard tools
+    """
+
+    def __init__(self, path: Union[str, Path] = None):
+        """
+        params:
+        - path: directory; defaults to `responses` in the bal_tools cache dir
+        """
+        self.path = cache_path("responses") if path is None else Path(path)
+
+    def _path(self, key: str) -> Path:
+        return self.path / key[:2] / f"{key}.json.gz"
+
+    def _get(self, key):
+        try:
+            with gzip.open(self._path(key), "rt") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry["expires_at"], entry["value"]
+
+    def _set(self, key, expires_at, value):
+        path = self._path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+            with os.fdopen(fd, "wb") as raw, gzip.open(raw, "wt") as f:
+                json.dump({"expires_at": expires_at, "value": value}, f)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+
+    def delete(self, key):
+        try:
+            self._path(key).unlink()
+        except OSError:
+            pass
+
+    def clear(self):
+        for path in self.path.glob("*/*.json.gz"):
+            path.unlink(missing_ok=True)
@@ -0,0 +1,127 @@
+import hashlib
+import json
+from threading import Lock
+from typing import Any, Callable, Optional
+
+from .response_cache import MemoryResponseCache, ResponseCache
+
+
+FINALITY_DEPTH = 64  # blocks behind the head after which reads never change
+# chains whose reorgs can run deeper than `FINALITY_DEPTH`
+FINALITY_DEPTHS = {
+    # polygon pos has seen reorgs of over 100 blocks
+    "polygon": 256,
+}
+RPC_CACHE_SIZE = 10_000
+RPC_CACHE_BYTES = 256 * 1024 * 1024  # json size of the cached responses
+# cached methods -> position of their block parameter
+CACHED_RPC_METHODS = {
+    "eth_call": 1,
+    "eth_getBalance": 1,
+    "eth_getBlockByNumber": 0,
+}
+
+
+def chain_finality_depth(chain: str) -> int:
+    """
+    blocks behind the head after which reads on `chain` are treated as final
+    """
+    return FINALITY_DEPTHS.get(chain, FINALITY_DEPTH)
+
+
+def rpc_block_number(method: str, params: Any) -> Optional[int]:
+    """
+    block number a cacheable read is pinned to; None for other methods and for
+    block tags (latest, safe, ...) or hashes
+    """
+    position = CACHED_RPC_METHODS.get(method)
+    if position is None or not params or len(params) <= position:
+        return None
+    block = params[position]
+    if isinstance(block, int) and not isinstance(block, bool):
+        return block
+    # block hashes are 66 characters long
+    if isinstance(block, str) and block.startswith("0x") and len(block) <= 18:
+        return int(block, 16)
+    return None
+
+
+class RpcCallCache:
+    """
+    memoizes `eth_call`, `eth_getBalance` and `eth_getBlockByNumber` responses
+    pinned to a block at least `finality_depth` blocks behind the chain head; those
+    can no longer change. `eth_getBlockByNumber` is cached as requested, so blocks
+    fetched with their full transactions are kept whole
+
+    any `ResponseCache` backend works; the default is a process wide in-memory lru
+    bounded to `RPC_CACHE_SIZE` responses and `RPC_CACHE_BYTES`,
+    `SQLiteResponseCache` keeps results across runs. keys include the chain, so one
+    backend can serve every chain
+    """
+
+    def __init__(
+        self,
+        chain: str,
+        cache: ResponseCache = None,
+        finality_depth: int = None,
+    ):
+        """
+        params:
+        - chain: chain of the provider, part of every key
+        - cache: backend; defaults to `RPC_CALL_CACHE`
+        - finality_depth: blocks behind the head a read must be to be cached;
+          defaults to the depth of the chain in `FINALITY_DEPTHS`
+        """
+        self.chain = chain
+        self.cache = cache if cache is not None else RPC_CALL_CACHE
+        self.finality_depth = (
+            finality_depth
+            if finality_depth is not None
+            else chain_finality_depth(chain)
+        )
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+    def key(self, method: str, params: Any) -> str:
+        payload = json.dumps([self.chain, method, params], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def request(
+        self,
+        method: str,
+        params: Any,
+        fetch: Callable[[], dict],
+        head: Callable[[], int],
+    ) -> dict:
+        """
+        answer a request from the cache, or `fetch` it and cache the response when
+        it is final
+
+        params:
+        - method, params: the json-rpc request
+        - fetch: callable making the request
+        - head: callable returning the current block number
+
+        returns:
+        - the rpc response
+        """
+        block = rpc_block_number(method, params)
+        if block is None:
+            return fetch()
+        key = self.key(method, params)
+        response = self.cache.get(key)
+        with self._lock:
+            if response is not None:
+                self.hits += 1
+                return response
+            self.misses += 1
+        response = fetch()
+        # errors and unknown blocks are never cached
+        if response.get("result") is not None and "error" not in response:
+            if block <= head() - self.finality_depth:
+                self.cache.set(key, response, ttl=None)
+        return response
+
+
+RPC_CALL_CACHE = MemoryResponseCache(RPC_CACHE_SIZE, RPC_CACHE_BYTES)
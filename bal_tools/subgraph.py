@@ -5,22 +5,60 @@ import re
 import time
 from datetime import datetime, timezone, timedelta
 from decimal import Decimal
-from typing import Union, List, Callable, Dict
+from typing import (
+    Union,
+    Iterable,
+    List,
+    Callable,
+    Dict,
+    Optional,
+    Iterator,
+    Sequence,
+    Tuple,
+)
 import warnings
+from threading import Lock, RLock, Thread, local
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
-import pandas as pd
-from gql import Client, gql
-from gql.transport.requests import RequestsHTTPTransport
+from gql import Client
 from gql.transport.exceptions import TransportServerError
 from web3 import Web3
 
 from .utils import get_abi, flatten_nested_dict, chain_ids_by_name
+from .cache import load_registry, read_json_cache, write_json_cache, DEFAULT_TTL
 from .models import *
-from .errors import NoPricesFoundError
+from .errors import NoPricesFoundError, NoResultError
 from .ts_config_loader import ts_config_loader
 from .etherscan import Etherscan
-from ._version import __version__ as VERSION
+from .transport import PooledRequestsHTTPTransport, GRAPHQL_CLIENT_HEADERS
+from .queries import QUERY_REGISTRY, build_aliased_query
+from .response_cache import ResponseCache, response_cache_key, response_ttl
+from .pagination import paginate, get_path, DEFAULT_PAGE_SIZE
+from .ratelimit import RATE_LIMITERS, backoff_delay
+from .multicall import multicall
+from .twap import TwapEngine, filtered_mean
+from .price_store import PriceStore, PRICE_STORE
+
+
+# aliases per document; keeps responses under server limits
+DEFAULT_ALIAS_CHUNK_SIZE = 25
+# base delay in seconds of the retries of a subgraph answering 503
+SERVICE_UNAVAILABLE_BACKOFF = 30
+# pool ids per `poolGetPools(where: {idIn})` request
+POOL_TOKENS_CHUNK_SIZE = 500
+# first block within 200s after a timestamp, aliased once per timestamp
+FIRST_BLOCK_AFTER_TS_FIELD = """
+blocks(
+    first: 1
+    orderBy: number
+    orderDirection: asc
+    where: {timestamp_gt: $timestamp_gt, timestamp_lt: $timestamp_lt}
+) {
+    number
+    timestamp
+}
+"""
 
 
 def url_dict_from_df(df):
@@ -42,13 +80,62 @@ def url_dict_from_df(df):
     )
 
 
+def _fetch_v3_subgraphs() -> Dict[str, Dict[str, Dict[str, str]]]:
+    # pandas/lxml are only needed when the docs page is actually scraped
+    import pandas as pd
+
+    vault_df, pools_df = pd.read_html(
+        V3_SUBGRAPHS_DOCS_URL,
+        match="Network",
+        flavor="lxml",
+    )
+    registry = {}
+    for subgraph, df in (("vault-v3", vault_df), ("pools-v3", pools_df)):
+        production, development = url_dict_from_df(df)
+        registry[subgraph] = {"production": production, "development": development}
+    return registry
+
+
+_v3_subgraphs = None
+_v3_subgraphs_lock = Lock()
+
+
+def get_v3_subgraphs() -> Dict[str, Dict[str, Dict[str, str]]]:
+    """
+    v3 subgraph urls as listed on the balancer docs; resolved on first use from the
+    on-disk cache, the docs page or the bundled snapshot (see `cache.load_registry`)
+
+    returns:
+    - {"vault-v3" | "pools-v3": {"production" | "development": {chain: url}}}
+    """
+    global _v3_subgraphs
+    if _v3_subgraphs is None:
+        with _v3_subgraphs_lock:
+            if _v3_subgraphs is None:
+                _v3_subgraphs = load_registry("v3_subgraphs.json", _fetch_v3_subgraphs)
+    return _v3_subgraphs
+
+
+_V3_SUBGRAPH_REGISTRY_NAMES = {
+    "VAULT_V3_SUBGRAPHS_BY_CHAIN": ("vault-v3", "production"),
+    "VAULT_V3_SUBGRAPHS_BY_CHAIN_DEV": ("vault-v3", "development"),
+    "POOLS_V3_SUBGRAPHS_BY_CHAIN": ("pools-v3", "production"),
+    "POOLS_V3_SUBGRAPHS_BY_CHAIN_DEV": ("pools-v3", "development"),
+}
+
+
+def __getattr__(name):
+    # keep the v3 url dicts importable without scraping the docs at import time
+    if name in _V3_SUBGRAPH_REGISTRY_NAMES:
+        subgraph, env = _V3_SUBGRAPH_REGISTRY_NAMES[name]
+        return get_v3_subgraphs()[subgraph][env]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 graphql_base_path = f"{os.path.dirname(os.path.abspath(__file__))}/graphql"
-vault_df, pools_df = pd.read_html(
-    "https://docs.balancer.fi/data-and-analytics/data-and-analytics/subgraph.html",
-    match="Network",
-    flavor="lxml",
+V3_SUBGRAPHS_DOCS_URL = (
+    "https://docs.balancer.fi/data-and-analytics/data-and-analytics/subgraph.html"
 )
-
 SNAPSHOT_URL = "https://hub.snapshot.org/graphql"
 AURA_SUBGRAPH_URI = "https://api.subgraph.ormilabs.com/api/public/396b336b-4ed7-469f-a8f4-468e1e26e9a8/subgraphs"
 AURA_SUBGRAPHS_BY_CHAIN = {
@@ -63,16 +150,153 @@ AURA_SUBGRAPHS_BY_CHAIN = {
     "avalanche": f"{AURA_SUBGRAPH_URI}/aura-finance-avalanche/v0.0.1/",
     "plasma": None,
 }
-VAULT_V3_SUBGRAPHS_BY_CHAIN, VAULT_V3_SUBGRAPHS_BY_CHAIN_DEV = url_dict_from_df(
-    vault_df
-)
-POOLS_V3_SUBGRAPHS_BY_CHAIN, POOLS_V3_SUBGRAPHS_BY_CHAIN_DEV = url_dict_from_df(
-    pools_df
-)
+
+SUBGRAPH_URL_CACHE_FILE = "subgraph_urls.json"
+SUBGRAPH_URL_CACHE_TTL = DEFAULT_TTL
+DEFAULT_WARM_SUBGRAPHS = ("core", "gauges", "blocks", "apiv3", "vault-v3", "pools-v3")
+
+# process wide subgraph url cache, mirrored to disk; see `Subgraph.get_subgraph_url`
+_url_cache = None
+_url_cache_lock = RLock()
+_url_refreshing = set()
+
+
+def _url_cache_key(chain: str, subgraph: str) -> str:
+    # resolution differs with and without an api key, so both are cached separately
+    has_key = "key" if os.getenv("GRAPH_API_KEY") else "nokey"
+    return f"{chain}:{subgraph}:{has_key}"
+
+
+def _mask_graph_api_key(url: str) -> str:
+    # never persist the api key itself to disk
+    graph_api_key = os.getenv("GRAPH_API_KEY")
+    if graph_api_key:
+        return url.replace(graph_api_key, "[api-key]")
+    return url
+
+
+def _unmask_graph_api_key(url: str) -> str:
+    graph_api_key = os.getenv("GRAPH_API_KEY")
+    if graph_api_key:
+        return url.replace("[api-key]", graph_api_key)
+    return url
+
+
+def _load_url_cache() -> Dict[str, Dict]:
+    global _url_cache
+    with _url_cache_lock:
+        if _url_cache is None:
+            _url_cache = read_json_cache(SUBGRAPH_URL_CACHE_FILE, ttl=None) or {}
+        return _url_cache
+
+
+def _get_cached_url(key: str) -> Optional[Dict]:
+    return _load_url_cache().get(key)
+
+
+def _set_cached_url(key: str, url: str, url_warnings: List[str] = None):
+    with _url_cache_lock:
+        cache = _load_url_cache()
+        cache[key] = {
+            "url": _mask_graph_api_key(url),
+            "ts": time.time(),
+            "warnings": url_warnings or [],
+        }
+        write_json_cache(SUBGRAPH_URL_CACHE_FILE, cache)
+
+
+def _refresh_url(chain: str, subgraph: str):
+    try:
+        subgraph_client = Subgraph(chain)
+        subgraph_client._url_warnings = []
+        url = subgraph_client.resolve_subgraph_url(subgraph)
+        if url:
+            _set_cached_url(
+                _url_cache_key(chain, subgraph), url, subgraph_client._url_warnings
+            )
+    except Exception:
+        pass
+    finally:
+        with _url_cache_lock:
+            _url_refreshing.discard((chain, subgraph))
+
+
+def _refresh_url_in_background(chain: str, subgraph: str):
+    with _url_cache_lock:
+        if (chain, subgraph) in _url_refreshing:
+            return
+        _url_refreshing.add((chain, subgraph))
+    Thread(target=_refresh_url, args=(chain, subgraph), daemon=True).start()
+
+
+def clear_url_cache(persist: bool = True):
+    """
+    drop every cached subgraph url; also wipes the on-disk copy if `persist`
+    """
+    global _url_cache
+    with _url_cache_lock:
+        _url_cache = {}
+        if persist:
+            write_json_cache(SUBGRAPH_URL_CACHE_FILE, _url_cache)
+
+
+def warm_url_cache(
+    chains: List[str],
+    subgraphs: List[str] = DEFAULT_WARM_SUBGRAPHS,
+    force: bool = False,
+    max_workers: int = 8,
+) -> Dict[str, Dict[str, Optional[str]]]:
+    """
+    resolve the subgraph urls for many chains at once and store them in the url cache
+
+    params:
+    - chains: chain names to resolve
+    - subgraphs: subgraph types to resolve per chain
+    - force: re-resolve even if a fresh url is already cached
+    - max_workers: number of chain/subgraph pairs resolved concurrently
+
+    returns:
+    - {chain: {subgraph: url}}; url is None where none could be found
+    """
+
+    def resolve(chain: str, subgraph: str) -> Optional[str]:
+        subgraph_client = Subgraph(chain)
+        if force:
+            _refresh_url(chain, subgraph)
+        return subgraph_client.get_subgraph_url(subgraph)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            (chain, subgraph): executor.submit(resolve, chain, subgraph)
+            for chain in chains
+            for subgraph in subgraphs
+        }
+    urls = {chain: {} for chain in chains}
+    for (chain, subgraph), future in futures.items():
+        try:
+            urls[chain][subgraph] = future.result()
+        except Exception:
+            urls[chain][subgraph] = None
+    return urls
 
 
 class Subgraph:
-    def __init__(self, chain: str = "mainnet", silence_warnings: bool = False):
+    def __init__(
+        self,
+        chain: str = "mainnet",
+        silence_warnings: bool = False,
+        response_cache: ResponseCache = None,
+        price_store: PriceStore = None,
+    ):
+        """
+        params:
+        - chain: chain the subgraphs are resolved for
+        - silence_warnings: hide warnings about missing api keys and fallback urls
+        - response_cache: optional cache for `fetch_graphql_data` results, see
+          `bal_tools.response_cache`; results pinned to a block are kept forever
+        - price_store: historical token prices used for TWAPs; defaults to the store
+          shared by the whole process
+        """
         if chain not in chain_ids_by_name().keys():
             raise ValueError(f"Invalid chain: {chain}")
         self.chain = chain
@@ -81,6 +305,19 @@ class Subgraph:
             self.set_silence_warnings(True)
         self.custom_price_logic: Dict[str, Callable] = {}
         self.etherscan_client = None
+        # instances are shared between threads; each resolution collects its own
+        # url warnings
+        self._local = local()
+        self.response_cache = response_cache
+        self.price_store = price_store or PRICE_STORE
+
+    @property
+    def _url_warnings(self) -> Optional[List[str]]:
+        return getattr(self._local, "url_warnings", None)
+
+    @_url_warnings.setter
+    def _url_warnings(self, url_warnings: Optional[List[str]]):
+        self._local.url_warnings = url_warnings
 
     def set_silence_warnings(self, silence_warnings: bool):
         if silence_warnings:
@@ -97,17 +334,54 @@ class Subgraph:
         2. frontend v2 config file
         3. frontend v2 config file (legacy style; for chains not supported by decentralised the graph)
 
+        resolved urls are cached process wide and on disk per (chain, subgraph) for
+        `SUBGRAPH_URL_CACHE_TTL` seconds; stale entries are served while being
+        refreshed in the background
+
         params:
         - subgraph: "apiv3", "vault-v3", "pools-v3", "core", "gauges", "blocks" or "aura"
 
         returns:
         - https url of the subgraph
         """
-        # before anything else, try to get the url from the latest backend config
         if subgraph == "snapshot":
             return SNAPSHOT_URL
         if subgraph == "aura":
             return AURA_SUBGRAPHS_BY_CHAIN.get(self.chain, None)
+
+        key = _url_cache_key(self.chain, subgraph)
+        entry = _get_cached_url(key)
+        if entry:
+            if time.time() - entry["ts"] > SUBGRAPH_URL_CACHE_TTL:
+                # stale while revalidate; serve the old url and refresh in the background
+                _refresh_url_in_background(self.chain, subgraph)
+            for message in entry.get("warnings", []):
+                warnings.warn(message, UserWarning)
+            return _unmask_graph_api_key(entry["url"])
+
+        self._url_warnings = []
+        try:
+            url = self.resolve_subgraph_url(subgraph)
+            deferred_warnings = self._url_warnings
+        finally:
+            self._url_warnings = None
+        for message in deferred_warnings:
+            warnings.warn(message, UserWarning)
+        if url:
+            _set_cached_url(key, url, deferred_warnings)
+        return url
+
+    def resolve_subgraph_url(self, subgraph="core") -> str:
+        """
+        resolve the subgraph url from its upstream sources, bypassing the url cache
+
+        params:
+        - subgraph: "apiv3", "vault-v3", "pools-v3", "core", "gauges" or "blocks"
+
+        returns:
+        - https url of the subgraph
+        """
+        # before anything else, try to get the url from the latest backend config
         url = self.get_subgraph_url_from_backend_config(subgraph)
         if url:
             return url
@@ -126,6 +400,14 @@ class Subgraph:
             or None
         )
 
+    def _warn_missing_graph_api_key(self, subgraph: str, url: str):
+        message = f"`GRAPH_API_KEY` not set. may be rate limited or have stale data for subgraph:{subgraph} url:{url}"
+        if self._url_warnings is not None:
+            # resolving for the url cache; the caller emits and stores the warning
+            self._url_warnings.append(message)
+        else:
+            warnings.warn(message, UserWarning)
+
     def get_subgraph_url_from_backend_config(self, subgraph: str) -> str:
         ts_keys_map = {
             "vault-v3": "balancerV3",
@@ -160,36 +442,39 @@ class Subgraph:
                     except:
                         return None
                 else:
-                    warnings.warn(
-                        f"`GRAPH_API_KEY` not set. may be rate limited or have stale data for subgraph:{subgraph} url:{url}",
-                        UserWarning,
-                    )
+                    self._warn_missing_graph_api_key(subgraph, url)
                     return None
             return url
         except:
             return None
 
     def get_subgraph_url_vault_v3(self, chain: str) -> str:
+        urls = get_v3_subgraphs()["vault-v3"]
         graph_api_key = os.getenv("GRAPH_API_KEY")
         if graph_api_key:
             try:
-                return VAULT_V3_SUBGRAPHS_BY_CHAIN.get(chain, None).replace(
-                    "[api-key]", graph_api_key
+                return (
+                    urls["production"]
+                    .get(chain, None)
+                    .replace("[api-key]", graph_api_key)
                 )
             except AttributeError:
                 pass
-        return VAULT_V3_SUBGRAPHS_BY_CHAIN_DEV.get(chain, None)
+        return urls["development"].get(chain, None)
 
     def get_subgraph_url_pools_v3(self, chain: str) -> str:
+        urls = get_v3_subgraphs()["pools-v3"]
         graph_api_key = os.getenv("GRAPH_API_KEY")
         if graph_api_key:
             try:
-                return POOLS_V3_SUBGRAPHS_BY_CHAIN.get(chain, None).replace(
-                    "[api-key]", graph_api_key
+                return (
+                    urls["production"]
+                    .get(chain, None)
+                    .replace("[api-key]", graph_api_key)
                 )
             except AttributeError:
                 pass
-        return POOLS_V3_SUBGRAPHS_BY_CHAIN_DEV.get(chain, None)
+        return urls["development"].get(chain, None)
 
     def get_subgraph_url_frontendv2(self, subgraph):
         if subgraph == "core":
@@ -215,10 +500,7 @@ class Subgraph:
                                 graph_api_key = os.getenv("GRAPH_API_KEY")
                                 if "${keys.graph}" in url:
                                     if not graph_api_key:
-                                        warnings.warn(
-                                            f"`GRAPH_API_KEY` not set. may be rate limited or have stale data for subgraph:{subgraph} url:{url}",
-                                            UserWarning,
-                                        )
+                                        self._warn_missing_graph_api_key(subgraph, url)
                                         return None
                                     return url.replace("${keys.graph}", graph_api_key)
                                 return url
@@ -320,6 +602,7 @@ class Subgraph:
         params: dict = None,
         url: str = None,
         retries: int = 10,
+        validate: bool = False,
     ):
         """
         query a subgraph using a locally saved query
@@ -328,6 +611,7 @@ class Subgraph:
         - query: the name of the query (file) to be executed
         - params: optional parameters to be passed to the query
         - retries: number of retry attempts for failed requests (default: 10)
+        - validate: check `params` against the query's variable definitions first
 
         returns:
         - result of the query
@@ -341,61 +625,191 @@ class Subgraph:
                         f"Subgraph url not found for {subgraph} on chain {self.chain}"
                     )
 
-        # prepare the query
-        if "{" and "}" in query:
-            # `query` is the actual query itself
-            gql_query = gql(query)
-        else:
-            # `query` is the filename; load it from the graphql folder
-            with open(f"{graphql_base_path}/{subgraph}/{query}.gql") as f:
-                gql_query = gql(f.read())
+        # prepare the query; either the actual query itself or the name of a
+        # bundled query, parsed once per process by the registry
+        gql_query = QUERY_REGISTRY.get(subgraph, query)
+        if validate:
+            QUERY_REGISTRY.validate_variables(subgraph, query, params)
+
+        url = url or self.subgraph_url[subgraph]
+        if self.response_cache is not None:
+            cache_key = response_cache_key(url, gql_query, params)
+            result = self.response_cache.get(cache_key)
+            if result is not None:
+                return result
 
         # manual retry logic on top of transport retries
         max_attempts = 3
         for attempt in range(max_attempts):
             try:
-                transport = RequestsHTTPTransport(
-                    url=url or self.subgraph_url[subgraph],
+                # cheap wrapper; the underlying keep-alive session is pooled per url
+                transport = PooledRequestsHTTPTransport(
+                    url=url,
                     retries=retries,
                     retry_backoff_factor=2.0,
                     retry_status_forcelist=[400, 429, 500, 502, 503, 504, 520],
-                    headers={
-                        "x-graphql-client-name": "Maxxis",
-                        "x-graphql-client-version": f"bal_tools/v{VERSION}",
-                    },
+                    headers=GRAPHQL_CLIENT_HEADERS,
                 )
                 client = Client(transport=transport, fetch_schema_from_transport=False)
                 result = client.execute(gql_query, variable_values=params)
+                if self.response_cache is not None:
+                    self.response_cache.set(cache_key, result, response_ttl(params))
                 return result
 
             except TransportServerError as e:
                 error_msg = str(e).lower()
                 if "503" in error_msg or "service unavailable" in error_msg:
                     if attempt < max_attempts - 1:
-                        wait_time = 30 * (attempt + 1)  # 30s, 60s, 90s
+                        # a Retry-After of the host pauses its limiter; otherwise back
+                        # off with jitter so parallel jobs do not retry in lockstep
+                        limiter = RATE_LIMITERS.get(url)
+                        wait_time = limiter.paused_for() or backoff_delay(
+                            attempt, base=SERVICE_UNAVAILABLE_BACKOFF
+                        )
                         time.sleep(wait_time)
                         continue
                 raise
             except Exception:
                 raise
 
+    def paginate_graphql_data(
+        self,
+        subgraph: str,
+        query: str,
+        params: dict = None,
+        path: Union[str, Sequence[str]] = None,
+        page_size: int = DEFAULT_PAGE_SIZE,
+        limit: int = None,
+        url: str = None,
+    ) -> Iterator[List[dict]]:
+        """
+        stream all entities of a paginated query, one page at a time
+
+        the query must accept `$first` and `$id_gt` and order its list by id
+        ascending; see `pagination.paginate`
+
+        params:
+        - subgraph, query, params, url: as in `fetch_graphql_data`
+        - path: key(s) leading from the result to the paginated list
+        - page_size: number of entities per request
+        - limit: max total number of entities; None for all
+
+        returns:
+        - generator of pages (lists of entities)
+        """
+
+        def fetch_page(cursor: str, first: int) -> List[dict]:
+            data = self.fetch_graphql_data(
+                subgraph,
+                query,
+                {**(params or {}), "first": first, "id_gt": cursor},
+                url=url,
+            )
+            return get_path(data, path)
+
+        return paginate(fetch_page, page_size, limit)
+
+    def paginate_aliased_graphql_data(
+        self,
+        subgraph: str,
+        name: str,
+        field: str,
+        keys: Sequence[str],
+        key_type: str,
+        path: Union[str, Sequence[str]] = None,
+        params: Dict[str, tuple] = None,
+        chunk_size: int = DEFAULT_ALIAS_CHUNK_SIZE,
+        page_size: int = DEFAULT_PAGE_SIZE,
+        url: str = None,
+    ) -> Iterator[Tuple[str, List[dict]]]:
+        """
+        stream a paginated list for many keys at once; up to `chunk_size` keys are packed
+        as aliases into one document, and keys with more entities than `page_size` are
+        carried into the next document with their own cursor
+
+        `field` selects the list for one key using `$key`, `$id_gt` and `$first`, plus
+        any shared variable from `params`, eg:
+            gaugeShares(where: {gauge: $key, id_gt: $id_gt}, first: $first, orderBy: id) {...}
+
+        params:
+        - subgraph, url: as in `fetch_graphql_data`
+        - name: operation name of the generated document
+        - field: aliased selection, see above
+        - keys: one alias (or more, when paginating) per key
+        - key_type: graphql type of `$key`
+        - path: key(s) leading from an alias result to the paginated list
+        - params: shared variables as {var: (type, value)}
+        - chunk_size: max aliases per document
+        - page_size: number of entities per alias and request
+
+        returns:
+        - generator of (key, page) tuples; pages of one key come in order
+        """
+        params = params or {}
+        shared_types = {"first": "Int", **{k: t for k, (t, _) in params.items()}}
+        shared_values = {"first": page_size, **{k: v for k, (_, v) in params.items()}}
+        pending = [(key, "") for key in keys]
+        while pending:
+            chunk, pending = pending[:chunk_size], pending[chunk_size:]
+            query = build_aliased_query(
+                name, field, len(chunk), {"key": key_type, "id_gt": "ID!"}, shared_types
+            )
+            variables = dict(shared_values)
+            for i, (key, cursor) in enumerate(chunk):
+                variables[f"key_{i}"] = key
+                variables[f"id_gt_{i}"] = cursor
+            data = self.fetch_graphql_data(subgraph, query, variables, url=url)
+            for i, (key, _) in enumerate(chunk):
+                page = get_path(data.get(f"q{i}"), path)
+                if page:
+                    yield key, page
+                if len(page) == page_size:
+                    pending.append((key, page[-1]["id"]))
+
     def get_first_block_after_utc_timestamp(
         self, timestamp: int, use_etherscan: bool = True
     ) -> int:
-        if timestamp > int(datetime.now().strftime("%s")):
-            timestamp = int(datetime.now().strftime("%s")) - 2000
+        return self.get_first_blocks_after_utc_timestamps([timestamp], use_etherscan)[
+            timestamp
+        ]
+
+    def get_first_blocks_after_utc_timestamps(
+        self,
+        timestamps: Iterable[int],
+        use_etherscan: bool = True,
+        chunk_size: int = DEFAULT_ALIAS_CHUNK_SIZE,
+    ) -> Dict[int, int]:
+        """
+        batched `get_first_block_after_utc_timestamp`
+
+        timestamps are resolved in one concurrent, cached etherscan batch; the ones
+        etherscan cannot resolve fall back on the blocks subgraph, `chunk_size`
+        timestamps per request
+
+        params:
+        - timestamps: unix timestamps; future ones are clamped to just before now
+        - use_etherscan: try etherscan before the blocks subgraph
+        - chunk_size: timestamps per blocks subgraph request
+
+        returns:
+        - dict of timestamp -> block number
+        """
+        now = int(datetime.now().strftime("%s"))
+        clamped = {
+            ts: now - 2000 if ts > now else int(ts) for ts in dict.fromkeys(timestamps)
+        }
+        to_resolve = list(dict.fromkeys(clamped.values()))
+        blocks: Dict[int, int] = {}
 
         if use_etherscan:
             try:
                 if not self.etherscan_client:
                     self.etherscan_client = Etherscan()
 
-                block_number = self.etherscan_client.get_block_by_timestamp(
-                    chain=self.chain, timestamp=timestamp, closest="after"
-                )
-
-                if block_number:
-                    return block_number
+                found = self.etherscan_client.get_blocks_by_timestamps(
+                    {self.chain: to_resolve}, closest="after"
+                )[self.chain]
+                blocks.update({ts: b for ts, b in found.items() if b})
 
             except Exception as e:
                 warnings.warn(
@@ -403,54 +817,38 @@ class Subgraph:
                     UserWarning,
                 )
 
-        try:
-            data = self.fetch_graphql_data(
-                "blocks",
-                "first_block_after_ts",
-                {
-                    "timestamp_gt": int(timestamp) - 200,
-                    "timestamp_lt": int(timestamp) + 200,
-                },
-            )
-            data["blocks"].sort(key=lambda x: x["timestamp"], reverse=True)
-            return int(data["blocks"][0]["number"])
-        except Exception as e:
-            raise Exception(
-                f"Failed to fetch block for timestamp {timestamp} on {self.chain}: {str(e)}"
+        missing = [ts for ts in to_resolve if ts not in blocks]
+        for i in range(0, len(missing), chunk_size):
+            chunk = missing[i : i + chunk_size]
+            query = build_aliased_query(
+                "FirstBlocksAfterTimestamps",
+                FIRST_BLOCK_AFTER_TS_FIELD,
+                len(chunk),
+                {"timestamp_gt": "BigInt", "timestamp_lt": "BigInt"},
             )
+            variables = {}
+            for j, ts in enumerate(chunk):
+                variables[f"timestamp_gt_{j}"] = ts - 200
+                variables[f"timestamp_lt_{j}"] = ts + 200
+            try:
+                data = self.fetch_graphql_data("blocks", query, variables)
+                for j, ts in enumerate(chunk):
+                    blocks[ts] = int(data[f"q{j}"][0]["number"])
+            except Exception as e:
+                raise Exception(
+                    f"Failed to fetch block for timestamps {chunk} on {self.chain}: {str(e)}"
+                )
+
+        return {ts: blocks[resolved] for ts, resolved in clamped.items()}
 
     def filter_outliers_and_average(
         self, prices: List[Decimal], iqr_multiplier: float = 100_000.0
     ) -> Decimal:
-        arr = np.array([float(p) for p in prices])
-
-        if len(arr) == 1:
+        if len(prices) == 1:
             return prices[0]
+        return filtered_mean(np.array([float(p) for p in prices]), iqr_multiplier)
 
-        q1, q3 = np.percentile(arr, [25, 75])
-        iqr = q3 - q1
-        bounds = (q1 - iqr_multiplier * iqr, q3 + iqr_multiplier * iqr)
-        filtered = arr[(arr >= bounds[0]) & (arr <= bounds[1])]
-
-        return Decimal(str(np.mean(filtered) if len(filtered) > 0 else np.median(arr)))
-
-    def get_twap_price_token(
-        self,
-        addresses: Union[List[str], str],
-        chain: GqlChain,
-        date_range: DateRange,
-    ) -> Union[TWAPResult, List[TWAPResult]]:
-        """
-        fetches historical token prices and calculates the TWAP over the given date range.
-
-        :param addresses: list of token addresses or a single address.
-        :param chain: chain network from GqlChain enum.
-        :param date_range: tuple of (start_date_ts, end_date_ts).
-        :return: TWAPResult(s).
-        """
-        if isinstance(addresses, str):
-            addresses = [addresses]
-
+    def _check_twap_date_range(self, date_range: DateRange):
         start_date_ts, end_date_ts = date_range[0], date_range[1]
         current_ts = int(datetime.now(timezone.utc).timestamp())
         one_year_ago_ts = int(
@@ -468,34 +866,95 @@ class Subgraph:
         if end_date_ts < start_date_ts:
             raise ValueError("end date should be after start date")
 
+    def fetch_historical_token_prices(
+        self, addresses: List[str], chain: Union[GqlChain, str], range: str
+    ) -> List[dict]:
+        """
+        raw `tokenGetHistoricalPrices` of `addresses` over one of the api ranges
+        (SEVEN_DAY, THIRTY_DAY, ONE_YEAR, ...)
+        """
         chain = chain.value if isinstance(chain, GqlChain) else chain.upper()
-        params = {"addresses": addresses, "chain": chain, "range": "ONE_YEAR"}
+        params = {"addresses": addresses, "chain": chain, "range": range}
 
         token_data = self.fetch_graphql_data(
             "apiv3",
             "get_historical_token_prices",
             params,
         )
+        return token_data["tokenGetHistoricalPrices"]
 
-        def calc_twap(address: str) -> TWAPResult:
-            prices = [
-                Decimal(item["price"])
-                for entry in token_data["tokenGetHistoricalPrices"]
-                if entry["address"] == address
-                and entry["chain"].lower() == chain.lower()
-                for item in entry["prices"]
-                if end_date_ts >= int(item["timestamp"]) >= start_date_ts
-            ]
-            if not prices:
-                raise NoPricesFoundError(
-                    f"No prices found for {address} on {chain} between {start_date_ts} UTC and {end_date_ts} UTC"
-                )
-            twap_price = self.filter_outliers_and_average(prices)
-            return TWAPResult(address=address, twap_price=twap_price)
+    def get_twap_engine(
+        self,
+        addresses: List[str],
+        chain: Union[GqlChain, str],
+        date_ranges: List[DateRange] = None,
+    ) -> TwapEngine:
+        """
+        a `TwapEngine` over the price histories of `addresses`, read from the price
+        store; only missing or outdated points are downloaded
+
+        params:
+        - addresses: token addresses
+        - chain: chain network from GqlChain enum
+        - date_ranges: windows the engine should cover; defaults to the past year
+        """
+        chain = chain.value if isinstance(chain, GqlChain) else chain.upper()
+        if date_ranges:
+            since = min(date_range[0] for date_range in date_ranges)
+            until = max(date_range[1] for date_range in date_ranges)
+        else:
+            since = (datetime.now(timezone.utc) - timedelta(days=365)).timestamp()
+            until = None
+        histories = self.price_store.get_histories(
+            chain, addresses, self.fetch_historical_token_prices, since, until
+        )
+        return TwapEngine(histories, chain)
+
+    def get_twap_price_token(
+        self,
+        addresses: Union[List[str], str],
+        chain: GqlChain,
+        date_range: DateRange,
+    ) -> Union[TWAPResult, List[TWAPResult]]:
+        """
+        fetches historical token prices and calculates the TWAP over the given date range.
+
+        :param addresses: list of token addresses or a single address.
+        :param chain: chain network from GqlChain enum.
+        :param date_range: tuple of (start_date_ts, end_date_ts).
+        :return: TWAPResult(s).
+        """
+        if isinstance(addresses, str):
+            addresses = [addresses]
 
-        results = [calc_twap(addr) for addr in addresses]
+        results = self.get_twap_prices_token(addresses, chain, [date_range])[
+            tuple(date_range)
+        ]
         return results[0] if len(results) == 1 else results
 
+    def get_twap_prices_token(
+        self,
+        addresses: List[str],
+        chain: Union[GqlChain, str],
+        date_ranges: List[DateRange],
+    ) -> Dict[DateRange, List[TWAPResult]]:
+        """
+        calculates the TWAP of many tokens over many date ranges out of one download,
+        eg weekly fee reports over hundreds of tokens
+
+        params:
+        - addresses: list of token addresses
+        - chain: chain network from GqlChain enum
+        - date_ranges: list of (start_date_ts, end_date_ts) tuples
+
+        returns:
+        - dict of date_range -> TWAPResults in the order of `addresses`
+        """
+        for date_range in date_ranges:
+            self._check_twap_date_range(date_range)
+        engine = self.get_twap_engine(addresses, chain, date_ranges)
+        return engine.twaps(addresses, date_ranges)
+
     def get_twap_price_pool(
         self,
         pool_id: str,
@@ -529,19 +988,79 @@ class Subgraph:
         token_addresses = [token["address"] for token in token_data["poolTokens"]]
         bpt_address = pool_id[:42]
 
-        bpt_price = self.get_twap_price_token(
-            addresses=bpt_address,
-            chain=chain,
-            date_range=date_range,
-        )
-        token_prices = self.get_twap_price_token(
-            addresses=token_addresses,
-            chain=chain,
-            date_range=date_range,
-        )
+        # one store lookup for the bpt and its tokens
+        bpt_price, *token_prices = self.get_twap_prices_token(
+            [bpt_address] + token_addresses, chain, [date_range]
+        )[tuple(date_range)]
 
         return TwapPrices(bpt_price=bpt_price, token_prices=token_prices)
 
+    def get_pools_token_addresses(
+        self,
+        pool_ids: List[str],
+        chain: Union[GqlChain, str],
+        chunk_size: int = POOL_TOKENS_CHUNK_SIZE,
+    ) -> Dict[str, List[str]]:
+        """
+        token addresses of many pools, in one request per `chunk_size` pools
+
+        returns:
+        - dict of pool_id -> token addresses, in pool token order
+        """
+        chain = chain.value if isinstance(chain, GqlChain) else chain.upper()
+        pool_ids = list(dict.fromkeys(pool_ids))
+        tokens = {}
+        for i in range(0, len(pool_ids), chunk_size):
+            chunk = pool_ids[i : i + chunk_size]
+            data = self.fetch_graphql_data(
+                "apiv3",
+                "get_pools_tokens",
+                {"chain": chain, "poolIds": chunk, "first": len(chunk)},
+            )
+            for pool in data["poolGetPools"]:
+                tokens[pool["id"]] = [token["address"] for token in pool["poolTokens"]]
+        missing = [pool_id for pool_id in pool_ids if pool_id not in tokens]
+        if missing:
+            raise NoResultError(f"Pools not found on {chain}: {missing}")
+        return {pool_id: tokens[pool_id] for pool_id in pool_ids}
+
+    def get_twap_prices_for_pools(
+        self,
+        pool_ids: List[str],
+        chain: Union[GqlChain, str],
+        date_range: DateRange,
+    ) -> Dict[str, TwapPrices]:
+        """
+        batched `get_twap_price_pool`: the token sets of all pools are fetched in chunked
+        queries, addresses shared between pools are priced once, and every TWAP comes
+        out of a single engine pass
+
+        params:
+        - pool_ids: the ids of the pools
+        - chain: the chain network from GqlChain enum
+        - date_range: tuple of (start_date_ts, end_date_ts)
+
+        returns:
+        - dict of pool_id -> TwapPrices(bpt_price, token_prices)
+        """
+        tokens_by_pool = self.get_pools_token_addresses(pool_ids, chain)
+        addresses = list(
+            dict.fromkeys(
+                address
+                for pool_id, tokens in tokens_by_pool.items()
+                for address in [pool_id[:42]] + tokens
+            )
+        )
+        twaps = self.get_twap_prices_token(addresses, chain, [date_range])
+        twap_by_address = dict(zip(addresses, twaps[tuple(date_range)]))
+        return {
+            pool_id: TwapPrices(
+                bpt_price=twap_by_address[pool_id[:42]],
+                token_prices=[twap_by_address[address] for address in tokens],
+            )
+            for pool_id, tokens in tokens_by_pool.items()
+        }
+
     def calculate_aura_vebal_share(self, web3: Web3, block_number: int) -> Decimal:
         """
         Function that calculate veBAL share of AURA auraBAL from the total supply of veBAL
@@ -552,12 +1071,17 @@ class Subgraph:
             ),
             abi=get_abi("ERC20"),
         )
-        total_supply = ve_bal_contract.functions.totalSupply().call(
-            block_identifier=block_number
+        # both reads in a single eth_call
+        total_supply, aura_vebal_balance = multicall(
+            web3,
+            [
+                ve_bal_contract.functions.totalSupply(),
+                ve_bal_contract.functions.balanceOf(
+                    "0xaF52695E1bB01A16D33D7194C28C42b10e0Dbec2"  # veBAL aura holder
+                ),
+            ],
+            block_identifier=block_number,
         )
-        aura_vebal_balance = ve_bal_contract.functions.balanceOf(
-            "0xaF52695E1bB01A16D33D7194C28C42b10e0Dbec2"  # veBAL aura holder
-        ).call(block_identifier=block_number)
         return Decimal(aura_vebal_balance) / Decimal(total_supply)
 
     def fetch_all_pools_info(self) -> List[Pool]:
@@ -574,31 +1098,75 @@ class Subgraph:
         pools_per_req: int = 1000,
         limit: int = 5000,
     ) -> List[PoolSnapshot]:
+        return [
+            snapshot
+            for page in self.iter_balancer_pool_snapshots(
+                block, timestamp, pools_per_req, limit
+            )
+            for snapshot in page
+        ]
+
+    def iter_balancer_pool_snapshots(
+        self,
+        block: int = None,
+        timestamp: int = None,
+        pools_per_req: int = 1000,
+        limit: int = 5000,
+    ) -> Iterator[List[PoolSnapshot]]:
+        """
+        stream pool snapshots as of `block`, most recent first, one page at a time
+
+        pages on a `timestamp_lt` cursor; snapshots sharing the timestamp at a page
+        boundary are drained separately on an `id_gt` cursor so none are skipped
+
+        params:
+        - block: block to query at; resolved from `timestamp` if not given
+        - timestamp: utc timestamp used to find the block
+        - pools_per_req: page size
+        - limit: max number of snapshots; None for all
+        """
         if not any([block, timestamp]):
             raise ValueError("Must pass either block or timestamp")
 
         block = block or self.get_first_block_after_utc_timestamp(timestamp)
 
-        all_pools = []
-        offset = 0
-        while True:
-            result = self.fetch_graphql_data(
-                "core",
-                "pool_snapshots",
-                {"first": pools_per_req, "skip": offset, "block": block},
-            )
-            all_pools.extend(
-                [
-                    PoolSnapshot(**flatten_nested_dict(pool))
-                    for pool in result["poolSnapshots"]
-                ]
+        def to_models(snapshots: List[dict]) -> List[PoolSnapshot]:
+            return [
+                PoolSnapshot(**flatten_nested_dict(snapshot)) for snapshot in snapshots
+            ]
+
+        remaining = limit
+        params = {"block": block}
+        while remaining is None or remaining > 0:
+            first = (
+                pools_per_req if remaining is None else min(pools_per_req, remaining)
             )
-            offset += pools_per_req
-            if offset >= limit:
-                break
-            if len(result["poolSnapshots"]) < pools_per_req:
-                break
-        return all_pools
+            page = self.fetch_graphql_data(
+                "core", "pool_snapshots", {**params, "first": first}
+            )["poolSnapshots"]
+            if len(page) < first:
+                if page:
+                    yield to_models(page)
+                return
+            # the last timestamp of a full page may continue on the next page
+            boundary = page[-1]["timestamp"]
+            page = [snapshot for snapshot in page if snapshot["timestamp"] != boundary]
+            if page:
+                if remaining is not None:
+                    remaining -= len(page)
+                yield to_models(page)
+            for ties in self.paginate_graphql_data(
+                "core",
+                "pool_snapshots_at_timestamp",
+                {"block": block, "timestamp": boundary},
+                "poolSnapshots",
+                page_size=pools_per_req,
+                limit=remaining,
+            ):
+                if remaining is not None:
+                    remaining -= len(ties)
+                yield to_models(ties)
+            params["timestamp_lt"] = boundary
 
     def get_v3_protocol_fees(
         self, pool_id: str, chain: GqlChain, date_range: DateRange
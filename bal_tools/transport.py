@@ -0,0 +1,164 @@
+from threading import Lock
+from typing import Collection, Dict, Optional, Tuple
+
+from requests import Session
+from requests.adapters import HTTPAdapter, Retry
+from gql.transport.requests import RequestsHTTPTransport
+
+from ._version import __version__ as VERSION
+from .ratelimit import RATE_LIMITERS, RateLimiterRegistry, retry_after_seconds
+
+
+GRAPHQL_CLIENT_HEADERS = {
+    "x-graphql-client-name": "Maxxis",
+    "x-graphql-client-version": f"bal_tools/v{VERSION}",
+}
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 20
+
+_sessions: Dict[Tuple, Session] = {}
+_sessions_lock = Lock()
+
+
+class RateLimitedRetry(Retry):
+    """
+    `Retry` that also goes through the host's limiter in `RATE_LIMITERS` (or in
+    `registry`): every retry takes a token, and a `Retry-After` pauses the host for
+    all clients instead of only the retrying thread
+
+    the limiter owns the `Retry-After` wait, so urllib3 only sleeps its backoff
+    """
+
+    def __init__(
+        self,
+        *args,
+        registry: RateLimiterRegistry = None,
+        respect_retry_after_header: bool = False,
+        **kwargs,
+    ):
+        super().__init__(
+            *args, respect_retry_after_header=respect_retry_after_header, **kwargs
+        )
+        self.registry = registry
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.registry = self.registry
+        return retry
+
+    def increment(self, method=None, url=None, response=None, error=None, **kwargs):
+        pool = kwargs.get("_pool")
+        if pool is not None:
+            limiter = (self.registry or RATE_LIMITERS).get(pool.host)
+            seconds = None
+            if response is not None:
+                seconds = retry_after_seconds(response.headers)
+            if seconds is not None:
+                limiter.pause(seconds)
+        retry = super().increment(method, url, response, error, **kwargs)
+        if pool is not None:
+            limiter.acquire()
+        return retry
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """
+    `HTTPAdapter` taking a token from the host's limiter before every request and
+    pausing the host when a final response asks to retry later
+
+    limiters come from `RATE_LIMITERS` unless a `registry` of its own is given
+    """
+
+    def __init__(self, *args, registry: RateLimiterRegistry = None, **kwargs):
+        self.registry = registry
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, *args, **kwargs):
+        limiter = (self.registry or RATE_LIMITERS).get(request.url)
+        limiter.acquire()
+        response = super().send(request, *args, **kwargs)
+        if response.status_code in (429, 503):
+            seconds = retry_after_seconds(response.headers)
+            if seconds is not None:
+                limiter.pause(seconds)
+        return response
+
+
+def configure_pool(
+    pool_connections: Optional[int] = None, pool_maxsize: Optional[int] = None
+):
+    """
+    change the connection pool sizes used for graphql sessions
+
+    params:
+    - pool_connections: number of per-host pools kept per session
+    - pool_maxsize: max number of keep-alive connections per host
+
+    existing sessions are closed so the new sizes apply to the next request
+    """
+    global POOL_CONNECTIONS, POOL_MAXSIZE
+    if pool_connections is not None:
+        POOL_CONNECTIONS = pool_connections
+    if pool_maxsize is not None:
+        POOL_MAXSIZE = pool_maxsize
+    close_sessions()
+
+
+def get_session(
+    url: str,
+    retries: int = 0,
+    backoff_factor: float = 0.1,
+    status_forcelist: Collection[int] = (429, 500, 502, 503, 504),
+) -> Session:
+    """
+    get the process wide keep-alive session for a graphql url; sessions are shared
+    between all `Subgraph` instances and threads hitting the same url
+    """
+    key = (url, retries, backoff_factor, tuple(status_forcelist))
+    session = _sessions.get(key)
+    if session is not None:
+        return session
+    with _sessions_lock:
+        if key not in _sessions:
+            adapter = RateLimitedAdapter(
+                pool_connections=POOL_CONNECTIONS,
+                pool_maxsize=POOL_MAXSIZE,
+                max_retries=RateLimitedRetry(
+                    total=retries,
+                    backoff_factor=backoff_factor,
+                    status_forcelist=status_forcelist,
+                    allowed_methods=None,
+                ),
+            )
+            session = Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[key] = session
+        return _sessions[key]
+
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+class PooledRequestsHTTPTransport(RequestsHTTPTransport):
+    """
+    `RequestsHTTPTransport` that borrows its session from the process wide pool
+    instead of opening (and tearing down) a new one for every query
+    """
+
+    def connect(self):
+        if self.session is None:
+            self.session = get_session(
+                self.url,
+                self.retries,
+                self.retry_backoff_factor,
+                self.retry_status_forcelist,
+            )
+
+    def close(self):
+        # the session is owned by the pool; only drop our reference to it
+        self.session = None
@@ -0,0 +1,305 @@
+from decimal import Decimal
+from typing import Dict, Iterable, List, Sequence, Tuple, Union
+
+import numpy as np
+
+from .errors import NoPricesFoundError
+from .models import DateRange, TWAPResult
+
+
+class PriceHistory:
+    """
+    price points of one token, sorted by timestamp, as numpy arrays
+
+    `prices` holds floats for the vectorised maths; `raw_prices` keeps the api strings
+    so a window with a single point returns the exact quoted price
+    """
+
+    def __init__(
+        self,
+        timestamps: Iterable[int] = (),
+        prices: Iterable[str] = (),
+    ):
+        timestamps = np.asarray(list(timestamps), dtype=np.int64)
+        raw_prices = np.asarray(list(prices), dtype=object)
+        order = np.argsort(timestamps, kind="stable")
+        self.timestamps = timestamps[order]
+        self.raw_prices = raw_prices[order]
+        self.prices = self.raw_prices.astype(np.float64)
+
+    @classmethod
+    def from_api(cls, prices: List[dict]) -> "PriceHistory":
+        return cls(
+            (int(item["timestamp"]) for item in prices),
+            (item["price"] for item in prices),
+        )
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    @property
+    def last_timestamp(self) -> int:
+        return int(self.timestamps[-1]) if len(self.timestamps) else 0
+
+    def append(self, other: "PriceHistory") -> "PriceHistory":
+        """
+        new history with the points of `other` newer than the last point of this one
+        """
+        start = int(np.searchsorted(other.timestamps, self.last_timestamp, "right"))
+        history = PriceHistory()
+        history.timestamps = np.concatenate([self.timestamps, other.timestamps[start:]])
+        history.raw_prices = np.concatenate([self.raw_prices, other.raw_prices[start:]])
+        history.prices = np.concatenate([self.prices, other.prices[start:]])
+        return history
+
+    @property
+    def step(self) -> float:
+        """
+        typical spacing in seconds of the points; 0 with fewer than two points
+        """
+        if len(self.timestamps) < 2:
+            return 0.0
+        return float(np.median(np.diff(self.timestamps)))
+
+    def resample(self, step: float, after: int = None) -> "PriceHistory":
+        """
+        history keeping the first point of every `step` seconds, eg to bring points
+        of a denser api range to the spacing of a coarser one
+
+        params:
+        - step: min spacing of the kept points
+        - after: timestamp the first kept point must be `step` past
+        """
+        if step <= 0:
+            return self
+        keep = []
+        # 1% slack for points not quite on the grid
+        last = -np.inf if after is None else after
+        for i, timestamp in enumerate(self.timestamps):
+            if timestamp - last >= 0.99 * step:
+                keep.append(i)
+                last = timestamp
+        history = PriceHistory()
+        history.timestamps = self.timestamps[keep]
+        history.raw_prices = self.raw_prices[keep]
+        history.prices = self.prices[keep]
+        return history
+
+    def window(self, date_range: DateRange) -> slice:
+        """
+        slice of the points with `start <= timestamp <= end`, found by binary search
+        """
+        start, end = date_range
+        return slice(
+            int(np.searchsorted(self.timestamps, start, side="left")),
+            int(np.searchsorted(self.timestamps, end, side="right")),
+        )
+
+
+class TwapEngine:
+    """
+    computes TWAPs for many tokens and many date ranges out of one set of price
+    histories, without refetching or rescanning the full history per window
+
+    usage:
+        engine = TwapEngine.from_historical_prices(data["tokenGetHistoricalPrices"], chain)
+        weekly = engine.twaps(addresses, [(start, start + WEEK) for start in starts])
+    """
+
+    def __init__(
+        self,
+        histories: Dict[str, PriceHistory],
+        chain: str = None,
+        iqr_multiplier: float = 100_000.0,
+        exact: bool = False,
+    ):
+        """
+        params:
+        - histories: dict of address -> PriceHistory
+        - chain: chain of the histories, for error messages
+        - iqr_multiplier: see `filter_outliers_and_average_batch`
+        - exact: average the quoted prices in Decimal instead of float
+        """
+        self.histories = {address.lower(): h for address, h in histories.items()}
+        self.chain = chain
+        self.iqr_multiplier = iqr_multiplier
+        self.exact = exact
+
+    @classmethod
+    def from_historical_prices(
+        cls, token_prices: List[dict], chain: str, **kwargs
+    ) -> "TwapEngine":
+        """
+        params:
+        - token_prices: the `tokenGetHistoricalPrices` list of the api v3
+        - chain: only entries on this chain are kept
+        """
+        histories = {
+            entry["address"]: PriceHistory.from_api(entry["prices"])
+            for entry in token_prices
+            if entry["chain"].lower() == chain.lower()
+        }
+        return cls(histories, chain, **kwargs)
+
+    def _window(
+        self, address: str, date_range: DateRange
+    ) -> Tuple[PriceHistory, slice]:
+        history = self.histories.get(address.lower())
+        window = history.window(date_range) if history is not None else slice(0, 0)
+        if window.stop <= window.start:
+            raise NoPricesFoundError(
+                f"No prices found for {address} on {self.chain} between {date_range[0]} UTC and {date_range[1]} UTC"
+            )
+        return history, window
+
+    def twap(self, address: str, date_range: DateRange) -> TWAPResult:
+        """
+        raises:
+        - NoPricesFoundError when the token has no price point inside `date_range`
+        """
+        return self.twaps([address], [date_range])[tuple(date_range)][0]
+
+    def twaps(
+        self, addresses: Sequence[str], date_ranges: Sequence[DateRange]
+    ) -> Dict[DateRange, List[TWAPResult]]:
+        """
+        twap of every address over every date range; all windows are filtered and
+        averaged in one batched pass
+
+        returns:
+        - dict of date_range -> TWAPResults in the order of `addresses`
+        """
+        if not addresses:
+            return {tuple(date_range): [] for date_range in date_ranges}
+        windows = [
+            self._window(address, date_range)
+            for date_range in date_ranges
+            for address in addresses
+        ]
+        lengths = [window.stop - window.start for _, window in windows]
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        values = np.concatenate([history.prices[window] for history, window in windows])
+        raw_values = None
+        if self.exact:
+            raw_values = np.concatenate(
+                [history.raw_prices[window] for history, window in windows]
+            )
+        averages = filter_outliers_and_average_batch(
+            values, offsets, self.iqr_multiplier, raw_values=raw_values
+        )
+
+        results = {}
+        for i, (history, window) in enumerate(windows):
+            date_range = tuple(date_ranges[i // len(addresses)])
+            address = addresses[i % len(addresses)]
+            if lengths[i] == 1:
+                # a single point is returned as quoted
+                twap_price = Decimal(history.raw_prices[window.start])
+            elif self.exact:
+                twap_price = averages[i]
+            else:
+                twap_price = Decimal(str(averages[i]))
+            results.setdefault(date_range, []).append(
+                TWAPResult(address=address, twap_price=twap_price)
+            )
+        return results
+
+
+def to_padded(values: np.ndarray, offsets: Sequence[int]) -> np.ndarray:
+    """
+    turn ragged series, concatenated in `values` with series `i` spanning
+    `values[offsets[i]:offsets[i + 1]]`, into a nan padded 2-D array
+    """
+    values = np.asarray(values, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    padded = np.full((len(lengths), lengths.max(initial=0)), np.nan)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    cols = np.arange(len(values)) - np.repeat(offsets[:-1], lengths)
+    padded[rows, cols] = values[offsets[0] : offsets[-1]]
+    return padded
+
+
+def filter_outliers_and_average_batch(
+    values: np.ndarray,
+    offsets: Sequence[int] = None,
+    iqr_multiplier: float = 100_000.0,
+    raw_values: Sequence = None,
+) -> Union[np.ndarray, List[Decimal]]:
+    """
+    batched `Subgraph.filter_outliers_and_average`: per-series iqr bounds for many
+    series in one numpy pass, then their filtered means or median fallbacks
+
+    params:
+    - values: 2-D array with one series per row (nan padded), or the concatenated
+      series when `offsets` is given
+    - offsets: csr style offsets of the series in `values`, of length n_series + 1
+    - iqr_multiplier: points outside `iqr_multiplier` times the interquartile range
+      are dropped
+    - raw_values: exact values (eg price strings) aligned with a 1-D `values`; when
+      given, the final means are computed in Decimal from them
+
+    returns:
+    - float array of one average per series (nan for an empty series), or a list of
+      Decimals when `raw_values` is given
+    """
+    if offsets is None:
+        padded = np.atleast_2d(np.asarray(values, dtype=np.float64))
+    else:
+        padded = to_padded(values, offsets)
+    counts = np.sum(~np.isnan(padded), axis=1)
+    averages = np.full(len(padded), np.nan)
+    rows = counts > 0
+    if not rows.any():
+        return averages if raw_values is None else [None] * len(padded)
+    series = padded[rows]
+
+    q1, q3 = np.nanpercentile(series, [25, 75], axis=1)
+    iqr = q3 - q1
+    lower = (q1 - iqr_multiplier * iqr)[:, None]
+    upper = (q3 + iqr_multiplier * iqr)[:, None]
+    # nan padding compares false and is never kept
+    keep = (series >= lower) & (series <= upper)
+    # the means are taken row by row with `np.mean`, whose pairwise summation
+    # depends on the number of points summed, so they match `filtered_mean` exactly
+    averages[rows] = [
+        np.mean(row[mask]) if mask.any() else np.median(row[~np.isnan(row)])
+        for row, mask in zip(series, keep)
+    ]
+
+    if raw_values is None:
+        return averages
+    return _exact_averages(raw_values, offsets, keep, rows, averages)
+
+
+def _exact_averages(raw_values, offsets, keep, rows, averages) -> List[Decimal]:
+    if offsets is None:
+        raise ValueError("raw_values require csr offsets")
+    results: List[Decimal] = []
+    kept_rows = iter(keep)
+    for i, has_values in enumerate(rows):
+        if not has_values:
+            results.append(None)
+            continue
+        mask = next(kept_rows)
+        raw = raw_values[offsets[i] : offsets[i + 1]]
+        kept = [Decimal(str(v)) for v, k in zip(raw, mask) if k]
+        if kept:
+            results.append(sum(kept) / len(kept))
+        else:
+            # the median of the floats, as in the float path
+            results.append(Decimal(str(averages[i])))
+    return results
+
+
+def filtered_mean(arr: np.ndarray, iqr_multiplier: float = 100_000.0) -> Decimal:
+    """
+    mean of `arr` after dropping points outside `iqr_multiplier` times the
+    interquartile range; falls back on the median when every point is dropped
+    """
+    q1, q3 = np.percentile(arr, [25, 75])
+    iqr = q3 - q1
+    filtered = arr[
+        (arr >= q1 - iqr_multiplier * iqr) & (arr <= q3 + iqr_multiplier * iqr)
+    ]
+    return Decimal(str(np.mean(filtered) if len(filtered) > 0 else np.median(arr)))
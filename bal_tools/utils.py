@@ -2,13 +2,42 @@ from web3 import Web3
 from typing import Union, List, Dict
 import json
 from importlib.resources import files
+from threading import Lock
 
 import requests
 
+from .cache import load_registry
 
-CHAINS = requests.get(
-    "https://raw.githubusercontent.com/BalancerMaxis/bal_addresses/refs/heads/main/extras/chains.json"
-).json()
+
+CHAINS_URL = "https://raw.githubusercontent.com/BalancerMaxis/bal_addresses/refs/heads/main/extras/chains.json"
+_chains = None
+_chains_lock = Lock()
+
+
+def _fetch_chains() -> Dict:
+    response = requests.get(CHAINS_URL, timeout=10)
+    response.raise_for_status()
+    return response.json()
+
+
+def get_chains() -> Dict:
+    """
+    chains.json from bal_addresses; resolved on first use from the on-disk cache,
+    the network or the bundled snapshot (see `cache.load_registry`)
+    """
+    global _chains
+    if _chains is None:
+        with _chains_lock:
+            if _chains is None:
+                _chains = load_registry("chains.json", _fetch_chains)
+    return _chains
+
+
+def __getattr__(name):
+    # keep `utils.CHAINS` importable without fetching at import time
+    if name == "CHAINS":
+        return get_chains()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 ### These functions are to deal with differing web3 versions and the need to use 5.x for legacy brownie code
@@ -43,12 +72,12 @@ def flatten_nested_dict(d):
 
 
 def chain_ids_by_name():
-    return CHAINS["CHAIN_IDS_BY_NAME"]
+    return get_chains()["CHAIN_IDS_BY_NAME"]
 
 
 def chain_names_prod():
-    return CHAINS["BALANCER_PRODUCTION_CHAINS"]
+    return get_chains()["BALANCER_PRODUCTION_CHAINS"]
 
 
 def chain_names_prod_v3():
-    return CHAINS["BALANCER_PRODUCTION_CHAINS_V3"]
+    return get_chains()["BALANCER_PRODUCTION_CHAINS_V3"]
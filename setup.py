@@ -16,6 +16,7 @@ setup(
     package_data={
         "bal_tools": [
             "abi/*.json",
+            "misc/*.json",
             "graphql/**/*.gql",
             "safe_tx_builder/templates/*.json",
         ]
@@ -29,7 +30,7 @@ setup(
         "pandas",
         "dotmap",
         "munch==4.0.0",
-        "gql[requests]",
+        "gql[requests,aiohttp]",
         "pydantic",
         "json-fix",
         "lxml",
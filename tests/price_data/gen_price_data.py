@@ -18,13 +18,15 @@ def gen_price_data_for_date_range(date_range: tuple[int, int]):
     subgraph = Subgraph()
     mainnet_core_pools = BalPoolsGauges().core_pools
 
+    prices_by_pool = subgraph.get_twap_prices_for_pools(
+        pool_ids=[pool_id for pool_id, _ in mainnet_core_pools],
+        chain=GqlChain.MAINNET,
+        date_range=date_range,
+    )
+
     pool_prices = {}
     for pool_id, symbol in mainnet_core_pools:
-        prices = subgraph.get_twap_price_pool(
-            pool_id=pool_id,
-            chain=GqlChain.MAINNET,
-            date_range=date_range,
-        )
+        prices = prices_by_pool[pool_id]
         # cant json serialize Decimal objects
         pool_prices[symbol] = {
             "bpt_price": float(prices.bpt_price.twap_price),
@@ -9,7 +9,7 @@ def test_503_retry():
     """Test 503 retry recovers after failures"""
     subgraph = Subgraph("mainnet")
 
-    with patch("bal_tools.subgraph.RequestsHTTPTransport"):
+    with patch("bal_tools.subgraph.PooledRequestsHTTPTransport"):
         with patch("bal_tools.subgraph.Client") as mock_client:
             with patch("time.sleep"):
                 mock_instance = Mock()
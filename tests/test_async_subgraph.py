@@ -0,0 +1,149 @@
+import asyncio
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+import pytest
+from aiohttp import web
+
+from bal_tools.async_subgraph import AsyncSubgraph
+from bal_tools.ratelimit import RATE_LIMITERS
+
+
+async def _serve(handler):
+    app = web.Application()
+    app.router.add_post("/graphql", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/graphql"
+
+
+def test_fetch_graphql_data_bounded_concurrency():
+    state = {"in_flight": 0, "max_in_flight": 0, "calls": 0}
+
+    async def handler(request):
+        body = await request.json()
+        state["calls"] += 1
+        state["in_flight"] += 1
+        state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+        await asyncio.sleep(0.01)
+        state["in_flight"] -= 1
+        return web.json_response({"data": {"echo": body["variables"]["n"]}})
+
+    async def main():
+        runner, url = await _serve(handler)
+        try:
+            async with AsyncSubgraph(max_concurrency_per_host=3) as subgraph:
+                return await asyncio.gather(
+                    *[
+                        subgraph.fetch_graphql_data(
+                            "core", "query Q($n: Int) { echo }", {"n": n}, url=url
+                        )
+                        for n in range(20)
+                    ]
+                )
+        finally:
+            await runner.cleanup()
+
+    results = asyncio.run(main())
+    assert [r["echo"] for r in results] == list(range(20))
+    assert state["calls"] == 20
+    assert state["max_in_flight"] <= 3
+
+
+def test_fetch_graphql_data_retries_server_errors(monkeypatch):
+    state = {"calls": 0}
+
+    async def handler(request):
+        state["calls"] += 1
+        if state["calls"] < 3:
+            return web.Response(status=503, text="Service Unavailable")
+        return web.json_response({"data": {"ok": True}})
+
+    async def no_sleep(_):
+        pass
+
+    async def main():
+        runner, url = await _serve(handler)
+        monkeypatch.setattr("bal_tools.async_subgraph.asyncio.sleep", no_sleep)
+        try:
+            async with AsyncSubgraph() as subgraph:
+                return await subgraph.fetch_graphql_data("core", "{ ok }", url=url)
+        finally:
+            await runner.cleanup()
+
+    assert asyncio.run(main()) == {"ok": True}
+    assert state["calls"] == 3
+
+
+class GraphqlHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        payload = json.dumps({"data": {"ok": True}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def test_sessions_follow_the_event_loop():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GraphqlHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/graphql"
+    subgraph = AsyncSubgraph()
+    try:
+        # a long lived client serving several `asyncio.run` calls, as
+        # `BalPoolsGauges.async_subgraph` does; each run closes its sessions
+        for _ in range(2):
+            opened = []
+
+            async def fetch():
+                result = await subgraph.fetch_graphql_data("core", "{ ok }", url=url)
+                opened.extend(
+                    client for client, _ in (await subgraph._loop_sessions()).values()
+                )
+                return result
+
+            assert asyncio.run(fetch()) == {"ok": True}
+            assert not subgraph._sessions and not subgraph._closers
+            assert [client.transport.session for client in opened] == [None]
+
+        async def closed():
+            await subgraph.fetch_graphql_data("core", "{ ok }", url=url)
+            await subgraph.aclose()
+            assert not subgraph._sessions
+
+        asyncio.run(closed())
+        assert not subgraph._sessions
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_requests_per_second_is_private():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GraphqlHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/graphql"
+    shared_rate = RATE_LIMITERS.get(url).rate
+    subgraph = AsyncSubgraph(requests_per_second=1000)
+
+    async def fetch():
+        async with subgraph:
+            return await subgraph.fetch_graphql_data("core", "{ ok }", url=url)
+
+    try:
+        assert asyncio.run(fetch()) == {"ok": True}
+        assert subgraph.rate_limiters.get(url).rate == 1000
+        assert RATE_LIMITERS.get(url).rate == shared_rate
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,41 @@
+import pytest
+
+from bal_tools import cache
+from bal_tools.utils import chain_ids_by_name
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", tmp_path)
+    return tmp_path
+
+
+def test_load_registry_writes_through(cache_dir):
+    data = cache.load_registry("chains.json", lambda: {"a": 1})
+    assert data == {"a": 1}
+    assert (cache_dir / "chains.json").exists()
+
+    # fresh cache is served without calling fetch again
+    def fail():
+        raise AssertionError("fetch should not be called")
+
+    assert cache.load_registry("chains.json", fail) == {"a": 1}
+
+
+def test_load_registry_falls_back_to_bundled_snapshot(cache_dir, monkeypatch):
+    monkeypatch.setenv("BAL_TOOLS_OFFLINE", "1")
+    data = cache.load_registry("chains.json", lambda: {"a": 1})
+    assert data["CHAIN_IDS_BY_NAME"]["mainnet"] == 1
+
+
+def test_load_registry_prefers_stale_cache_over_snapshot(cache_dir):
+    cache.write_json_cache("chains.json", {"stale": True})
+
+    def fail():
+        raise ConnectionError("offline")
+
+    assert cache.load_registry("chains.json", fail, ttl=-1) == {"stale": True}
+
+
+def test_chain_ids_available_without_network():
+    assert chain_ids_by_name()["mainnet"] == 1
@@ -1,5 +1,12 @@
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
 import pytest
 from bal_tools.drpc import Web3RpcByChain, Web3Rpc
+from bal_tools.errors import AllEndpointsFailedError
+from bal_tools.response_cache import MemoryResponseCache, SQLiteResponseCache
 from tests.conftest import chains
 
 
@@ -26,3 +33,259 @@ def test_drpc_by_chain_dot_syntax(DRPC_KEY):
     assert w3_by_chain.mainnet.eth
     assert w3_by_chain.arbitrum.eth
     assert list(w3_by_chain.keys()) == ["mainnet", "arbitrum"]
+
+
+class JsonRpcHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _answer(self, request):
+        node = self.server.node
+        node["requests"].append(request["method"])
+        if request["method"] == "eth_blockNumber":
+            result = hex(node["head"])
+        elif request["method"] == "eth_chainId":
+            result = "0x1"
+        elif request["method"] == "eth_call":
+            error = {"code": 3, "message": "execution reverted"}
+            return {"jsonrpc": "2.0", "id": request["id"], "error": error}
+        elif request["method"] == "eth_getBalance":
+            result = hex(node["balance"])
+        elif request["method"] == "eth_getBlockByNumber":
+            number = int(request["params"][0], 16)
+            result = None
+            if number <= node["head"]:
+                result = {"number": hex(number), "timestamp": hex(12 * number)}
+        else:
+            result = None
+        return {"jsonrpc": "2.0", "id": request["id"], "result": result}
+
+    def do_POST(self):
+        node = self.server.node
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(node["delay"])
+        if node["status"] != 200:
+            self.send_response(node["status"])
+            self.end_headers()
+            return
+        if isinstance(body, list):
+            response = [self._answer(request) for request in body]
+        else:
+            response = self._answer(body)
+        payload = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+@pytest.fixture
+def rpc_nodes():
+    """
+    factory of local stand-in json-rpc nodes; tweak their `head`, `balance`,
+    `delay` and `status`
+    """
+    servers = []
+
+    def start():
+        server = ThreadingHTTPServer(("127.0.0.1", 0), JsonRpcHandler)
+        server.daemon_threads = True
+        server.node = {
+            "head": 100,
+            "balance": 1,
+            "delay": 0,
+            "status": 200,
+            "requests": [],
+        }
+        server.node["url"] = f"http://127.0.0.1:{server.server_address[1]}"
+        Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        servers.append(server)
+        return server.node
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def rpc_node(rpc_nodes):
+    return rpc_nodes()
+
+
+def test_lazy_web3rpc(rpc_node):
+    rpc = Web3Rpc("mainnet", "key", lazy=True, endpoint_uri=rpc_node["url"])
+    assert rpc_node["requests"] == []
+    # the health check on first use primes the head cache
+    assert rpc.eth.block_number == 100
+    assert rpc_node["requests"] == ["eth_blockNumber"]
+
+
+def test_lazy_web3rpc_check_fails(rpc_node):
+    rpc_node["status"] = 404
+    rpc = Web3Rpc("mainnet", "key", lazy=True, endpoint_uri=rpc_node["url"])
+    with pytest.raises(ConnectionError):
+        rpc.eth
+
+
+def test_chain_head_cache(rpc_node):
+    rpc = Web3Rpc("mainnet", "key", head_ttl=0.2, endpoint_uri=rpc_node["url"])
+    rpc_node["head"] = 101
+    assert [rpc.eth.block_number for _ in range(5)] == [100] * 5
+    time.sleep(0.25)
+    assert rpc.eth.block_number == 101
+    assert rpc_node["requests"] == ["eth_blockNumber"] * 2
+
+    uncached = Web3Rpc("mainnet", "key", head_ttl=0, endpoint_uri=rpc_node["url"])
+    uncached.eth.block_number
+    assert rpc_node["requests"] == ["eth_blockNumber"] * 4
+
+
+def test_prewarm(rpc_node):
+    rpc_node["delay"] = 0.2
+    chains = ["mainnet", "arbitrum", "base", "gnosis"]
+    w3_by_chain = Web3RpcByChain(
+        "key", lazy=True, endpoints={chain: rpc_node["url"] for chain in chains}
+    )
+    start = time.monotonic()
+    warmed = w3_by_chain.prewarm(chains)
+    # the checks run concurrently
+    assert time.monotonic() - start < 0.6
+    assert warmed.ok and sorted(w3_by_chain.keys()) == sorted(warmed.results)
+    assert w3_by_chain["mainnet"] is warmed.results["mainnet"]
+    assert w3_by_chain.mainnet.eth.block_number == 100
+    assert len(rpc_node["requests"]) == 4
+
+
+def pool(nodes, **kwargs) -> Web3Rpc:
+    return Web3Rpc(
+        "mainnet",
+        "key",
+        lazy=True,
+        head_ttl=0,
+        endpoint_uri=[node["url"] for node in nodes],
+        **kwargs,
+    )
+
+
+def test_pool_routes_to_fastest(rpc_nodes):
+    slow, fast = rpc_nodes(), rpc_nodes()
+    slow["delay"] = 0.05
+    rpc = pool([slow, fast], hedge_delay=None)
+    for _ in range(20):
+        assert rpc.w3.eth.block_number == 100
+    # each endpoint is tried once, then the fast one takes the traffic
+    assert len(slow["requests"]) == 1
+    assert len(fast["requests"]) == 19
+    assert rpc.w3.provider.endpoint_uri == fast["url"]
+
+
+def test_pool_fails_over(rpc_nodes):
+    down, up = rpc_nodes(), rpc_nodes()
+    down["status"] = 503
+    rpc = pool([down, up])
+    start = time.monotonic()
+    assert [rpc.w3.eth.block_number for _ in range(5)] == [100] * 5
+    assert time.monotonic() - start < 1
+    # the failing endpoint cools down instead of being retried
+    assert len(down["requests"]) == 0 and len(up["requests"]) == 5
+    stats = {s["uri"]: s for s in rpc.w3.provider.stats()}
+    assert stats[down["url"]]["failures"] == 1
+    assert not stats[down["url"]]["available"]
+
+    up["status"] = 503
+    with pytest.raises(AllEndpointsFailedError):
+        rpc.w3.eth.get_balance("0x" + "1" * 40)
+
+
+def test_pool_hedges_slow_reads(rpc_nodes):
+    stuck, fast = rpc_nodes(), rpc_nodes()
+    stuck["delay"] = 2
+    rpc = pool([stuck, fast], hedge_delay=0.05)
+    start = time.monotonic()
+    assert rpc.w3.eth.block_number == 100
+    assert time.monotonic() - start < 1
+    assert rpc.w3.provider.endpoint_uri == fast["url"]
+
+
+def test_pool_rpc_errors_are_answers(rpc_nodes):
+    first, second = rpc_nodes(), rpc_nodes()
+    rpc = pool([first, second], hedge_delay=None)
+    with pytest.raises(Exception, match="execution reverted"):
+        rpc.w3.eth.call({"to": "0x" + "1" * 40, "data": "0x"})
+    assert (first["requests"] + second["requests"]).count("eth_call") == 1
+    assert all(s["failures"] == 0 for s in rpc.w3.provider.stats())
+
+
+ADDRESS = "0x" + "1" * 40
+
+
+def test_call_cache_final_reads(rpc_node):
+    rpc = Web3Rpc(
+        "mainnet", "key", endpoint_uri=rpc_node["url"], call_cache=MemoryResponseCache()
+    )
+    rpc_node["requests"].clear()
+    # block 10 is more than `finality_depth` (64) behind the head of 100
+    assert [rpc.eth.get_balance(ADDRESS, 10) for _ in range(3)] == [1] * 3
+    assert [rpc.eth.get_block(10)["timestamp"] for _ in range(3)] == [120] * 3
+    assert rpc_node["requests"] == ["eth_getBalance", "eth_getBlockByNumber"]
+
+    # recent blocks, block tags and missing blocks still go to the node
+    rpc_node["requests"].clear()
+    for _ in range(2):
+        rpc.eth.get_balance(ADDRESS, 90)
+        rpc.eth.get_balance(ADDRESS)
+        with pytest.raises(Exception):
+            rpc.eth.get_block(1000)
+    assert rpc_node["requests"].count("eth_getBalance") == 4
+    assert rpc_node["requests"].count("eth_getBlockByNumber") == 2
+
+    uncached = Web3Rpc(
+        "mainnet", "key", endpoint_uri=rpc_node["url"], cache_calls=False
+    )
+    rpc_node["requests"].clear()
+    uncached.eth.get_balance(ADDRESS, 10)
+    assert rpc_node["requests"] == ["eth_getBalance"]
+
+    # block 10 is not final yet on polygon
+    polygon = Web3Rpc(
+        "polygon", "key", endpoint_uri=rpc_node["url"], call_cache=MemoryResponseCache()
+    )
+    assert polygon.call_cache.finality_depth == 256
+    rpc_node["requests"].clear()
+    for _ in range(2):
+        polygon.eth.get_balance(ADDRESS, 10)
+    assert rpc_node["requests"].count("eth_getBalance") == 2
+
+
+def test_call_cache_persists(rpc_nodes, tmp_path):
+    first, second = rpc_nodes(), rpc_nodes()
+    path = tmp_path / "rpc.sqlite"
+    rpc = pool([first, second], call_cache=SQLiteResponseCache(path))
+    assert rpc.eth.get_balance(ADDRESS, 10) == 1
+    # reverts are answers, but never cached
+    for _ in range(2):
+        with pytest.raises(Exception, match="execution reverted"):
+            rpc.eth.call({"to": ADDRESS, "data": "0x"}, 10)
+    assert (first["requests"] + second["requests"]).count("eth_call") == 2
+
+    first["requests"].clear()
+    second["requests"].clear()
+    restarted = Web3Rpc(
+        "mainnet",
+        "key",
+        endpoint_uri=first["url"],
+        call_cache=SQLiteResponseCache(path),
+    )
+    assert restarted.eth.get_balance(ADDRESS, 10) == 1
+    assert "eth_getBalance" not in first["requests"] + second["requests"]
+    # keys include the chain
+    other_chain = Web3Rpc(
+        "arbitrum",
+        "key",
+        endpoint_uri=first["url"],
+        call_cache=SQLiteResponseCache(path),
+    )
+    other_chain.eth.get_balance(ADDRESS, 10)
+    assert first["requests"].count("eth_getBalance") == 1
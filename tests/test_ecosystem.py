@@ -1,4 +1,17 @@
-from bal_tools.ecosystem import StakeDAO
+import json
+
+import pytest
+
+from bal_tools.cache import write_json_cache
+from bal_tools.ecosystem import (
+    Aura,
+    StakeDAO,
+    aura_snapshot_file,
+    load_aura_gauge_mappings_by_chain,
+)
+from bal_tools.errors import MultipleMatchesError
+from bal_tools.subgraph import Subgraph
+from bal_tools.utils import to_checksum_address
 
 
 def test_calculate_dynamic_min_incentive():
@@ -7,3 +20,76 @@ def test_calculate_dynamic_min_incentive():
 
     assert isinstance(result, int)
     assert result > 0
+
+
+def aura_gauges(pids_by_gauge):
+    return [
+        {"id": gauge, "pool": {"id": pid, "gauge": {"id": gauge}}}
+        for gauge, pid in pids_by_gauge.items()
+    ]
+
+
+def test_aura_mapping_snapshot(monkeypatch, tmp_path):
+    monkeypatch.setattr("bal_tools.cache.CACHE_DIR", tmp_path)
+    gauges = {"0x" + "1" * 40: "1", "0x" + "2" * 40: "2"}
+    changed_at = {"0x" + "1" * 40: 100, "0x" + "2" * 40: 100}
+    head = [150]
+    requests = []
+
+    def fetch(self, subgraph, query, params=None, url=None):
+        requests.append(params)
+        rows = [
+            g
+            for g in aura_gauges(gauges)
+            if g["id"] > params["id_gt"] and changed_at[g["id"]] >= params["since"]
+        ]
+        return {"_meta": {"block": {"number": head[0]}}, "gauges": rows}
+
+    monkeypatch.setattr(Subgraph, "fetch_graphql_data", fetch)
+    aura = Aura("mainnet")
+    assert aura.get_aura_pid_from_gauge("0x" + "1" * 40) == "1"
+    assert requests[-1]["since"] == 0
+
+    # a fresh snapshot is used as is
+    Aura("mainnet").aura_pids_by_address
+    assert len(requests) == 1
+
+    # an outdated one only pulls the gauges added since its block
+    gauges["0x" + "3" * 40] = "3"
+    changed_at["0x" + "3" * 40] = 200
+    head[0] = 250
+    aura.refresh()
+    assert requests[-1]["since"] == 150
+    assert len(aura.aura_pids_by_address) == 3
+
+    snapshot = json.loads((tmp_path / aura_snapshot_file("mainnet")).read_text())
+    assert snapshot["block"] == 250
+    assert len(snapshot["mappings"]) == 3
+
+    by_chain = load_aura_gauge_mappings_by_chain(["mainnet"], max_age=3600)
+    assert by_chain.ok and by_chain.results["mainnet"] == snapshot["mappings"]
+    assert len(requests) == 2
+
+
+def test_aura_mapping_snapshot_pid_conflict(monkeypatch, tmp_path):
+    monkeypatch.setattr("bal_tools.cache.CACHE_DIR", tmp_path)
+    gauge = to_checksum_address("0x" + "1" * 40)
+    write_json_cache(
+        aura_snapshot_file("mainnet"),
+        {"block": 1, "fetched_at": 0, "mappings": {gauge: "1"}},
+    )
+    rows = aura_gauges({gauge: "9"})
+
+    def fetch(self, subgraph, query, params=None, url=None):
+        return {"_meta": {"block": {"number": 2}}, "gauges": rows}
+
+    monkeypatch.setattr(Subgraph, "fetch_graphql_data", fetch)
+    # a gauge re-added under a new pool takes the new PID
+    assert Aura("mainnet", lazy=True).load_aura_gauge_mappings() == {gauge: "9"}
+    snapshot = json.loads((tmp_path / aura_snapshot_file("mainnet")).read_text())
+    assert snapshot["block"] == 2 and snapshot["mappings"] == {gauge: "9"}
+
+    # the same gauge twice in one fetch is ambiguous
+    rows.append(dict(rows[0], pool={"id": "10", "gauge": {"id": gauge}}))
+    with pytest.raises(MultipleMatchesError):
+        Aura("mainnet", lazy=True).load_aura_gauge_mappings(max_age=0)
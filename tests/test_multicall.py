@@ -0,0 +1,126 @@
+import pytest
+from eth_abi import decode, encode
+from web3 import Web3
+from web3.providers import JSONBaseProvider
+
+from bal_tools.drpc import Web3Rpc
+from bal_tools.errors import MulticallFailedError
+from bal_tools.multicall import MULTICALL3_ADDRESS, decode_call_output, multicall
+from bal_tools.utils import get_abi
+
+TOKEN = "0x" + "1" * 40
+BROKEN = "0x" + "2" * 40
+BALANCE_OF = bytes.fromhex("70a08231")
+TOTAL_SUPPLY = bytes.fromhex("18160ddd")
+
+
+class FakeChainProvider(JSONBaseProvider):
+    """
+    answers Multicall3 `aggregate3` over an erc20 at TOKEN where every holder owns
+    its address as uint, and `eth_getBlockByNumber`
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.requests = []
+
+    def _result(self, method, params):
+        if method == "eth_call":
+            assert params[0]["to"].lower() == MULTICALL3_ADDRESS.lower()
+            data = bytes.fromhex(params[0]["data"][2:])
+            (calls,) = decode(["(address,bool,bytes)[]"], data[4:])
+            results = []
+            for target, _, call_data in calls:
+                if target.lower() != TOKEN:
+                    results.append((False, b""))
+                elif call_data[:4] == TOTAL_SUPPLY:
+                    results.append((True, encode(["uint256"], [10**24])))
+                else:
+                    (holder,) = decode(["address"], call_data[4:])
+                    results.append((True, encode(["uint256"], [int(holder, 16)])))
+            return "0x" + encode(["(bool,bytes)[]"], [results]).hex()
+        if method == "eth_chainId":
+            return "0x1"
+        if method == "eth_blockNumber":
+            return "0x10"
+        if method == "eth_getBlockByNumber":
+            number = int(params[0], 16)
+            return {"number": hex(number), "timestamp": hex(number * 12)}
+        raise NotImplementedError(method)
+
+    def make_request(self, method, params):
+        self.requests.append(method)
+        return {"jsonrpc": "2.0", "id": 1, "result": self._result(method, params)}
+
+    def make_batch_request(self, requests):
+        self.requests.append([method for method, _ in requests])
+        return [
+            {"jsonrpc": "2.0", "id": i, "result": self._result(method, params)}
+            for i, (method, params) in enumerate(requests)
+        ]
+
+
+@pytest.fixture
+def w3():
+    return Web3(FakeChainProvider())
+
+
+def test_multicall_chunks(w3):
+    token = w3.eth.contract(
+        address=Web3.to_checksum_address(TOKEN), abi=get_abi("ERC20")
+    )
+    holders = [Web3.to_checksum_address(f"0x{i:040x}") for i in range(1, 1001)]
+    calls = [token.functions.totalSupply()] + [
+        token.functions.balanceOf(holder) for holder in holders
+    ]
+    results = multicall(w3, calls, block_identifier=123, chunk_size=400)
+    assert results == [10**24] + list(range(1, 1001))
+    assert w3.provider.requests.count("eth_call") == 3
+
+
+def test_multicall_failures(w3):
+    broken = w3.eth.contract(
+        address=Web3.to_checksum_address(BROKEN), abi=get_abi("ERC20")
+    )
+    calls = [broken.functions.totalSupply()]
+    assert multicall(w3, calls, allow_failure=True) == [None]
+    with pytest.raises(MulticallFailedError):
+        multicall(w3, calls)
+
+
+def test_get_blocks_batched(w3):
+    rpc = Web3Rpc("mainnet", "key", lazy=True)
+    rpc.w3 = w3
+    blocks = rpc.get_blocks(list(range(1, 6)), chunk_size=2)
+    assert [b["timestamp"] for b in blocks] == [12, 24, 36, 48, 60]
+    assert [len(r) for r in w3.provider.requests[1:]] == [2, 2, 1]
+
+
+def test_decode_call_output_normalises_nested_addresses(w3):
+    abi = [
+        {
+            "type": "function",
+            "name": "holders",
+            "stateMutability": "view",
+            "inputs": [],
+            "outputs": [
+                {"name": "", "type": "address[]"},
+                {
+                    "name": "",
+                    "type": "tuple",
+                    "components": [
+                        {"name": "owner", "type": "address"},
+                        {"name": "amount", "type": "uint256"},
+                    ],
+                },
+            ],
+        }
+    ]
+    call = w3.eth.contract(address=Web3.to_checksum_address(TOKEN), abi=abi)
+    address = "0x" + "ab" * 20
+    data = encode(["address[]", "(address,uint256)"], [[address], (address, 1)])
+    checksummed = Web3.to_checksum_address(address)
+    assert decode_call_output(w3, call.functions.holders(), data) == [
+        [checksummed],
+        (checksummed, 1),
+    ]
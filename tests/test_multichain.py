@@ -0,0 +1,87 @@
+import asyncio
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+from bal_tools import multichain
+from bal_tools.multichain import MultiChainPoolsGauges
+from bal_tools.pools_gauges import BalPoolsGauges
+
+
+def test_multichain_shares_fetches_and_reports_errors(monkeypatch):
+    fetches = []
+    monkeypatch.setattr(
+        multichain, "get_vebal_voting_list", lambda: fetches.append("vebal") or []
+    )
+    monkeypatch.setattr(
+        multichain,
+        "fetch_cached_core_pools",
+        lambda: fetches.append("core") or {"mainnet": {"0xa": "A"}, "gnosis": {}},
+    )
+
+    def query_all_pools(self):
+        if self.chain == "gnosis":
+            raise ValueError("subgraph down")
+        return [self.chain]
+
+    async def query_all_pools_async(self):
+        return query_all_pools(self)
+
+    monkeypatch.setattr(BalPoolsGauges, "query_all_pools", query_all_pools)
+    monkeypatch.setattr(BalPoolsGauges, "query_all_pools_async", query_all_pools_async)
+
+    chains = MultiChainPoolsGauges(["mainnet", "gnosis", "arbitrum"], max_workers=2)
+    pools = chains.query_all_pools()
+    assert pools.results == {"mainnet": ["mainnet"], "arbitrum": ["arbitrum"]}
+    assert isinstance(pools.errors["gnosis"], ValueError)
+    assert not pools.ok
+
+    core_pools = chains.core_pools()
+    assert len(core_pools.results["mainnet"]) == 1
+    assert len(core_pools.results["arbitrum"]) == 0
+
+    pools = asyncio.run(chains.amap("query_all_pools_async"))
+    assert set(pools.results) == {"mainnet", "arbitrum"}
+    assert set(pools.errors) == {"gnosis"}
+
+    assert fetches == ["vebal", "core"]
+
+
+class GraphqlHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        payload = json.dumps({"data": {"ok": True}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def test_amap_closes_sessions(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GraphqlHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/graphql"
+    monkeypatch.setattr(multichain, "get_vebal_voting_list", lambda: [])
+    monkeypatch.setattr(multichain, "fetch_cached_core_pools", lambda: {})
+
+    async def ping_async(self):
+        return await self.async_subgraph.fetch_graphql_data("core", "{ ok }", url=url)
+
+    monkeypatch.setattr(BalPoolsGauges, "ping_async", ping_async, raising=False)
+    chains = MultiChainPoolsGauges(["mainnet", "arbitrum"])
+    try:
+        for _ in range(2):
+            results = asyncio.run(chains.amap("ping_async"))
+            assert results.ok and results.results["mainnet"] == {"ok": True}
+            assert all(
+                instance._async_subgraph is None
+                for instance in chains._instances.values()
+            )
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,187 @@
+import asyncio
+
+from bal_tools.pagination import paginate, apaginate, get_path
+from bal_tools.subgraph import Subgraph
+from bal_tools.ecosystem import Aura
+from bal_tools.pools_gauges import BalPoolsGauges
+from bal_tools.utils import to_checksum_address
+
+ENTITIES = [{"id": f"{i:04d}"} for i in range(25)]
+
+
+def fetch_page(cursor, first):
+    return [e for e in ENTITIES if e["id"] > cursor][:first]
+
+
+def test_paginate_all_pages():
+    pages = list(paginate(fetch_page, page_size=10))
+    assert [len(p) for p in pages] == [10, 10, 5]
+    assert [e for p in pages for e in p] == ENTITIES
+
+
+def test_paginate_limit():
+    pages = list(paginate(fetch_page, page_size=10, limit=12))
+    assert [len(p) for p in pages] == [10, 2]
+
+
+def test_apaginate():
+    async def afetch_page(cursor, first):
+        return fetch_page(cursor, first)
+
+    async def collect():
+        return [page async for page in apaginate(afetch_page, page_size=10)]
+
+    assert [e for p in asyncio.run(collect()) for e in p] == ENTITIES
+
+
+def test_get_path():
+    assert get_path({"pool": {"shares": [1]}}, ("pool", "shares")) == [1]
+    assert get_path({"pool": None}, ("pool", "shares")) == []
+
+
+def test_pool_snapshots_drain_timestamp_ties(monkeypatch):
+    # 3 snapshots per day over 4 days; page boundaries split days
+    snapshots = [
+        {
+            "id": f"0xpool{p}-{ts}",
+            "timestamp": ts,
+            "pool": {
+                "address": f"0xpool{p}",
+                "id": f"0xpool{p}",
+                "symbol": "X",
+                "totalProtocolFeePaidInBPT": "0",
+                "tokens": [],
+            },
+        }
+        for ts in (400, 300, 200, 100)
+        for p in range(3)
+    ]
+
+    def fetch(self, subgraph, query, params=None, url=None):
+        if query == "pool_snapshots":
+            rows = [
+                s
+                for s in snapshots
+                if s["timestamp"] < params.get("timestamp_lt", 1e18)
+            ]
+            return {"poolSnapshots": rows[: params["first"]]}
+        assert query == "pool_snapshots_at_timestamp"
+        rows = sorted(
+            (
+                s
+                for s in snapshots
+                if s["timestamp"] == params["timestamp"] and s["id"] > params["id_gt"]
+            ),
+            key=lambda s: s["id"],
+        )
+        return {"poolSnapshots": rows[: params["first"]]}
+
+    monkeypatch.setattr(Subgraph, "fetch_graphql_data", fetch)
+    result = Subgraph().get_balancer_pool_snapshots(
+        block=1, pools_per_req=4, limit=None
+    )
+    assert sorted((s.timestamp, s.id) for s in result) == sorted(
+        (s["timestamp"], s["pool"]["id"]) for s in snapshots
+    )
+
+    limited = Subgraph().get_balancer_pool_snapshots(block=1, pools_per_req=4, limit=5)
+    assert [s.timestamp for s in limited] == [400, 400, 400, 300, 300]
+
+
+def test_aura_pool_shares_paginated(monkeypatch, tmp_path):
+    monkeypatch.setattr("bal_tools.cache.CACHE_DIR", tmp_path)
+    gauges = {"0x" + "1" * 40: "1", "0x" + "2" * 40: "2"}
+    accounts = [
+        {
+            "id": f"{pid}-{i:04d}",
+            "staked": str(10**18),
+            "pool": {"id": pid},
+            "account": {"id": "0x" + f"{i:x}".rjust(40, "0")},
+        }
+        for pid in gauges.values()
+        for i in range(1, 1500)
+    ]
+
+    def fetch(self, subgraph, query, params=None, url=None):
+        if query == "get_aura_gauge_mappings":
+            return {
+                "gauges": [
+                    {"pool": {"id": pid, "gauge": {"id": gauge}}}
+                    for gauge, pid in gauges.items()
+                ]
+            }
+        rows = [a for a in accounts if a["id"] > params["id_gt"]]
+        if query == "get_aura_user_pool_balances":
+            rows = [a for a in rows if a["pool"]["id"] == params["poolId"]]
+            return {"leaderboard": {"accounts": rows[: params["first"]]}}
+        rows = [a for a in rows if a["pool"]["id"] in params["poolIds"]]
+        return {"poolAccounts": rows[: params["first"]]}
+
+    monkeypatch.setattr(Subgraph, "fetch_graphql_data", fetch)
+    aura = Aura("mainnet")
+    gauge = to_checksum_address("0x" + "1" * 40)
+
+    shares = aura.get_aura_pool_shares(gauge, 1)
+    assert len(shares) == 1499 and set(shares.values()) == {1.0}
+    assert [len(p) for p in aura.iter_aura_pool_shares(gauge, 1)] == [1000, 499]
+
+    by_gauge = aura.get_aura_pool_shares_for_gauges(list(gauges), 1)
+    assert {g: len(s) for g, s in by_gauge.items()} == {
+        to_checksum_address(g): 1499 for g in gauges
+    }
+
+
+def test_gauge_deposit_shares_for_gauges(monkeypatch):
+    gauges = [to_checksum_address("0x" + f"{g:x}" * 40) for g in range(1, 6)]
+    shares = [
+        {"id": f"{g}-{i:05d}", "balance": "1.5", "user": {"id": "0x" + "a" * 40}}
+        for g in gauges
+        for i in range(1200 if g == gauges[0] else 3)
+    ]
+    requests = []
+
+    def fetch(self, subgraph, query, params=None, url=None):
+        requests.append(params)
+        data = {}
+        i = 0
+        while f"key_{i}" in params:
+            rows = [
+                s
+                for s in shares
+                if s["id"].startswith(params[f"key_{i}"])
+                and s["id"] > params[f"id_gt_{i}"]
+            ]
+            data[f"q{i}"] = rows[: params["first"]]
+            i += 1
+        return data
+
+    monkeypatch.setattr(Subgraph, "fetch_graphql_data", fetch)
+    pools_gauges = BalPoolsGauges.__new__(BalPoolsGauges)
+    pools_gauges.subgraph = Subgraph()
+    result = pools_gauges.get_gauge_deposit_shares_for_gauges(gauges, 1, chunk_size=2)
+    assert set(result) == set(gauges)
+    # the same user holds every share, so one entry per gauge
+    assert all(len(users) == 1 for users in result.values())
+    # the second page of the large gauge rides along with the last chunk
+    assert len(requests) == 3
+    assert requests[-1]["key_1"] == gauges[0]
+    assert requests[-1]["id_gt_1"] == f"{gauges[0]}-00999"
+
+
+def test_lazy_aura(monkeypatch, tmp_path):
+    monkeypatch.setattr("bal_tools.cache.CACHE_DIR", tmp_path)
+    queries = []
+
+    def fetch(self, subgraph, query, params=None, url=None):
+        queries.append(query)
+        return {"gauges": [{"pool": {"id": "7", "gauge": {"id": "0x" + "1" * 40}}}]}
+
+    monkeypatch.setattr(Subgraph, "fetch_graphql_data", fetch)
+    aura = Aura("mainnet", lazy=True)
+    assert queries == []
+    assert aura.get_aura_pid_from_gauge("0x" + "1" * 40) == "7"
+    assert aura.get_aura_pid_from_gauge("0x" + "1" * 40) == "7"
+    assert queries == ["get_aura_gauge_mappings"]
+    aura.refresh()
+    aura.aura_pids_by_address
+    assert len(queries) == 2
@@ -1,7 +1,15 @@
 import pytest
+import responses
 from gql.transport.exceptions import TransportQueryError
 from bal_tools.models import PoolData, GaugeData
 from bal_tools.models import CorePools
+from bal_tools import pools_gauges
+from bal_tools.pools_gauges import (
+    BalPoolsGauges,
+    CorePoolsBuilder,
+    get_pools_tvl_by_chain,
+)
+from bal_tools.subgraph import Subgraph
 
 
 EXAMPLE_PREFERENTIAL_GAUGES = {
@@ -155,3 +163,216 @@ def test_query_all_gauges(bal_pools_gauges):
 
     if len(response) > 0:
         assert isinstance(response[0], GaugeData)
+
+
+def test_get_pools_tvl(bal_pools_gauges):
+    pool_ids = [
+        pool["id"]
+        for pool in bal_pools_gauges.vebal_voting_list
+        if pool["chain"].lower() == bal_pools_gauges.chain
+    ][:5]
+    if not pool_ids:
+        pytest.skip(f"No vebal pools on {bal_pools_gauges.chain}")
+
+    tvls = bal_pools_gauges.get_pools_tvl(pool_ids)
+
+    assert set(tvls) == set(pool_ids)
+    assert tvls[pool_ids[0]] == pytest.approx(
+        bal_pools_gauges.get_pool_tvl(pool_ids[0]), rel=0.05
+    )
+
+
+def test_get_pools_tvl_by_chain_chunks(monkeypatch):
+    requests = []
+
+    def fetch(self, subgraph, query, params=None, url=None):
+        requests.append(params)
+        return {
+            "poolGetPools": [
+                {"id": pool_id, "dynamicData": {"totalLiquidity": "1.5"}}
+                for pool_id in params["poolIds"]
+                if pool_id != "0xmissing"
+            ]
+        }
+
+    monkeypatch.setattr(Subgraph, "fetch_graphql_data", fetch)
+    tvls = get_pools_tvl_by_chain(
+        {"mainnet": ["0xa", "0xb", "0xc", "0xmissing"], "gnosis": ["0xa"]},
+        chunk_size=2,
+    )
+
+    assert tvls == {
+        "mainnet": {"0xa": 1.5, "0xb": 1.5, "0xc": 1.5, "0xmissing": 0},
+        "gnosis": {"0xa": 1.5},
+    }
+    assert len(requests) == 3
+
+
+def test_vebal_voting_list_shared_and_indexed(monkeypatch):
+    fetches = []
+    voting_list = [
+        {"id": "0xkilled", "gauge": {"isKilled": True}},
+        {"id": "0xreplaced", "gauge": {"isKilled": True}},
+        {"id": "0xreplaced", "gauge": {"isKilled": False}},
+        {"id": "0xalive", "gauge": {"isKilled": False}},
+    ]
+    monkeypatch.setattr(
+        pools_gauges,
+        "fetch_vebal_voting_list",
+        lambda: fetches.append(1) or voting_list,
+    )
+    monkeypatch.setattr(pools_gauges, "_vebal_voting_list", None)
+
+    mainnet = BalPoolsGauges("mainnet", core_pools_data={})
+    gnosis = BalPoolsGauges("gnosis", core_pools_data={})
+
+    assert len(fetches) == 1
+    assert mainnet.vebal_voting_list is gnosis.vebal_voting_list
+    assert mainnet.is_pool_on_vebal_list("0xalive")
+    assert mainnet.is_pool_on_vebal_list("0xreplaced")
+    assert not mainnet.is_pool_on_vebal_list("0xkilled")
+    assert not mainnet.is_pool_on_vebal_list("0xunknown")
+
+    pools_gauges.get_vebal_voting_list(force=True)
+    assert len(fetches) == 2
+
+
+def test_lazy_pools_gauges(monkeypatch):
+    fetches = []
+    monkeypatch.setattr(
+        pools_gauges,
+        "fetch_vebal_voting_list",
+        lambda: fetches.append("vebal")
+        or [{"id": "0xa", "gauge": {"isKilled": False}}],
+    )
+    monkeypatch.setattr(
+        pools_gauges,
+        "fetch_cached_core_pools",
+        lambda: fetches.append("core") or {"mainnet": {"0xa": "A"}},
+    )
+    monkeypatch.setattr(pools_gauges, "_vebal_voting_list", None)
+
+    lazy = BalPoolsGauges("mainnet", lazy=True)
+    assert fetches == []
+    assert lazy.is_core_pool("0xa")
+    assert fetches == ["core"]
+    assert lazy.is_pool_on_vebal_list("0xa")
+    assert fetches == ["core", "vebal"]
+
+    lazy.refresh()
+    assert fetches == ["core", "vebal"]
+    assert lazy.is_pool_on_vebal_list("0xa")
+    assert fetches == ["core", "vebal", "vebal"]
+
+    BalPoolsGauges("mainnet").refresh()
+    assert fetches == ["core", "vebal", "vebal", "core", "vebal", "core"]
+
+
+def core_pool_filters(pool_id, chain="MAINNET", recovery=False):
+    return {
+        "id": pool_id,
+        "chain": chain,
+        "symbol": pool_id.upper(),
+        "type": "WEIGHTED",
+        "tags": ["BOOSTED"],
+        "poolCreator": None,
+        "dynamicData": {"isInRecoveryMode": recovery},
+        "poolTokens": [],
+    }
+
+
+def test_core_pools_builder_incremental(monkeypatch, tmp_path):
+    monkeypatch.setattr("bal_tools.cache.CACHE_DIR", tmp_path)
+    alive = {"gauge": {"isKilled": False}}
+    voting_list = [{"id": i, **alive} for i in ("0xa", "0xb", "0xc")]
+    filters = {i: core_pool_filters(i) for i in ("0xa", "0xb", "0xc")}
+    # not boosted and without a rate provider
+    filters["0xc"]["tags"] = []
+    filters["0xc"]["poolTokens"] = [
+        {"priceRateProviderData": None, "isExemptFromProtocolYieldFee": False}
+    ]
+    configs = {
+        "core_pools_whitelist.json": {"gnosis": {"0xw": "W"}},
+        "core_pools_blacklist.json": {},
+    }
+    queries = []
+    evaluated = []
+    is_core_pool_candidate = pools_gauges.is_core_pool_candidate
+
+    def fetch_core_pool_candidates(self, ids, query="get_core_pools_filters"):
+        queries.append(query)
+        return [filters[i] for i in ids if i in filters]
+
+    monkeypatch.setattr(pools_gauges, "get_vebal_voting_list", lambda: voting_list)
+    monkeypatch.setattr(pools_gauges, "fetch_core_pools_config", configs.get)
+    monkeypatch.setattr(
+        pools_gauges,
+        "is_core_pool_candidate",
+        lambda pool: evaluated.append(pool["id"]) or is_core_pool_candidate(pool),
+    )
+    monkeypatch.setattr(
+        BalPoolsGauges, "fetch_core_pool_candidates", fetch_core_pool_candidates
+    )
+    pools = BalPoolsGauges(
+        "mainnet", vebal_voting_list=voting_list, core_pools_data={}, lazy=True
+    )
+
+    diff = CorePoolsBuilder(pools, "core_pools_state.json").update()
+    assert diff.added["mainnet"] == {"0xa": "0XA", "0xb": "0XB"}
+    assert diff.added["gnosis"] == {"0xw": "W"}
+    assert sorted(evaluated) == ["0xa", "0xb", "0xc"]
+    assert queries == ["get_core_pools_listing"]
+
+    # state is reloaded from disk; only the changed pool is re-evaluated
+    filters["0xb"] = core_pool_filters("0xb", recovery=True)
+    filters["0xa"]["symbol"] = "A-RENAMED"
+    builder = CorePoolsBuilder(pools, "core_pools_state.json")
+    diff = builder.update()
+    assert evaluated[3:] == ["0xb"]
+    assert diff.removed["mainnet"] == {"0xb": "0XB"}
+    assert not any(diff.added.values())
+    # display fields of reused pools follow the listing
+    assert builder.core_pools["mainnet"] == {"0xa": "A-RENAMED"}
+
+    # a rate provider added to a token is a filter input change
+    filters["0xc"]["poolTokens"][0]["priceRateProviderData"] = {"address": "0x1"}
+    diff = builder.update()
+    assert evaluated[4:] == ["0xc"]
+    assert diff.added["mainnet"] == {"0xc": "0XC"}
+
+    assert not builder.update().changed
+    assert len(evaluated) == 5
+    builder.update(full=True)
+    assert sorted(evaluated[5:]) == ["0xa", "0xb", "0xc"]
+    assert set(queries) == {"get_core_pools_listing"}
+
+
+def test_fetch_core_pool_candidates_chunks(monkeypatch):
+    requests = []
+
+    def fetch(self, subgraph, query, params=None, url=None):
+        requests.append(params["where"]["idIn"])
+        return {"poolGetPools": [{"id": i} for i in params["where"]["idIn"]]}
+
+    monkeypatch.setattr(Subgraph, "fetch_graphql_data", fetch)
+    pools = BalPoolsGauges(
+        "mainnet", vebal_voting_list=[], core_pools_data={}, lazy=True
+    )
+    result = pools.fetch_core_pool_candidates([f"0x{i}" for i in range(5)], 2)
+    assert len(result) == 5
+    assert [len(r) for r in requests] == [2, 2, 1]
+
+
+@responses.activate
+def test_fetch_core_pools_config_etag():
+    url = f"{pools_gauges.GITHUB_RAW_CONFIG}/core_pools_whitelist.json"
+    responses.add(responses.GET, url, json={"mainnet": {}}, headers={"ETag": '"v1"'})
+    responses.add(responses.GET, url, status=304)
+
+    assert pools_gauges.fetch_core_pools_config("core_pools_whitelist.json") == {
+        "mainnet": {}
+    }
+    assert pools_gauges.fetch_core_pools_config("core_pools_whitelist.json") == {
+        "mainnet": {}
+    }
+    assert responses.calls[1].request.headers["If-None-Match"] == '"v1"'
@@ -0,0 +1,141 @@
+import threading
+import time
+
+import pytest
+
+from bal_tools import price_store as price_store_module
+from bal_tools.price_store import DAY, PriceStore, price_range_for
+from bal_tools.twap import TwapEngine
+
+NOW = 1_750_000_000
+
+
+class FakeApi:
+    def __init__(self, steps=None):
+        self.calls = []
+        # range -> spacing of its points
+        self.steps = steps or {}
+
+    def __call__(self, addresses, chain, price_range):
+        self.calls.append((tuple(addresses), price_range))
+        length = dict(price_store_module.PRICE_RANGES)[price_range]
+        now = int(time.time())
+        return [
+            {
+                "address": address,
+                "chain": chain,
+                "prices": [
+                    {"timestamp": ts, "price": str(ts % 1000)}
+                    for ts in range(
+                        now - length, now + 1, self.steps.get(price_range, DAY)
+                    )
+                ],
+            }
+            for address in addresses
+        ]
+
+
+@pytest.fixture
+def now(monkeypatch):
+    clock = {"now": NOW}
+    monkeypatch.setattr(time, "time", lambda: clock["now"])
+    return clock
+
+
+def test_price_range_for():
+    assert price_range_for(2 * DAY) == "SEVEN_DAY"
+    assert price_range_for(20 * DAY) == "THIRTY_DAY"
+    assert price_range_for(400 * DAY) == "ONE_YEAR"
+
+
+def test_store_tops_up_incrementally(now):
+    store = PriceStore(refresh_interval=3600)
+    api = FakeApi()
+
+    histories = store.get_histories("mainnet", ["0xA", "0xb"], api, NOW - 300 * DAY)
+    assert api.calls == [(("0xa", "0xb"), "ONE_YEAR")]
+    assert len(histories["0xa"]) == 366
+
+    # served from memory, also for a narrower window
+    store.get_histories("MAINNET", ["0xa"], api, NOW - 10 * DAY)
+    assert len(api.calls) == 1
+
+    # two days later only the recent points are requested and appended
+    now["now"] = NOW + 2 * DAY
+    histories = store.get_histories("MAINNET", ["0xa"], api, NOW - 300 * DAY)
+    assert api.calls[-1] == (("0xa",), "SEVEN_DAY")
+    assert len(histories["0xa"]) == 368
+    assert histories["0xa"].last_timestamp == NOW + 2 * DAY
+
+    # windows that ended before the last download never trigger a refresh
+    now["now"] = NOW + 3 * DAY
+    store.get_histories("MAINNET", ["0xa"], api, NOW - 300 * DAY, NOW)
+    assert len(api.calls) == 2
+
+
+def test_store_persists_to_sqlite(now, tmp_path):
+    api = FakeApi()
+    PriceStore(tmp_path / "prices.sqlite").get_histories(
+        "MAINNET", ["0xa"], api, NOW - 5 * DAY
+    )
+    histories = PriceStore(tmp_path / "prices.sqlite").get_histories(
+        "MAINNET", ["0xa"], api, NOW - 5 * DAY
+    )
+    assert len(api.calls) == 1
+    assert len(histories["0xa"]) == 366
+
+
+def test_store_keeps_one_spacing(now):
+    store = PriceStore(refresh_interval=3600)
+    api = FakeApi(steps={"SEVEN_DAY": 3600})
+    store.get_histories("MAINNET", ["0xa"], api, NOW - 300 * DAY)
+
+    # the hourly points of the top-up are thinned to the daily ones of the history
+    now["now"] = NOW + 2 * DAY
+    history = store.get_histories("MAINNET", ["0xa"], api, NOW - 300 * DAY)["0xa"]
+    assert api.calls[-1] == (("0xa",), "SEVEN_DAY")
+    assert len(history) == 368
+    assert set(history.timestamps[-3:] - NOW) == {0, DAY, 2 * DAY}
+
+
+def test_store_fetches_outside_the_lock(now):
+    started, release = threading.Event(), threading.Event()
+    api = FakeApi()
+
+    def slow_fetch(addresses, chain, price_range):
+        if chain == "MAINNET":
+            started.set()
+            release.wait(5)
+        return api(addresses, chain, price_range)
+
+    store = PriceStore()
+    mainnet = threading.Thread(
+        target=store.get_histories, args=("MAINNET", ["0xa"], slow_fetch, NOW - DAY)
+    )
+    mainnet.start()
+    started.wait(5)
+    # another chain is served while the mainnet download is in flight
+    histories = store.get_histories("GNOSIS", ["0xa"], slow_fetch, NOW - DAY)
+    assert len(histories["0xa"]) == 366
+    assert not release.is_set() and mainnet.is_alive()
+    release.set()
+    mainnet.join(5)
+    assert len(api.calls) == 2
+
+
+def test_twap_independent_of_store_history(now):
+    api = FakeApi(steps={"SEVEN_DAY": 3600, "THIRTY_DAY": 3600})
+    warmed = PriceStore(refresh_interval=3600)
+    warmed.get_histories("MAINNET", ["0xa"], api, NOW - 300 * DAY)
+
+    now["now"] = NOW + 2 * DAY
+    window = (NOW - 3 * DAY, NOW + 2 * DAY)
+    twaps = [
+        TwapEngine(store.get_histories("MAINNET", ["0xa"], api, window[0])).twap(
+            "0xa", window
+        )
+        for store in (warmed, PriceStore())
+    ]
+    # a cold store fetches daily points too, not the denser recent ranges
+    assert api.calls[1:] == [(("0xa",), "SEVEN_DAY"), (("0xa",), "ONE_YEAR")]
+    assert twaps[0] == twaps[1]
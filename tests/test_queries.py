@@ -0,0 +1,49 @@
+import pytest
+
+from bal_tools.errors import QueryVariablesError
+from bal_tools.queries import QueryRegistry, QUERY_REGISTRY
+
+
+def test_query_parsed_once():
+    registry = QueryRegistry()
+    first = registry.get("core", "pool_snapshots")
+    assert registry.get("core", "pool_snapshots") is first
+
+
+def test_query_by_operation_name():
+    registry = QueryRegistry()
+    assert registry.get("snapshot", "GetActiveProposals") is registry.get(
+        "snapshot", "get_active_proposals"
+    )
+
+
+def test_preload_registers_all_bundled_queries():
+    registry = QueryRegistry()
+    assert registry.preload() > 0
+    assert ("apiv3", "vebal_get_voting_list") in registry._queries
+
+
+def test_unknown_query():
+    with pytest.raises(FileNotFoundError):
+        QueryRegistry().get("core", "does_not_exist")
+
+
+def test_validate_variables():
+    QUERY_REGISTRY.validate_variables(
+        "core", "get_user_pool_balances", {"poolId": "0x1", "block": 1}
+    )
+    # optional variables may be omitted
+    QUERY_REGISTRY.validate_variables(
+        "core", "get_user_pool_balances", {"poolId": "0x1"}
+    )
+
+    with pytest.raises(QueryVariablesError, match="Missing required"):
+        QUERY_REGISTRY.validate_variables("core", "get_user_pool_balances", {})
+    with pytest.raises(QueryVariablesError, match="Unknown"):
+        QUERY_REGISTRY.validate_variables(
+            "core", "get_user_pool_balances", {"poolId": "0x1", "foo": 1}
+        )
+    with pytest.raises(QueryVariablesError, match="does not match"):
+        QUERY_REGISTRY.validate_variables(
+            "core", "get_user_pool_balances", {"poolId": "0x1", "block": "1"}
+        )
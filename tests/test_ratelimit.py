@@ -0,0 +1,122 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+
+import pytest
+import responses
+from requests import Session
+
+from bal_tools import transport
+from bal_tools.models import RateLimitMetrics
+from bal_tools.ratelimit import RateLimiterRegistry, TokenBucket, retry_after_seconds
+
+
+def test_token_bucket_burst_then_rate():
+    bucket = TokenBucket(rate=50, capacity=5)
+    waits = [bucket.reserve() for _ in range(10)]
+    assert waits[:5] == [0.0] * 5
+    # the rest are spaced by 1 / rate
+    assert all(b > a for a, b in zip(waits[5:], waits[6:]))
+    assert abs(waits[-1] - 5 / 50) < 0.01
+
+
+def test_token_bucket_shared_by_threads():
+    bucket = TokenBucket(rate=100, capacity=1)
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda _: bucket.acquire(), range(21)))
+    # one token up front, 20 more at 100 per second
+    assert time.monotonic() - start >= 0.19
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds({"Retry-After": "3"}) == 3
+    assert retry_after_seconds({}) is None
+    assert retry_after_seconds({"Retry-After": "soon"}) is None
+    later = formatdate(time.time() + 60, usegmt=True)
+    assert 55 < retry_after_seconds({"Retry-After": later}) <= 60
+
+
+def test_token_bucket_pause_and_metrics():
+    bucket = TokenBucket(jitter=0)
+    assert bucket.reserve() == 0
+    bucket.pause(0.05)
+    assert 0 < bucket.reserve() <= 0.05
+    assert bucket.metrics == RateLimitMetrics(
+        requests=2, throttled=1, waited=bucket.metrics.waited, pauses=1
+    )
+
+
+def test_token_bucket_async():
+    bucket = TokenBucket(rate=100, capacity=1)
+
+    async def run():
+        start = time.monotonic()
+        await asyncio.gather(*[bucket.acquire_async() for _ in range(11)])
+        return time.monotonic() - start
+
+    assert asyncio.run(run()) >= 0.09
+
+
+def test_registry_tiers():
+    registry = RateLimiterRegistry()
+    etherscan = registry.get("https://api.etherscan.io/v2/api?chainid=1")
+    assert etherscan.rate == 5
+    assert registry.get("api.etherscan.io") is etherscan
+    registry.configure("https://api.etherscan.io", tier="advanced")
+    assert etherscan.rate == 20
+    with pytest.raises(ValueError):
+        registry.configure("api.etherscan.io", tier="platinum")
+    assert registry.get("https://example.com:8000/graphql").rate is None
+    assert set(registry.metrics()) == {"api.etherscan.io", "example.com"}
+
+
+@responses.activate
+def test_retry_after_pauses_host(monkeypatch):
+    registry = RateLimiterRegistry()
+    monkeypatch.setattr(transport, "RATE_LIMITERS", registry)
+    url = "https://limited.example/graphql"
+    responses.add(responses.POST, url, status=429, headers={"Retry-After": "30"})
+
+    session = Session()
+    session.mount("https://", transport.RateLimitedAdapter())
+    assert session.post(url).status_code == 429
+    assert 29 < registry.get(url).paused_for() <= 30
+    assert registry.get(url).metrics.pauses == 1
+
+
+class RetryAfterHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.server.calls += 1
+        if self.server.calls == 1:
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def test_retry_after_waited_once(monkeypatch):
+    monkeypatch.setattr(transport, "RATE_LIMITERS", RateLimiterRegistry())
+    server = HTTPServer(("127.0.0.1", 0), RetryAfterHandler)
+    server.calls = 0
+    Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/graphql"
+        session = transport.get_session(url, 3, 0.0, (429,))
+        start = time.monotonic()
+        assert session.post(url).status_code == 200
+        # the limiter sleeps through the pause; urllib3 must not sleep it again
+        assert 1 <= time.monotonic() - start < 1.5
+        assert server.calls == 2
+    finally:
+        transport.close_sessions()
+        server.shutdown()
+        server.server_close()
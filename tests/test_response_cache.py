@@ -0,0 +1,99 @@
+import pytest
+import responses
+from gql import gql
+
+from bal_tools.subgraph import Subgraph
+from bal_tools.response_cache import (
+    MemoryResponseCache,
+    SQLiteResponseCache,
+    DirectoryResponseCache,
+    ResponseCache,
+    response_cache_key,
+    response_ttl,
+)
+
+URL = "https://gateway.thegraph.com/api/0123456789abcdef/subgraphs/id/test"
+
+
+@pytest.fixture(params=["memory", "sqlite", "directory"])
+def response_cache(request, tmp_path):
+    if request.param == "memory":
+        return MemoryResponseCache(maxsize=2)
+    if request.param == "sqlite":
+        return SQLiteResponseCache(tmp_path / "responses.sqlite")
+    return DirectoryResponseCache(tmp_path / "responses")
+
+
+def test_backend_roundtrip_and_expiry(response_cache):
+    response_cache.set("a", {"pool": {"id": "0x1"}})
+    response_cache.set("b", {"pools": []}, ttl=-1)
+    assert response_cache.get("a") == {"pool": {"id": "0x1"}}
+    assert response_cache.get("b") is None
+    assert response_cache.get("missing") is None
+    response_cache.clear()
+    assert response_cache.get("a") is None
+
+
+def test_memory_cache_evicts_least_recently_used():
+    cache = MemoryResponseCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("a") == 1 and cache.get("b") is None
+
+
+def test_memory_cache_bounded_by_size():
+    cache = MemoryResponseCache(maxsize=100, maxbytes=20)
+    cache.set("a", "x" * 8)
+    cache.set("b", "y" * 8)
+    assert cache.nbytes == 20
+    cache.set("c", "z" * 8)
+    assert cache.get("a") is None and cache.get("c") == "z" * 8
+    assert cache.nbytes == 20
+    # responses larger than the whole cache are not kept
+    cache.set("d", "w" * 30)
+    assert cache.get("d") is None and cache.get("c") == "z" * 8
+    cache.clear()
+    assert cache.nbytes == 0
+
+
+def test_default_paths_follow_cache_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr("bal_tools.cache.CACHE_DIR", tmp_path)
+    assert SQLiteResponseCache().path == tmp_path / "responses.sqlite"
+    assert DirectoryResponseCache().path == tmp_path / "responses"
+    with pytest.raises(TypeError):
+        ResponseCache()
+
+
+def test_response_cache_key():
+    query = gql("query Q($block: Int) { pools(block: {number: $block}) { id } }")
+    reformatted = gql(
+        "query Q($block: Int) {\n  pools(block: {number: $block}) {\n id\n}\n}"
+    )
+    other_key_url = URL.replace("0123456789abcdef", "fedcba9876543210")
+    key = response_cache_key(URL, query, {"block": 1})
+
+    assert key == response_cache_key(other_key_url, reformatted, {"block": 1})
+    assert key != response_cache_key(URL, query, {"block": 2})
+    assert response_ttl({"block": 1}) is None
+    assert response_ttl({"block": None}) > 0
+
+
+@responses.activate
+def test_fetch_graphql_data_served_from_cache(response_cache):
+    responses.add(responses.POST, URL, json={"data": {"test": 1}})
+    responses.add(responses.POST, URL, json={"data": {"test": 2}})
+    subgraph = Subgraph(response_cache=response_cache)
+
+    query = "query Q($block: Int) { test(block: $block) }"
+    assert subgraph.fetch_graphql_data("core", query, {"block": 1}, url=URL) == {
+        "test": 1
+    }
+    assert subgraph.fetch_graphql_data("core", query, {"block": 1}, url=URL) == {
+        "test": 1
+    }
+    assert subgraph.fetch_graphql_data("core", query, {"block": 2}, url=URL) == {
+        "test": 2
+    }
+    assert len(responses.calls) == 2
@@ -1,13 +1,18 @@
 import pytest
+import responses
 from decimal import Decimal
 import json
 import warnings
 import time
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 from bal_tools.subgraph import Subgraph, GqlChain, Pool, PoolSnapshot
+from bal_tools.etherscan import BlockCache, Etherscan
 from bal_tools.errors import NoPricesFoundError
+from bal_tools.ratelimit import RATE_LIMITERS
 
 
 @pytest.fixture(scope="module")
@@ -251,3 +256,161 @@ def test_fetch_pools_by_type(subgraph):
             pytest.skip(f"API or network issue: {e}")
         else:
             raise
+
+
+@pytest.fixture
+def url_cache(tmp_path, monkeypatch):
+    from bal_tools import cache, subgraph as subgraph_module
+
+    monkeypatch.setattr(cache, "CACHE_DIR", tmp_path)
+    monkeypatch.setenv("GRAPH_API_KEY", "secret")
+    subgraph_module.clear_url_cache(persist=False)
+    yield subgraph_module
+    subgraph_module.clear_url_cache(persist=False)
+
+
+def test_subgraph_url_cache_shared_across_instances(url_cache, monkeypatch, tmp_path):
+    calls = []
+
+    def resolve(self, subgraph="core"):
+        calls.append((self.chain, subgraph))
+        return "https://gateway.thegraph.com/api/secret/subgraphs/id/abc"
+
+    monkeypatch.setattr(Subgraph, "resolve_subgraph_url", resolve)
+
+    assert (
+        Subgraph("mainnet").get_subgraph_url("core").endswith("secret/subgraphs/id/abc")
+    )
+    assert (
+        Subgraph("mainnet").get_subgraph_url("core").endswith("secret/subgraphs/id/abc")
+    )
+    assert calls == [("mainnet", "core")]
+
+    # the api key never hits the disk
+    on_disk = (tmp_path / url_cache.SUBGRAPH_URL_CACHE_FILE).read_text()
+    assert "secret" not in on_disk
+    assert "[api-key]" in on_disk
+
+
+def test_url_warnings_per_thread(url_cache, monkeypatch):
+    barrier = threading.Barrier(2)
+
+    def resolve(self, subgraph="core"):
+        url = f"https://{self.chain}.example/{subgraph}"
+        barrier.wait(5)
+        self._warn_missing_graph_api_key(subgraph, url)
+        barrier.wait(5)
+        return url
+
+    monkeypatch.setattr(Subgraph, "resolve_subgraph_url", resolve)
+    subgraph = Subgraph("mainnet")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(subgraph.get_subgraph_url, ["core", "gauges"]))
+
+    # each resolution keeps only its own warning
+    for name in ("core", "gauges"):
+        entry = url_cache._get_cached_url(url_cache._url_cache_key("mainnet", name))
+        assert (
+            len(entry["warnings"]) == 1 and f"subgraph:{name}" in entry["warnings"][0]
+        )
+
+
+def test_warm_url_cache(url_cache, monkeypatch):
+    monkeypatch.setattr(
+        Subgraph,
+        "resolve_subgraph_url",
+        lambda self, subgraph="core": f"https://{self.chain}.example/{subgraph}",
+    )
+    urls = url_cache.warm_url_cache(["mainnet", "arbitrum"], subgraphs=["core"])
+    assert urls == {
+        "mainnet": {"core": "https://mainnet.example/core"},
+        "arbitrum": {"core": "https://arbitrum.example/core"},
+    }
+
+
+@responses.activate
+def test_etherscan_blocks_by_timestamps(tmp_path):
+    calls = []
+
+    def callback(request):
+        params = request.params
+        calls.append((params["chainid"], params["timestamp"]))
+        block = int(params["timestamp"]) // 10
+        return 200, {}, json.dumps({"status": "1", "result": str(block)})
+
+    responses.add_callback(responses.GET, Etherscan.BASE_URL, callback=callback)
+    shared_rate = RATE_LIMITERS.get(Etherscan.BASE_URL).rate
+    etherscan = Etherscan(
+        "key",
+        block_cache=BlockCache(tmp_path / "blocks.sqlite"),
+        requests_per_second=100,
+    )
+    # the client's own limit leaves the process wide one alone
+    assert etherscan.rate_limiters.get(Etherscan.BASE_URL).rate == 100
+    assert RATE_LIMITERS.get(Etherscan.BASE_URL).rate == shared_rate
+    recent = int(time.time())
+    blocks = etherscan.get_blocks_by_timestamps(
+        {"mainnet": [1000, 2000, 1000, recent], "arbitrum": [1000]}
+    )
+    assert blocks == {
+        "mainnet": {1000: 100, 2000: 200, recent: recent // 10},
+        "arbitrum": {1000: 100},
+    }
+    assert len(calls) == 4
+
+    # old timestamps come from the cache, recent ones are looked up again
+    etherscan = Etherscan(
+        "key",
+        block_cache=BlockCache(tmp_path / "blocks.sqlite"),
+        requests_per_second=100,
+    )
+    assert etherscan.get_block_by_timestamp("mainnet", 2000) == 200
+    assert etherscan.get_block_by_timestamp("mainnet", recent) == recent // 10
+    assert len(calls) == 5
+    assert etherscan.get_block_by_timestamp("mainnet", "2000") == 200
+    assert etherscan.get_block_by_timestamp("mainnet", 2000.5) == 200
+    assert len(calls) == 5
+
+
+def test_etherscan_rate_limit_delay_shim():
+    shared_rate = RATE_LIMITERS.get(Etherscan.BASE_URL).rate
+    etherscan = Etherscan("key")
+    assert etherscan.rate_limit_delay == 1 / shared_rate
+    with pytest.warns(DeprecationWarning):
+        etherscan.rate_limit_delay = 0.5
+    assert etherscan.rate_limit_delay == 0.5
+    assert etherscan.rate_limiters.get(Etherscan.BASE_URL).rate == 2
+    assert RATE_LIMITERS.get(Etherscan.BASE_URL).rate == shared_rate
+    adapter = etherscan.session.get_adapter(Etherscan.BASE_URL)
+    assert adapter.registry is etherscan.rate_limiters
+    with pytest.warns(DeprecationWarning):
+        etherscan._rate_limit()
+    assert etherscan.last_request_time > 0
+
+
+def test_block_cache_default_path(monkeypatch, tmp_path):
+    monkeypatch.setattr("bal_tools.cache.CACHE_DIR", tmp_path)
+    BlockCache().set_many("mainnet", {1000: 100}, "before")
+    assert (tmp_path / "blocks.sqlite").exists()
+    assert BlockCache().get_many("mainnet", [1000], "before") == {1000: 100}
+
+
+def test_first_blocks_after_timestamps_subgraph_fallback(monkeypatch):
+    requests = []
+
+    def fetch(self, subgraph, query, params=None, url=None):
+        requests.append(params)
+        count = len(params) // 2
+        return {
+            f"q{i}": [{"number": str(params[f"timestamp_gt_{i}"] + 200)}]
+            for i in range(count)
+        }
+
+    monkeypatch.setattr(Subgraph, "fetch_graphql_data", fetch)
+    blocks = Subgraph("mainnet").get_first_blocks_after_utc_timestamps(
+        [100, 200, 300, 100], use_etherscan=False, chunk_size=2
+    )
+    assert blocks == {100: 100, 200: 200, 300: 300}
+    assert [len(r) for r in requests] == [4, 2]
@@ -0,0 +1,33 @@
+import responses
+
+from bal_tools.subgraph import Subgraph
+from bal_tools.transport import PooledRequestsHTTPTransport, close_sessions, get_session
+
+URL = "https://graph.example/subgraphs/test"
+
+
+def test_transports_share_pooled_session():
+    close_sessions()
+    a = PooledRequestsHTTPTransport(url=URL, retries=3)
+    b = PooledRequestsHTTPTransport(url=URL, retries=3)
+    a.connect()
+    b.connect()
+    assert a.session is b.session is get_session(URL, 3)
+
+    # closing a transport must not tear down the shared session
+    a.close()
+    assert a.session is None
+    assert get_session(URL, 3) is b.session
+
+
+@responses.activate
+def test_fetch_graphql_data_reuses_session():
+    close_sessions()
+    responses.add(responses.POST, URL, json={"data": {"test": 1}})
+    responses.add(responses.POST, URL, json={"data": {"test": 2}})
+
+    subgraph = Subgraph()
+    assert subgraph.fetch_graphql_data("core", "{ test }", url=URL) == {"test": 1}
+    session = get_session(URL, 10, 2.0, [400, 429, 500, 502, 503, 504, 520])
+    assert subgraph.fetch_graphql_data("core", "{ test }", url=URL) == {"test": 2}
+    assert get_session(URL, 10, 2.0, [400, 429, 500, 502, 503, 504, 520]) is session
@@ -0,0 +1,168 @@
+import time
+from decimal import Decimal
+
+import numpy as np
+import pytest
+
+from bal_tools.errors import NoPricesFoundError
+from bal_tools.subgraph import Subgraph
+from bal_tools.twap import (
+    PriceHistory,
+    TwapEngine,
+    filter_outliers_and_average_batch,
+    to_padded,
+)
+from bal_tools.price_store import PriceStore
+
+DAY = 24 * 3600
+START = 1_700_000_000
+
+
+def historical_prices(n_tokens=3, n_points=365, seed=0, start=START):
+    rng = np.random.default_rng(seed)
+    return [
+        {
+            "address": f"0x{i:040x}",
+            "chain": "MAINNET",
+            "prices": [
+                {"timestamp": start + d * DAY, "price": str(p)}
+                for d, p in enumerate(rng.uniform(1, 2, n_points))
+            ],
+        }
+        for i in range(n_tokens)
+    ] + [{"address": f"0x{0:040x}", "chain": "GNOSIS", "prices": []}]
+
+
+def brute_force_twap(token_prices, address, date_range):
+    # the pre-engine implementation of get_twap_price_token
+    prices = [
+        Decimal(item["price"])
+        for entry in token_prices
+        if entry["address"] == address and entry["chain"] == "MAINNET"
+        for item in entry["prices"]
+        if date_range[1] >= int(item["timestamp"]) >= date_range[0]
+    ]
+    return Subgraph().filter_outliers_and_average(prices)
+
+
+def test_price_history_window():
+    history = PriceHistory([30, 10, 20], ["3", "1", "2"])
+    assert list(history.timestamps) == [10, 20, 30]
+    assert history.window((10, 20)) == slice(0, 2)
+    assert history.window((11, 29)) == slice(1, 2)
+    assert history.window((31, 40)) == slice(3, 3)
+
+
+def test_twaps_match_brute_force():
+    token_prices = historical_prices()
+    engine = TwapEngine.from_historical_prices(token_prices, "MAINNET")
+    addresses = [f"0x{i:040x}" for i in range(3)]
+    date_ranges = [(START + w * 7 * DAY, START + (w + 1) * 7 * DAY) for w in range(50)]
+
+    twaps = engine.twaps(addresses, date_ranges)
+
+    for date_range in date_ranges:
+        for address, result in zip(addresses, twaps[date_range]):
+            assert result.address == address
+            assert result.twap_price == brute_force_twap(
+                token_prices, address, date_range
+            )
+
+
+def test_twap_single_point_and_missing():
+    engine = TwapEngine.from_historical_prices(historical_prices(), "MAINNET")
+    address = f"0x{1:040x}"
+    day = engine.twap(address, (START + DAY, START + DAY))
+    assert day.twap_price == Decimal(engine.histories[address].raw_prices[1])
+    with pytest.raises(NoPricesFoundError):
+        engine.twap(address, (START - 2 * DAY, START - DAY))
+    with pytest.raises(NoPricesFoundError):
+        engine.twap("0xunknown", (START, START + DAY))
+
+
+def test_twap_prices_for_pools(monkeypatch):
+    start = int(time.time()) - 300 * DAY
+    token_prices = historical_prices(n_tokens=4, start=start)
+    address = [entry["address"] for entry in token_prices]
+    pools = {
+        address[0] + "0002" + "0" * 20: [address[1], address[2]],
+        address[3] + "0002" + "0" * 20: [address[2]],
+    }
+    requests = []
+
+    def fetch(self, subgraph, query, params=None, url=None):
+        requests.append(query)
+        if query == "get_pools_tokens":
+            return {
+                "poolGetPools": [
+                    {"id": pool_id, "poolTokens": [{"address": a} for a in tokens]}
+                    for pool_id, tokens in pools.items()
+                    if pool_id in params["poolIds"]
+                ]
+            }
+        # every address once, whatever the number of pools it is in
+        assert sorted(params["addresses"]) == sorted(set(address))
+        return {"tokenGetHistoricalPrices": token_prices}
+
+    monkeypatch.setattr(Subgraph, "fetch_graphql_data", fetch)
+    subgraph = Subgraph(price_store=PriceStore())
+    date_range = (start + 100 * DAY, start + 107 * DAY)
+
+    result = subgraph.get_twap_prices_for_pools(list(pools), "MAINNET", date_range)
+
+    assert requests == ["get_pools_tokens", "get_historical_token_prices"]
+    for pool_id, tokens in pools.items():
+        assert result[pool_id].bpt_price.address == pool_id[:42]
+        assert [t.address for t in result[pool_id].token_prices] == tokens
+        assert result[pool_id].token_prices[-1].twap_price == brute_force_twap(
+            token_prices, tokens[-1], date_range
+        )
+
+
+def test_filter_outliers_and_average_batch():
+    rng = np.random.default_rng(1)
+    series = [rng.uniform(1, 2, n) for n in (5, 1, 40, 0, 3)]
+    series[2][7] = 1e12  # outlier
+    values = np.concatenate(series)
+    offsets = np.concatenate([[0], np.cumsum([len(s) for s in series])])
+
+    averages = filter_outliers_and_average_batch(values, offsets, iqr_multiplier=1.5)
+
+    subgraph = Subgraph()
+    for s, average in zip(series, averages):
+        if not len(s):
+            assert np.isnan(average)
+            continue
+        expected = subgraph.filter_outliers_and_average(
+            [Decimal(str(v)) for v in s], iqr_multiplier=1.5
+        )
+        assert average == float(expected)
+
+    padded = filter_outliers_and_average_batch(to_padded(values, offsets), None, 1.5)
+    np.testing.assert_array_equal(padded, averages)
+
+    exact = filter_outliers_and_average_batch(
+        values, offsets, 1.5, raw_values=[str(v) for v in values]
+    )
+    assert exact[3] is None
+    assert exact[0] == sum(Decimal(str(v)) for v in series[0]) / 5
+    assert exact[2] == pytest.approx(Decimal(str(averages[2])), rel=Decimal(1e-12))
+
+
+def test_filter_outliers_and_average_batch_matches_single_series():
+    rng = np.random.default_rng(7)
+    lengths = rng.integers(2, 400, 200)
+    series = [rng.lognormal(0, 2, n) for n in lengths]
+    values = np.concatenate(series)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+    subgraph = Subgraph()
+    for iqr_multiplier in (100_000.0, 1.5, 0.0):
+        averages = filter_outliers_and_average_batch(values, offsets, iqr_multiplier)
+        expected = [
+            subgraph.filter_outliers_and_average(
+                [Decimal(str(v)) for v in s], iqr_multiplier
+            )
+            for s in series
+        ]
+        assert [Decimal(str(average)) for average in averages] == expected